@@ -1,19 +1,66 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
+import contextlib
+import fcntl
+import hashlib
 import json
 import logging
+import os
 import pathlib
+import random
 import re
+import socket
+import struct
 import subprocess
+import sys
+import threading
 import time
 import typing as t
+import urllib.error
 import urllib.request
 
+# Installed by the auto-mount-volumes role, with this script
+sys.path.append("/usr/lib/exosphere")
+from exosphere_systemd import SystemdDBus
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 MOUNT_PATH = pathlib.Path("/media/volume")
+MOUNT_OPTIONS = "user,exec,rw,auto,nofail,X-mount.owner=exouser,X-mount.group=exouser,x-systemd.device-timeout=1s"
+
+# Filesystems a volume's exoVolume tag can ask for, and the mkfs options for each tuning
+# profile. XFS allocates inodes as it needs them, so only its inode space limit is tuned.
+FORMAT_PROFILES = {
+    "ext4": {
+        "default": [],
+        "largefile": ["-T", "largefile"],  # One inode per MiB
+        "smallfiles": ["-T", "news"],  # One inode per 4 KiB
+    },
+    "xfs": {
+        "default": [],
+        "largefile": ["-i", "maxpct=5"],
+        "smallfiles": ["-i", "maxpct=50"],
+    },
+}
+RUN_PATH = pathlib.Path("/run/exosphere")
+STATE_PATH = pathlib.Path("/var/lib/exosphere")
+METADATA_URL = "http://169.254.169.254/openstack/latest/meta_data.json"
+
+# How long to wait for a volume's tag to appear in the metadata, and the backoff between requests
+METADATA_TIMEOUT_SECONDS = 10
+BACKOFF_INITIAL_SECONDS = 0.1
+BACKOFF_MAX_SECONDS = 2.0
+
+# With --coalesce, how long to wait for more devices to be attached before mounting
+COALESCE_WINDOW_SECONDS = 0.3
+JOURNAL_SOCKET = "/run/systemd/journal/socket"
+
+# The systemd client, from systemd(); a SystemdDBus if PyGObject is installed, else SystemdMount
+SYSTEMD = None
+SYSTEMD_LOCK = threading.Lock()
 
 
 class FSTab(t.NamedTuple):
@@ -25,6 +72,54 @@ class FSTab(t.NamedTuple):
     fs_passno: str
 
 
+def journal_send(message: str, **fields) -> bool:
+    """
+    Sends a message with structured fields to the systemd journal, using its native protocol
+
+    Returns False if the journal isn't available
+    """
+
+    entry = {"MESSAGE": message, "SYSLOG_IDENTIFIER": "automount-volume", **fields}
+    datagram = "".join(
+        f"{key}={str(value).replace(chr(10), ' ')}\n" for key, value in entry.items()
+    )
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as journal:
+            journal.sendto(datagram.encode("utf-8"), JOURNAL_SOCKET)
+    except OSError:
+        return False
+    return True
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """
+    Times a phase of mounting or unmounting, and records it in the journal
+
+    Each span is a JSON message, with the same data in EXO_* fields, e.g. to find slow formats:
+        journalctl -o json SYSLOG_IDENTIFIER=automount-volume EXO_SPAN=mkfs
+    """
+
+    start = time.monotonic()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        record = {
+            "span": name,
+            "duration_ms": round((time.monotonic() - start) * 1000, 1),
+            "outcome": outcome,
+            **attributes,
+        }
+        message = json.dumps(record)
+        fields = {f"EXO_{key.upper()}": value for key, value in record.items()}
+        if not journal_send(message, **fields):
+            logger.info(message)
+
+
 def sanitize(label: str) -> str:
     return re.sub(r"\W+", "-", label)
 
@@ -42,16 +137,111 @@ def udevadm_info(device: pathlib.Path) -> t.Dict[str, str]:
     )
 
 
+def udev_db_info(device: pathlib.Path) -> t.Optional[t.Dict[str, str]]:
+    """
+    Reads the properties `udevadm info --query=property` would give, without running it
+
+    Kernel properties come from sysfs, and udev's own from its database in /run/udev/data. The
+    database is written once udev has processed the device; until then, and for anything that
+    isn't a block device, this returns None.
+    """
+
+    name = os.path.basename(os.path.realpath(device))
+    class_path = f"/sys/class/block/{name}"
+    try:
+        sys_path = os.path.normpath(
+            os.path.join("/sys/class/block", os.readlink(class_path))
+        )
+        with open(f"{class_path}/uevent", "r", encoding="utf-8") as f:
+            uevent = dict(line.split("=", maxsplit=1) for line in f.read().splitlines())
+        with open(
+            f"/run/udev/data/b{uevent['MAJOR']}:{uevent['MINOR']}",
+            "r",
+            encoding="utf-8",
+        ) as f:
+            db_lines = f.read().splitlines()
+    except (OSError, KeyError, ValueError):
+        return None
+
+    info = {
+        "DEVPATH": sys_path[len("/sys") :],
+        "DEVNAME": f"/dev/{uevent.pop('DEVNAME', name)}",
+        **uevent,
+        "SUBSYSTEM": "block",
+    }
+    links, tags, current_tags = [], [], []
+    for line in db_lines:
+        kind, _, value = line.partition(":")
+        if kind == "E":
+            key, _, val = value.partition("=")
+            info[key] = val
+        elif kind == "I":
+            info["USEC_INITIALIZED"] = value
+        elif kind == "S":
+            links.append(f"/dev/{value}")
+        elif kind == "G":
+            tags.append(value)
+        elif kind == "Q":
+            current_tags.append(value)
+
+    if links:
+        info["DEVLINKS"] = " ".join(links)
+    if tags:
+        info["TAGS"] = f":{':'.join(tags)}:"
+    if current_tags:
+        info["CURRENT_TAGS"] = f":{':'.join(current_tags)}:"
+    return info
+
+
+_device_info_cache: t.Dict[pathlib.Path, t.Dict[str, str]] = {}
+
+
+def device_info(device: pathlib.Path) -> t.Dict[str, str]:
+    """Returns a device's udev properties, read once per run, falling back to udevadm"""
+
+    if device not in _device_info_cache:
+        info = udev_db_info(device)
+        if info is None:
+            logger.info(f"{device} isn't in the udev database, asking udevadm")
+            info = udevadm_info(device)
+        _device_info_cache[device] = info
+    return _device_info_cache[device]
+
+
 def get_disk_uuid(device: pathlib.Path) -> t.Optional[str]:
-    device_info = udevadm_info(device)
-    return device_info.get("ID_SERIAL_SHORT")
+    return device_info(device).get("ID_SERIAL_SHORT")
 
 
-def get_openstack_metadata():
-    with urllib.request.urlopen(
-        "http://169.254.169.254/openstack/latest/meta_data.json"
-    ) as response:
-        return json.load(response)
+def get_openstack_metadata(
+    validators: t.Optional[t.Dict[str, str]] = None, timeout: float = 10
+) -> t.Tuple[t.Optional[bytes], t.Dict[str, str]]:
+    """
+    Fetches the metadata document, conditionally if `validators` from an earlier response are given
+
+    Returns the body, or None if the metadata service says it hasn't changed, and the validators
+    (ETag and Last-Modified) to send next time
+    """
+
+    validators = validators or {}
+    request = urllib.request.Request(METADATA_URL)
+    if validators.get("etag"):
+        request.add_header("If-None-Match", validators["etag"])
+    if validators.get("last_modified"):
+        request.add_header("If-Modified-Since", validators["last_modified"])
+
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            body = response.read()
+            headers = response.headers
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None, validators
+        raise
+
+    return body, {
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+    }
 
 
 def get_all_volume_metadata_v5(metadata):
@@ -73,8 +263,8 @@ def get_all_volume_metadata_v6(metadata):
     return volumes
 
 
-def get_all_volume_metadata():
-    metadata = get_openstack_metadata()
+def parse_volume_metadata(body: bytes):
+    metadata = json.loads(body)
     v5 = {}
     v6 = {}
 
@@ -91,17 +281,137 @@ def get_all_volume_metadata():
     return {**v5, **v6}
 
 
-def get_volume_name(uuid, *, retries=0, default=None):
-    while retries >= 0:
-        names = get_all_volume_metadata()
-        if uuid in names:
-            return names[uuid]["name"]
+class VolumeMetadataCache:
+    """
+    The parsed volume metadata, shared by every automount-volume run through a file under /run
+
+    When several volumes are attached at once, udev starts one run per device. The first run to
+    miss refreshes the cache while holding a lock, and runs that missed meanwhile wait for it and
+    use its result, so the metadata service is asked once rather than once per device.
+
+    Times are from the monotonic clock, which is system-wide and, like /run, reset on boot, so
+    the clock being set early in boot doesn't expire (or extend) the cache.
+    """
+
+    TTL_SECONDS = 60
+
+    def __init__(self, directory: pathlib.Path):
+        self.path = directory / "volume-metadata.json"
+        self.lock_path = directory / "volume-metadata.lock"
+
+    def read(self) -> t.Optional[t.Dict[str, t.Any]]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write(self, cached: t.Dict[str, t.Any]):
+        # Readers don't take the lock, so replace the file rather than rewrite it
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(cached))
+        os.replace(tmp_path, self.path)
+
+    def is_fresh(self, cached: t.Dict[str, t.Any]) -> bool:
+        return time.monotonic() - cached["fetched"] < self.TTL_SECONDS
+
+    def volumes(self) -> t.Dict[str, t.Any]:
+        """Returns the cached volume metadata, or nothing if it has expired"""
+
+        cached = self.read()
+        return cached["volumes"] if cached is not None and self.is_fresh(cached) else {}
+
+    def refresh(
+        self, uuid, timeout: float = 10, since: t.Optional[float] = None
+    ) -> t.Dict[str, t.Any]:
+        """
+        Returns volume metadata fetched since `uuid` was looked up and not found, or since `since`
+
+        The request is conditional on the cached copy's validators, and a body that hashes the
+        same as the cached copy isn't parsed again, since the metadata service doesn't always
+        support conditional requests.
+        """
 
-        if retries:
-            time.sleep(1)
-        retries -= 1
+        missed_at = time.monotonic() if since is None else since
+        try:
+            self.lock_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            lock_file = open(self.lock_path, "w")
+        except OSError as e:
+            logger.warning(f"Not caching volume metadata: {e}")
+            body, _ = get_openstack_metadata(timeout=timeout)
+            return parse_volume_metadata(body)
 
-    return default
+        with lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Another run may have refreshed the cache while this one waited for the lock
+            cached = self.read()
+            if cached is not None and (
+                cached["fetched"] >= missed_at
+                or (self.is_fresh(cached) and uuid in cached["volumes"])
+            ):
+                return cached["volumes"]
+
+            cached = cached or {}
+            fetched = time.monotonic()
+            body, validators = get_openstack_metadata(cached.get("validators"), timeout)
+            digest = (
+                cached.get("sha256")
+                if body is None
+                else hashlib.sha256(body).hexdigest()
+            )
+            if "volumes" in cached and digest == cached.get("sha256"):
+                volumes = cached["volumes"]
+            else:
+                volumes = parse_volume_metadata(body)
+
+            self.write(
+                {
+                    "fetched": fetched,
+                    "volumes": volumes,
+                    "validators": validators,
+                    "sha256": digest,
+                }
+            )
+            return volumes
+
+
+def get_volume_metadata(
+    uuid, *, timeout: float = 0, default=None, since: t.Optional[float] = None
+):
+    """
+    Looks up a volume's exoVolume tag, waiting up to `timeout` seconds for it to appear
+
+    Nova can add a volume's tag a little after the volume is attached, so misses are retried with
+    exponential backoff. The jitter keeps runs for volumes attached together from retrying in
+    step. A first miss is satisfied by metadata fetched after `since` (monotonic time), so
+    lookups that started together can share one fetch.
+    """
+
+    deadline = time.monotonic() + timeout
+    cache = VolumeMetadataCache(RUN_PATH)
+    names = cache.volumes()
+    delay = BACKOFF_INITIAL_SECONDS
+    attempts = 0
+    while uuid not in names:
+        if attempts:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return default
+            time.sleep(min(remaining, random.uniform(delay / 2, delay)))
+            delay = min(delay * 2, BACKOFF_MAX_SECONDS)
+        names = cache.refresh(
+            uuid,
+            timeout=max(1.0, deadline - time.monotonic()),
+            since=None if attempts else since,
+        )
+        attempts += 1
+
+    return names[uuid]
+
+
+def get_volume_name(uuid, *, default=None, **kwargs):
+    metadata = get_volume_metadata(uuid, **kwargs)
+    return default if metadata is None else metadata["name"]
 
 
 def get_mounts(device: t.Optional[pathlib.Path] = None) -> t.Iterable[FSTab]:
@@ -121,83 +431,567 @@ def log_exec(cmd, *args, _ignore_errors=False, **kwargs):
             raise
 
 
-def do_mount(device: pathlib.Path):
-    logger.info(f"do_mount({device})")
-    disk_info = udevadm_info(device)
+class SystemdMount:
+    """Mounts volumes by running systemd-mount, for systems without PyGObject"""
+
+    def mount(self, what: pathlib.Path, where: pathlib.Path, options: str):
+        log_exec(
+            ("systemd-mount", "--options", options, "--collect", str(what), str(where))
+        )
+
+    def unmount(self, where: pathlib.Path):
+        log_exec(("/usr/bin/env", "systemd-mount", "--unmount", str(where)))
+
+
+def systemd() -> t.Union[SystemdDBus, SystemdMount]:
+    """Returns the systemd client, connecting over D-Bus if possible"""
+
+    global SYSTEMD
+    with SYSTEMD_LOCK:
+        if SYSTEMD is None:
+            SYSTEMD = SystemdDBus.connect() or SystemdMount()
+        return SYSTEMD
+
+
+class Volume(t.NamedTuple):
+    device: pathlib.Path
+    disk_info: t.Dict[str, str]
+    name: str
+    mountpoint: pathlib.Path  # Before avoiding collisions with other mounts
+    metadata: t.Dict[str, t.Any]  # The volume's exoVolume tag
+
+
+def resolve_volume(
+    device: pathlib.Path, since: t.Optional[float] = None
+) -> t.Optional[Volume]:
+    """Looks up a device and its volume's name, or returns None if it shouldn't be mounted"""
+
+    with span("udev", device=str(device)):
+        disk_info = device_info(device)
 
-    devname = disk_info["DEVNAME"]
     uuid = disk_info.get("ID_SERIAL_SHORT")
-    volume_name = get_volume_name(uuid, default=device.name, retries=3)
+    with span("metadata", device=str(device)):
+        metadata = get_volume_metadata(
+            uuid,
+            default={"name": device.name},
+            timeout=METADATA_TIMEOUT_SECONDS,
+            since=since,
+        )
+    volume_name = metadata["name"]
     mountpoint: pathlib.Path = MOUNT_PATH / sanitize(volume_name)
 
     if disk_info["DEVTYPE"] == "partition":
         if disk_info.get("ID_FS_USAGE", None) != "filesystem":
-            logger.warning(f"Refusing to mount unformatted partition {devname}")
-            return 2
+            logger.warning(
+                f"Refusing to mount unformatted partition {disk_info['DEVNAME']}"
+            )
+            return None
 
         partition_number = disk_info["PARTN"]
         mountpoint = mountpoint.with_suffix(f".part{partition_number}")
 
-    elif disk_info.get("ID_FS_USAGE", None) != "filesystem":
-        logger.info(f"formatting {device} to ext4")
-        # Options borrowed from https://github.com/systemd/systemd/blob/0e2f18eedd/src/shared/mkfs-util.c#L418-L426
-        log_exec(
-            (
-                "mkfs.ext4",
-                "-L",  # Volume label
-                volume_name[:16],
-                "-U",  # Volume UUID, lets match OpenStack!
-                uuid,
-                "-I",  # Inode size
-                "256",
-                "-m",  # Reserved blocks percentage
-                "0",
-                "-E",  # faster formatting, copied from systemd-makefs
-                "nodiscard,lazy_itable_init=1",
-                "-b",  # Block size
-                "4096",
-                str(device),
-            )
-        )
+    return Volume(device, disk_info, volume_name, mountpoint, metadata)
 
-    elif disk_info.get("ID_FS_LABEL", "") != volume_name:
-        logger.info("Fixing volume label")
-        log_exec(("e2label", str(device), volume_name))
 
-    current_mounts = {m.fs_file: m for m in get_mounts()}
-    if str(mountpoint) in current_mounts:
+def allocate_mountpoint(volume: Volume, taken: t.Set[str]) -> pathlib.Path:
+    """Picks a mount point for the volume that isn't in `taken`, the mount points in use"""
+
+    mountpoint = volume.mountpoint
+    if str(mountpoint) in taken:
         # If udev returned a unique sysname for the device, append it
-        if "SYSNAME" in disk_info:
-            sysname = disk_info["SYSNAME"]
+        if "SYSNAME" in volume.disk_info:
+            sysname = volume.disk_info["SYSNAME"]
             mountpoint = mountpoint.with_name(f"{mountpoint.name}-{sysname}")
         new_mountpoint = mountpoint
         suffix = 1
-        while str(new_mountpoint) in current_mounts:
+        while str(new_mountpoint) in taken:
             new_mountpoint = mountpoint.with_name(f"{mountpoint.name}-{suffix}")
             suffix += 1
         mountpoint = new_mountpoint
 
+    return mountpoint
+
+
+def read_boot_id() -> str:
+    with open("/proc/sys/kernel/random/boot_id", "r", encoding="utf-8") as f:
+        return f.read().strip()
+
+
+def volume_key(volume: Volume) -> str:
+    """Identifies a volume (or partition of one) across attaches, by its serial if it has one"""
+
+    key = volume.disk_info.get("ID_SERIAL_SHORT") or f"dev:{volume.device.name}"
+    if volume.disk_info["DEVTYPE"] == "partition":
+        key += f".part{volume.disk_info['PARTN']}"
+    return key
+
+
+class MountpointIndex:
+    """
+    Allocates mount points while holding a lock, and remembers each volume's mount point
+
+    Used as a context manager, which holds the lock. The index is kept under /var/lib, so a
+    volume that is attached again, even after a reboot, gets its previous mount point back. An
+    allocation also reserves the mount point until the volume is unmounted or the instance
+    reboots, so runs mounting at the same time can't pick the same one before either has
+    finished mounting.
+    """
+
+    def __init__(self):
+        self.path = STATE_PATH / "volume-mountpoints.json"
+        self.lock_path = RUN_PATH / "mountpoints.lock"
+
+    def __enter__(self) -> "MountpointIndex":
+        self.lock_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        self.lock_file = open(self.lock_path, "w")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+
+            try:
+                self.entries = json.loads(self.path.read_text())
+            except (OSError, ValueError):
+                self.entries = {}
+            self.boot_id = read_boot_id()
+            self.mounted = {m.fs_file for m in get_mounts()}
+        except BaseException:
+            # __exit__ isn't called when __enter__ raises
+            self.lock_file.close()
+            raise
+        self.changed = False
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            if self.changed:
+                # Replace the file, so it is never left half written
+                self.path.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+                tmp_path = self.path.with_suffix(".tmp")
+                tmp_path.write_text(json.dumps(self.entries, indent=2, sort_keys=True))
+                os.replace(tmp_path, self.path)
+        finally:
+            self.lock_file.close()
+
+    def allocate(self, volume: Volume) -> pathlib.Path:
+        key = volume_key(volume)
+        taken = self.mounted | {
+            entry["mountpoint"]
+            for other_key, entry in self.entries.items()
+            if other_key != key and entry.get("boot") == self.boot_id
+        }
+
+        previous = self.entries.get(key, {}).get("mountpoint")
+        if previous is not None and previous not in taken:
+            mountpoint = pathlib.Path(previous)
+        else:
+            mountpoint = allocate_mountpoint(volume, taken)
+
+        self.entries[key] = {"mountpoint": str(mountpoint), "boot": self.boot_id}
+        self.changed = True
+        return mountpoint
+
+    def release(self, mountpoint: str):
+        for entry in self.entries.values():
+            if entry["mountpoint"] == mountpoint and entry.get("boot") is not None:
+                entry["boot"] = None
+                self.changed = True
+
+
+def volume_format(volume: Volume) -> t.Tuple[str, str]:
+    """Returns the filesystem and tuning profile for a new volume, as asked for by its tag"""
+
+    filesystem = volume.metadata.get("filesystem", "ext4")
+    profile = volume.metadata.get("profile", "default")
+    if filesystem not in FORMAT_PROFILES:
+        logger.warning(f"Unsupported filesystem {filesystem!r}, using ext4")
+        filesystem = "ext4"
+    if profile not in FORMAT_PROFILES[filesystem]:
+        logger.warning(f"Unknown {filesystem} profile {profile!r}, using the default")
+        profile = "default"
+    return filesystem, profile
+
+
+def mkfs_command(volume: Volume) -> t.List[str]:
+    filesystem, profile = volume_format(volume)
+    uuid = volume.disk_info.get("ID_SERIAL_SHORT")
+    tuning = FORMAT_PROFILES[filesystem][profile]
+
+    if filesystem == "xfs":
+        return [
+            "mkfs.xfs",
+            "-L",  # Volume label
+            volume.name[:12],
+            *(
+                ["-m", f"uuid={uuid}"] if uuid else []
+            ),  # Volume UUID, lets match OpenStack!
+            "-K",  # Don't discard blocks
+            *tuning,
+            str(volume.device),
+        ]
+
+    # Options borrowed from https://github.com/systemd/systemd/blob/0e2f18eedd/src/shared/mkfs-util.c#L418-L426
+    return [
+        "mkfs.ext4",
+        "-L",  # Volume label
+        volume.name[:16],
+        *(["-U", uuid] if uuid else []),  # Volume UUID, lets match OpenStack!
+        "-I",  # Inode size
+        "256",
+        "-m",  # Reserved blocks percentage
+        "0",
+        # Faster formatting: the kernel zeroes inode tables in the background once the volume
+        # is mounted, and journal checksums (on by default) keep a journal that wasn't zeroed
+        # from replaying stale blocks
+        "-E",
+        "nodiscard,lazy_itable_init=1,lazy_journal_init=1",
+        "-b",  # Block size
+        "4096",
+        *tuning,
+        str(volume.device),
+    ]
+
+
+class FormatStatus:
+    """
+    Progress of formatting a device, in /run/exosphere/format/<device>.json
+
+    Read with `automount-volume.py status`.
+    """
+
+    WRITE_INTERVAL_SECONDS = 0.5
+
+    def __init__(self, device: pathlib.Path):
+        self.path = RUN_PATH / "format" / f"{device.name}.json"
+        self.status: t.Dict[str, t.Any] = {"device": str(device)}
+        self.written = 0.0
+
+    def update(self, force: bool = True, **status):
+        self.status.update(status)
+        now = time.monotonic()
+        if not force and now - self.written < self.WRITE_INTERVAL_SECONDS:
+            return
+        self.written = now
+        self.path.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self.status))
+        os.replace(tmp_path, self.path)
+
+
+# Superblock feature flags and group descriptor flags, from the kernel's fs/ext4/ext4.h
+EXT4_INCOMPAT_META_BG = 0x10
+EXT4_INCOMPAT_64BIT = 0x80
+EXT4_RO_COMPAT_GDT_CSUM = 0x10
+EXT4_RO_COMPAT_METADATA_CSUM = 0x400
+EXT4_BG_INODE_ZEROED = 0x4
+
+# mkfs.ext4 prints each step, then redraws its progress in place with backspaces:
+#   Writing inode tables: 0/8\b\b\b1/8\b\b\b2/8...
+MKFS_PROGRESS = re.compile(r"(?P<step>[A-Z][a-z ]+):|(?P<done>\d+)/(?P<total>\d+)")
+
+
+def iter_mkfs_progress(chunks: t.Iterable[bytes]) -> t.Iterator[t.Tuple[str, int, int]]:
+    """Parses mkfs output into (step, done, total) progress updates"""
+
+    step = None
+    for chunk in chunks:
+        for match in MKFS_PROGRESS.finditer(chunk.decode("utf-8", "replace")):
+            if match["step"]:
+                step = match["step"]
+            elif step is not None:
+                yield step, int(match["done"]), int(match["total"])
+
+
+def run_mkfs(volume: Volume, status: FormatStatus):
+    """
+    Runs mkfs for a volume, recording its progress through each step in `status`
+
+    mkfs runs to completion before the volume is mounted; for ext4 it leaves inode tables for
+    the kernel to zero once the volume is mounted, which lazy_init_pending() reports.
+    """
+
+    command = mkfs_command(volume)
+    logger.info(f"Calling {command}")
+    mkfs = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = []
+
+    def read_output():
+        # Progress isn't written line by line, so read whatever is available
+        for chunk in iter(lambda: mkfs.stdout.read1(4096), b""):
+            output.append(chunk)
+            yield chunk
+
+    for step, done, total in iter_mkfs_progress(read_output()):
+        # Record each new step, and progress within a step now and then
+        new_step = step != status.status.get("step")
+        status.update(force=new_step, step=step, done=done, total=total)
+
+    if mkfs.wait():
+        output = b"".join(output)
+        logger.error(output.decode("utf-8", "replace"))
+        raise subprocess.CalledProcessError(mkfs.returncode, command, output)
+
+
+def lazy_init_pending(device: pathlib.Path) -> t.Optional[bool]:
+    """
+    Whether an ext4 filesystem still has inode tables for the kernel to zero in the background
+
+    Reads the device's group descriptors, in which the ext4lazyinit kernel thread sets each
+    group's ITABLE_ZEROED flag once it has zeroed that group. The kernel's metadata goes through
+    the device's page cache, so this is current while the filesystem is mounted. Returns None if
+    the device can't be read as ext4.
+    """
+
+    try:
+        with open(device, "rb") as f:
+            f.seek(1024)
+            superblock = f.read(1024)
+            if len(superblock) < 1024 or superblock[0x38:0x3A] != b"\x53\xef":
+                return None
+            blocks, first_block, log_block_size, blocks_per_group = struct.unpack_from(
+                "<I12xII4xI", superblock, 0x04
+            )
+            incompat, ro_compat = struct.unpack_from("<II", superblock, 0x60)
+            # Without group descriptor checksums, mkfs can't leave inode tables uninitialized
+            if not ro_compat & (EXT4_RO_COMPAT_GDT_CSUM | EXT4_RO_COMPAT_METADATA_CSUM):
+                return False
+            # meta_bg scatters the descriptors through the filesystem
+            if incompat & EXT4_INCOMPAT_META_BG:
+                return None
+            desc_size = 32
+            if incompat & EXT4_INCOMPAT_64BIT:
+                blocks |= struct.unpack_from("<I", superblock, 0x150)[0] << 32
+                desc_size = struct.unpack_from("<H", superblock, 0xFE)[0]
+            groups = -(-(blocks - first_block) // blocks_per_group)
+
+            f.seek((first_block + 1) * (1024 << log_block_size))
+            descriptors = f.read(groups * desc_size)
+    except OSError:
+        return None
+    if len(descriptors) < groups * desc_size:
+        return None
+
+    return any(
+        not flags & EXT4_BG_INODE_ZEROED
+        for (flags,) in (
+            struct.unpack_from("<H", descriptors, group * desc_size + 0x12)
+            for group in range(groups)
+        )
+    )
+
+
+def format_status(device: t.Optional[pathlib.Path] = None):
+    """Prints the formatting status of a device, or of every device formatted since boot"""
+
+    statuses = []
+    for path in sorted((RUN_PATH / "format").glob("*.json")):
+        status = json.loads(path.read_text())
+        if device is None or status["device"] == str(device):
+            if status.get("step") == "mounted" and status.get("filesystem") == "ext4":
+                status["lazy_init"] = lazy_init_pending(pathlib.Path(status["device"]))
+            statuses.append(status)
+    print(json.dumps(statuses, indent=2))
+
+
+def format_and_mount(volume: Volume, mountpoint: pathlib.Path):
+    device, disk_info, volume_name = volume.device, volume.disk_info, volume.name
+    status = None
+
+    # Partitions are mounted as they are; resolve_volume() skips unformatted ones
+    if disk_info["DEVTYPE"] != "partition":
+        if disk_info.get("ID_FS_USAGE", None) != "filesystem":
+            filesystem, profile = volume_format(volume)
+            logger.info(f"formatting {device} to {filesystem} ({profile} profile)")
+            status = FormatStatus(device)
+            status.update(filesystem=filesystem, profile=profile, step="starting")
+            with span("mkfs", device=str(device), filesystem=filesystem):
+                run_mkfs(volume, status)
+            status.update(step="mounting")
+
+        elif disk_info.get("ID_FS_LABEL", "") != volume_name:
+            logger.info("Fixing volume label")
+            with span("label", device=str(device)):
+                if disk_info.get("ID_FS_TYPE") == "xfs":
+                    log_exec(("xfs_admin", "-L", volume_name[:12], str(device)))
+                else:
+                    log_exec(("e2label", str(device), volume_name))
+
     logger.info(f"mounting {device} to {mountpoint}")
     mountpoint.mkdir(mode=0o755, parents=True, exist_ok=True)
-    log_exec(
-        (
-            "systemd-mount",
-            "--options",
-            "user,exec,rw,auto,nofail,X-mount.owner=exouser,X-mount.group=exouser,x-systemd.device-timeout=1s",
-            "--collect",
-            str(device),
-            str(mountpoint),
+    with span("mount", device=str(device), mountpoint=str(mountpoint)):
+        systemd().mount(device, mountpoint, MOUNT_OPTIONS)
+    with span("chown", device=str(device), mountpoint=str(mountpoint)):
+        log_exec(("/usr/bin/chown", "exouser:exouser", str(mountpoint)))
+
+    if status is not None:
+        lazy_init = status.status["filesystem"] == "ext4" and bool(
+            lazy_init_pending(device)
         )
-    )
-    log_exec(("/usr/bin/chown", "exouser:exouser", str(mountpoint)))
+        if lazy_init:
+            logger.info(
+                f"{device} is mounted, inode tables are still being initialized"
+            )
+        status.update(step="mounted", mountpoint=str(mountpoint), lazy_init=lazy_init)
+
+
+def do_mount(device: pathlib.Path):
+    logger.info(f"do_mount({device})")
+    with span("attach", device=str(device)):
+        volume = resolve_volume(device)
+        if volume is None:
+            return 2
+
+        with MountpointIndex() as index:
+            mountpoint = index.allocate(volume)
+        format_and_mount(volume, mountpoint)
+
+
+def mount_batch(devices: t.List[pathlib.Path]) -> t.Dict[pathlib.Path, str]:
+    """
+    Mounts several devices together, returning "mounted", "skipped" or "failed" for each
+
+    Devices are looked up in parallel, so their names come from a shared metadata refresh, then
+    given mount points while holding the index's lock once, and then formatted and mounted in
+    parallel.
+    """
+
+    logger.info(f"mount_batch({', '.join(map(str, devices))})")
+    # e.g. every queued device was detached again during the coalescing window
+    if not devices:
+        return {}
+
+    started = time.monotonic()
+    results = {}
+
+    def resolve(device):
+        try:
+            return resolve_volume(device, since=started)
+        except Exception:
+            logger.exception(f"Failed to look up {device}")
+            results[device] = "failed"
+
+    def mount(volume, mountpoint):
+        try:
+            with span("attach", device=str(volume.device), batch=len(devices)):
+                format_and_mount(volume, mountpoint)
+        except Exception:
+            logger.exception(f"Failed to mount {volume.device}")
+            results[volume.device] = "failed"
+        else:
+            results[volume.device] = "mounted"
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(devices)) as pool:
+        volumes = list(pool.map(resolve, devices))
+
+        futures = []
+        with MountpointIndex() as index:
+            for device, volume in zip(devices, volumes):
+                if volume is None:
+                    results.setdefault(device, "skipped")
+                    continue
+                mountpoint = index.allocate(volume)
+                futures.append(pool.submit(mount, volume, mountpoint))
+        concurrent.futures.wait(futures)
+
+    return results
+
+
+def process_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def queued_attaches(queue: pathlib.Path) -> t.Dict[pathlib.Path, pathlib.Path]:
+    """
+    Returns the devices in the attach queue that are waiting to be mounted, and their entries
+
+    Entries left behind by runs that were killed are removed, and devices that were detached
+    while queued are recorded as skipped.
+    """
+
+    pending = {}
+    for queued in sorted(queue.iterdir()):
+        try:
+            queued_entry = json.loads(queued.read_text())
+        except (OSError, ValueError):
+            # Removed or still being written; its run will take its turn with the lock
+            continue
+        if "result" in queued_entry:
+            continue
+        queued_device = pathlib.Path(queued_entry["device"])
+        if not process_exists(queued_entry["pid"]):
+            logger.info(
+                f"Dropping {queued_device} from the attach queue, its run exited"
+            )
+            queued.unlink(missing_ok=True)
+        elif not os.path.exists(queued_device):
+            logger.info(f"Skipping {queued_device}, it was detached")
+            queued.write_text(json.dumps({**queued_entry, "result": "skipped"}))
+        else:
+            pending[queued_device] = queued
+    return pending
+
+
+def do_mount_coalesced(device: pathlib.Path):
+    """
+    Mounts a device together with any others attached at about the same time
+
+    Each run queues its device, then waits for the attach lock. Whichever run holds the lock
+    waits COALESCE_WINDOW_SECONDS for more devices, then mounts every queued device with
+    mount_batch() and records each result. Runs that were waiting then find their result already
+    recorded; any that aren't (their device was queued too late) take their turn with the lock.
+    """
+
+    queue = RUN_PATH / "attach-queue"
+    queue.mkdir(mode=0o700, parents=True, exist_ok=True)
+    entry = queue / device.name
+    entry.write_text(json.dumps({"device": str(device), "pid": os.getpid()}))
+
+    try:
+        with open(RUN_PATH / "attach.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if "result" not in json.loads(entry.read_text()):
+                time.sleep(COALESCE_WINDOW_SECONDS)
+                pending = queued_attaches(queue)
+                results = {}
+                try:
+                    with span("batch", devices=len(pending)):
+                        results = mount_batch(list(pending))
+                finally:
+                    # Record a result for every device even if the batch failed, so that no
+                    # later run mounts it again
+                    for queued_device, queued in pending.items():
+                        queued.write_text(
+                            json.dumps(
+                                {
+                                    "device": str(queued_device),
+                                    "result": results.get(queued_device, "failed"),
+                                }
+                            )
+                        )
+
+            result = json.loads(entry.read_text())["result"]
+    finally:
+        entry.unlink(missing_ok=True)
+
+    if result == "failed":
+        raise RuntimeError(f"Failed to mount {device}")
+    return 2 if result == "skipped" else None
 
 
 def do_unmount(device: pathlib.Path):
     logger.info(f"do_unmount({device})")
 
-    for _, mountpoint, *_ in get_mounts(device):
-        log_exec(("/usr/bin/env", "systemd-mount", "--unmount", mountpoint))
-        log_exec(("/usr/bin/rmdir", mountpoint))
+    with span("detach", device=str(device)):
+        for _, mountpoint, *_ in get_mounts(device):
+            with span("unmount", device=str(device), mountpoint=mountpoint):
+                systemd().unmount(pathlib.Path(mountpoint))
+            log_exec(("/usr/bin/rmdir", mountpoint))
+            with MountpointIndex() as index:
+                index.release(mountpoint)
 
 
 if __name__ == "__main__":
@@ -206,12 +1000,25 @@ if __name__ == "__main__":
     subparsers = parser.add_subparsers()
     mount_parser = subparsers.add_parser("mount")
     unmount_parser = subparsers.add_parser("unmount")
+    status_parser = subparsers.add_parser(
+        "status", help="show the progress of formatting new volumes"
+    )
 
     mount_parser.add_argument("device", type=pathlib.Path)
+    mount_parser.add_argument(
+        "--coalesce",
+        action="store_true",
+        help="mount together with other devices being attached at the same time",
+    )
     mount_parser.set_defaults(action=do_mount)
 
     unmount_parser.add_argument("device", type=pathlib.Path)
     unmount_parser.set_defaults(action=do_unmount)
 
+    status_parser.add_argument("device", type=pathlib.Path, nargs="?")
+    status_parser.set_defaults(action=format_status)
+
     args = parser.parse_args()
+    if getattr(args, "coalesce", False):
+        args.action = do_mount_coalesced
     args.action(args.device)
@@ -0,0 +1,238 @@
+"""
+The systemd client shared by automount-volume.py and mount_ceph.py
+
+The auto-mount-volumes role installs it in /usr/lib/exosphere/. mount_ceph.py is often piped
+from curl, so it uses this module when it is installed and runs systemctl and systemd-escape
+when it isn't.
+"""
+
+import functools
+import logging
+import pathlib
+import threading
+import typing as t
+
+try:
+    from gi.repository import Gio, GLib
+except ImportError:  # Without PyGObject, SystemdDBus.connect() returns None
+    Gio = GLib = None
+
+logger = logging.getLogger(__name__)
+
+SYSTEMD_BUS_NAME = "org.freedesktop.systemd1"
+SYSTEMD_OBJECT_PATH = "/org/freedesktop/systemd1"
+SYSTEMD_MANAGER_INTERFACE = "org.freedesktop.systemd1.Manager"
+# systemd's own default for how long a unit may take to start (DefaultTimeoutStartSec)
+JOB_TIMEOUT_SECONDS = 90
+
+# Bytes that systemd leaves as they are in unit names; see unit_name_path_escape() in
+# systemd's src/basic/unit-name.c
+UNIT_NAME_CHARS = frozenset(
+    b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789:_."
+)
+
+
+@functools.lru_cache(maxsize=1024)
+def escape_path(val: str) -> str:
+    r"""
+    Escapes a path name as a systemd unit name, as `systemd-escape --path` does
+
+    The path is simplified (repeated slashes and "." are dropped), then slashes become dashes,
+    and any byte of its UTF-8 encoding other than [A-Za-z0-9:_.], as well as a leading dot, is
+    escaped as \xNN.
+
+    Example:
+        escape_path("/media/share/test-share") == "media-share-test\x2dshare"
+    """
+
+    components = [
+        component for component in val.split("/") if component not in ("", ".")
+    ]
+    if ".." in components:
+        raise ValueError(f"{val!r} is not a normalized path, and can't be escaped")
+    if not components:
+        return "-"
+
+    escaped = []
+    for i, byte in enumerate("/".join(components).encode("utf-8", "surrogateescape")):
+        if byte == ord("/"):
+            escaped.append("-")
+        elif byte in UNIT_NAME_CHARS and not (i == 0 and byte == ord(".")):
+            escaped.append(chr(byte))
+        else:
+            escaped.append(f"\\x{byte:02x}")
+    return "".join(escaped)
+
+
+class SystemdError(Exception):
+    """systemd refused a request, or a job failed"""
+
+
+class ManagerBus:
+    """
+    The systemd manager's D-Bus interface, through PyGObject
+
+    JobRemoved signals are received by a GLib main loop in a background thread, so that any
+    thread can wait for its jobs to finish. Only the results of jobs started with start_job()
+    are kept, until wait() returns them; systemd announces every job on the system.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        # Each awaited job's result, or None while it is still running
+        self.awaited: t.Dict[str, t.Optional[str]] = {}
+        self.condition = threading.Condition()
+
+    @classmethod
+    def connect(cls) -> "ManagerBus":
+        bus = cls(Gio.bus_get_sync(Gio.BusType.SYSTEM, None))
+        bus.connection.signal_subscribe(
+            SYSTEMD_BUS_NAME,
+            SYSTEMD_MANAGER_INTERFACE,
+            "JobRemoved",
+            SYSTEMD_OBJECT_PATH,
+            None,
+            Gio.DBusSignalFlags.NONE,
+            bus._job_removed,
+        )
+        threading.Thread(target=GLib.MainLoop().run, daemon=True).start()
+        bus.call("Subscribe")
+        return bus
+
+    def _job_removed(
+        self, connection, sender, path, interface, signal, parameters, *user_data
+    ):
+        _, job, _, result = parameters.unpack()
+        with self.condition:
+            if job in self.awaited:
+                self.awaited[job] = result
+                self.condition.notify_all()
+
+    def variant(self, signature: str, value: t.Any) -> t.Any:
+        return GLib.Variant(signature, value)
+
+    def call(self, method: str, signature: str = "", *args) -> tuple:
+        try:
+            reply = self.connection.call_sync(
+                SYSTEMD_BUS_NAME,
+                SYSTEMD_OBJECT_PATH,
+                SYSTEMD_MANAGER_INTERFACE,
+                method,
+                GLib.Variant(f"({signature})", args) if signature else None,
+                None,
+                Gio.DBusCallFlags.NONE,
+                -1,
+                None,
+            )
+        except GLib.Error as e:
+            raise SystemdError(e.message) from e
+        return reply.unpack() if reply is not None else ()
+
+    def start_job(self, method: str, signature: str, *args) -> str:
+        """Calls a method that queues a job, and returns the job for wait()"""
+
+        # A job can finish before its method returns, so JobRemoved is held back (by the
+        # condition's lock) until the job is awaited
+        with self.condition:
+            (job,) = self.call(method, signature, *args)
+            self.awaited[job] = None
+        return job
+
+    def wait(self, jobs: t.List[str], timeout: float) -> t.Dict[str, str]:
+        """Waits for jobs to finish, returning each one's result ("done", "failed", ...)"""
+
+        with self.condition:
+            self.condition.wait_for(
+                lambda: all(self.awaited.get(job) for job in jobs), timeout
+            )
+            return {job: self.awaited.pop(job, None) or "timeout" for job in jobs}
+
+
+class SystemdDBus:
+    """Starts and stops units over D-Bus, with a job for each unit and no processes"""
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    @classmethod
+    def connect(cls) -> t.Optional["SystemdDBus"]:
+        if Gio is None:
+            return None
+        try:
+            return cls(ManagerBus.connect())
+        except (GLib.Error, SystemdError) as e:
+            logger.debug("Couldn't connect to systemd over D-Bus: %s", e)
+            return None
+
+    def reload(self):
+        self.bus.call("Reload")
+
+    def start(
+        self, units: t.List[str], *, enable: bool = False, reload: bool = False
+    ) -> t.Dict[str, str]:
+        if enable:
+            self.bus.call("EnableUnitFiles", "asbb", units, False, True)
+        if reload:
+            self.reload()
+        return self._run_jobs("StartUnit", "ss", [(unit, "replace") for unit in units])
+
+    def stop(self, units: t.List[str], *, disable: bool = False) -> t.Dict[str, str]:
+        if disable:
+            self.bus.call("DisableUnitFiles", "asb", units, False)
+        return self._run_jobs("StopUnit", "ss", [(unit, "replace") for unit in units])
+
+    def mount(self, what: pathlib.Path, where: pathlib.Path, options: str):
+        """Mounts a block device with a transient mount unit, as systemd-mount does"""
+
+        logger.info("Starting a mount unit for %s at %s", what, where)
+        v = self.bus.variant
+        # Like systemd-mount, check the filesystem before mounting it
+        fsck = f"systemd-fsck@{escape_path(str(what))}.service"
+        properties = [
+            ("Description", v("s", f"Volume {what}")),
+            ("What", v("s", str(what))),
+            ("Where", v("s", str(where))),
+            ("Options", v("s", options)),
+            ("Requires", v("as", [fsck])),
+            ("After", v("as", [fsck])),
+            # Like systemd-mount --collect, unload the unit even if it fails
+            ("CollectMode", v("s", "inactive-or-failed")),
+        ]
+        self._run_job(
+            "StartTransientUnit",
+            "ssa(sv)a(sa(sv))",
+            escape_path(str(where)) + ".mount",
+            "fail",
+            properties,
+            [],
+        )
+
+    def unmount(self, where: pathlib.Path):
+        logger.info("Stopping the mount unit for %s", where)
+        self._run_job("StopUnit", "ss", escape_path(str(where)) + ".mount", "replace")
+
+    def _run_job(self, method: str, signature: str, unit: str, *args):
+        result = self._run_jobs(method, signature, [(unit, *args)])[unit]
+        if result != "done":
+            raise SystemdError(f"{method} {unit}: {result}")
+
+    def _run_jobs(
+        self, method: str, signature: str, calls: t.List[tuple]
+    ) -> t.Dict[str, str]:
+        """Calls a method once for each unit (the first of each call's arguments)"""
+
+        # Every job is queued before waiting for any, so they run together
+        results = {}
+        jobs = {}
+        for unit, *args in calls:
+            try:
+                job = self.bus.start_job(method, signature, unit, *args)
+            except SystemdError as e:
+                results[unit] = str(e)
+            else:
+                jobs[job] = unit
+
+        finished = self.bus.wait(list(jobs), JOB_TIMEOUT_SECONDS)
+        for job, unit in jobs.items():
+            results[unit] = finished[job]
+        return {unit: results[unit] for unit, *_ in calls}
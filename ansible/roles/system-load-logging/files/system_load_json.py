@@ -2,11 +2,65 @@
 
 # Outputs system resource usage on one line as JSON.
 # Uses only the standard library shipped with Ubuntu 20+, Rocky Linux, and AlmaLinux cloud images.
-# Requires "top", "free", and "df" installed.
+# Reads /proc and statvfs directly; the "subprocess" backend, which requires "top", "free", and "df"
+# installed, is kept as a fallback for systems without a readable /proc.
+#
+# Run without arguments to write a single record to stdout. Pass --interval to keep running and
+# write a record every interval seconds (this is how the system-load-logging service runs it).
+# With a shorter --sample-interval, samples taken within each interval are folded into one record
+# holding their mean, plus [min, max, p95] of CPU, memory and GPU usage under "stats" so short
+# bursts are not lost.
+#
+# --format compact writes version 2 records instead, batching several records into one line:
+#   {"v":2,"e":<epoch of first record>,"s":[[<seconds since previous record>,cpu,mem,rootfs,gpu],...]}
+# where the trailing gpu list is left out when there are no GPUs, and "stats" are not kept.
+# --extended and --self-stats only apply to the full format and are rejected with this one.
+# encode_compact() and decode_compact() below are the reference implementation; Exosphere's
+# Helpers.ServerResourceUsage decodes both formats. Use --decode to expand a console log.
+#
+# With --history-file, every record is also kept in a fixed-size, memory-mapped ring buffer on
+# disk, so history survives the console buffer rotating. Read a window of it back as JSON with
+#   system_load_json.py --history-file FILE --query [--since EPOCH] [--until EPOCH]
+# where a negative --since or --until is taken as seconds before now.
+#
+# --extended adds an "ext" object to each full-format record, read from /proc in the same pass:
+#   {
+#     "v": 1,                                  # version of the "ext" schema
+#     "cpuCorePctUsed": [12, 3, ...],          # percent non-idle per core, over the interval
+#     "loadAvg": [0.52, 0.40, 0.33],           # 1, 5 and 15 minute load averages
+#     "swapPctUsed": 0,                        # percent of swap in use, 0 without swap
+#     "mountPctUsed": {"/media/volume/data": 41, "/media/share/scratch": 7},
+#                                              # volumes and shares mounted by Exosphere
+#     "diskBytesPerSec": {"vda": [4096, 81920]},  # read and written per whole disk
+#     "netBytesPerSec": {"eth0": [1200, 860]}     # received and sent per interface
+#   }
+# Rates and per-core usage are averaged over the time since the previous record.
+#
+# GPUs are detected once at start-up. Utilization and memory use are read through NVML (the library
+# behind nvidia-smi) when it can be loaded, otherwise from a long-lived `nvidia-smi --loop-ms`
+# child. Records from hosts with GPUs also carry "gpuMemPctUsed", percent of memory used per GPU.
+#
+# --self-stats adds a "self" object to each full-format record, reporting what this agent costs:
+#   {
+#     "collectMs": 1.84,   # wall time spent collecting the record's samples
+#     "cpuMs": 3.1,        # CPU time used since the previous record, by this process and the
+#                          # commands it waited for (not a long-lived nvidia-smi child)
+#     "rssKb": 12056       # resident memory of this process
+#   }
 
+import argparse
+import ctypes
 import json
+import math
+import mmap
+import os
+import re
+import shutil
+import signal
+import struct
 import subprocess
 import sys
+import threading
 import time
 
 
@@ -14,54 +68,909 @@ def cmd_stdout_lines(cmd_list):
     return subprocess.check_output(cmd_list, text=True).splitlines()
 
 
-def cpu():
-    # Returns percent CPU non-idle
-    top_output_lines = cmd_stdout_lines(["top", "-b", "-n", "1"])
-    cpu_line = next(filter((lambda l: l[:4] == "%Cpu"), top_output_lines))
-    cpu_idle_pct = float(cpu_line.split(",")[3][:5])
-    cpu_used_pct = round(100 - cpu_idle_pct)
-    return cpu_used_pct
+class SubprocessCollector:
+    # Scrapes the output of top, free and df
 
+    def cpu(self):
+        # Returns percent CPU non-idle
+        top_output_lines = cmd_stdout_lines(["top", "-b", "-n", "1"])
+        cpu_line = next(filter((lambda l: l[:4] == "%Cpu"), top_output_lines))
+        cpu_idle_pct = float(cpu_line.split(",")[3][:5])
+        cpu_used_pct = round(100 - cpu_idle_pct)
+        return cpu_used_pct
 
-def mem():
-    # Returns percent of total memory not available
-    # https://www.linuxatemyram.com/
-    free_output_lines = cmd_stdout_lines(["free", "-t", "-m"])
-    total_line = next(filter((lambda l: l[:4] == "Mem:"), free_output_lines))
-    mem_avail_mb = int(total_line.split()[6])
-    mem_total_mb = int(total_line.split()[1])
-    mem_unavail_pct = round(100 - mem_avail_mb / mem_total_mb * 100)
-    return mem_unavail_pct
+    def mem(self):
+        # Returns percent of total memory not available
+        # https://www.linuxatemyram.com/
+        free_output_lines = cmd_stdout_lines(["free", "-t", "-m"])
+        total_line = next(filter((lambda l: l[:4] == "Mem:"), free_output_lines))
+        mem_avail_mb = int(total_line.split()[6])
+        mem_total_mb = int(total_line.split()[1])
+        mem_unavail_pct = round(100 - mem_avail_mb / mem_total_mb * 100)
+        return mem_unavail_pct
 
+    def disk(self):
+        # Returns percent of root filesystem used
+        df_output_lines = cmd_stdout_lines(["df", "/"])
+        rootfs_line = next(filter((lambda l: l.split()[-1] == "/"), df_output_lines))
+        rootfs_used_pct = rootfs_line.split()[-2][:-1]
+        return int(rootfs_used_pct)
 
-def disk():
-    # Returns percent of root filesystem used
-    df_output_lines = cmd_stdout_lines(["df", "/"])
-    rootfs_line = next(filter((lambda l: l.split()[-1] == "/"), df_output_lines))
-    rootfs_used_pct = rootfs_line.split()[-2][:-1]
-    return int(rootfs_used_pct)
 
+def cpu_times(stat_line):
+    # Returns (busy, total) jiffies from a "cpu" line of /proc/stat
+    fields = [int(v) for v in stat_line.split()[1:]]
+    # guest and guest_nice are already counted in user and nice
+    total = sum(fields[:8])
+    # Like top's "id" column, only idle counts as idle; iowait is reported as in use
+    idle = fields[3]
+    return total - idle, total
 
-def gpu():
+
+def read_cpu_times(path="/proc/stat"):
+    # Returns (busy, total) jiffies for all CPUs together
+    with open(path, "r") as f:
+        return cpu_times(f.readline())
+
+
+def read_core_times(path="/proc/stat"):
+    # Returns a list of (busy, total) jiffies, one per core
+    cores = []
+    with open(path, "r") as f:
+        f.readline()
+        for line in f:
+            if not line.startswith("cpu"):
+                break
+            cores.append(cpu_times(line))
+    return cores
+
+
+def pct_of(part, whole):
+    return round(part / whole * 100) if whole > 0 else 0
+
+
+def statvfs_pct_used(path):
+    # Returns percent of a filesystem used, rounded up like df's Use%
+    st = os.statvfs(path)
+    used = st.f_blocks - st.f_bfree
+    usable = used + st.f_bavail
+    if usable == 0:
+        return 0
+    return math.ceil(used * 100 / usable)
+
+
+def read_meminfo(path="/proc/meminfo"):
+    # Returns /proc/meminfo as a dict of kB values
+    meminfo = {}
+    with open(path, "r") as f:
+        for line in f:
+            key, value = line.split(":", maxsplit=1)
+            meminfo[key] = int(value.split()[0])
+    return meminfo
+
+
+class ProcCollector:
+    # Reads /proc/stat, /proc/meminfo and statvfs("/") without starting any processes.
+    # CPU usage is averaged over the time since the previous sample.
+
+    # With no previous sample to compare against, measure over this many seconds
+    FIRST_SAMPLE_SECONDS = 0.5
+
+    def __init__(self):
+        self.prev_cpu_times = None
+
+    def cpu(self):
+        # Returns percent CPU non-idle
+        if self.prev_cpu_times is None:
+            self.prev_cpu_times = read_cpu_times()
+            time.sleep(self.FIRST_SAMPLE_SECONDS)
+        busy, total = read_cpu_times()
+        prev_busy, prev_total = self.prev_cpu_times
+        self.prev_cpu_times = (busy, total)
+        return pct_of(busy - prev_busy, total - prev_total)
+
+    def mem(self):
+        # Returns percent of total memory not available, the same figure free reports
+        meminfo = read_meminfo()
+        return round(100 - meminfo["MemAvailable"] / meminfo["MemTotal"] * 100)
+
+    def disk(self):
+        # Returns percent of root filesystem used, rounded up like df's Use%
+        return statvfs_pct_used("/")
+
+
+EXTENDED_VERSION = 1
+
+# Where automount-volume.py mounts volumes and mount_ceph.py mounts shares
+EXTENDED_MOUNT_PREFIXES = ("/media/volume/", "/media/share/")
+
+
+def unescape_mount_path(path):
+    # /proc/mounts escapes spaces and other whitespace as octal, e.g. \040
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), path)
+
+
+def read_mount_usage(path="/proc/mounts"):
+    # Returns {mount point: percent used} for volumes and shares mounted by Exosphere
+    usage = {}
+    with open(path, "r") as f:
+        for line in f:
+            mountpoint = unescape_mount_path(line.split()[1])
+            if mountpoint.startswith(EXTENDED_MOUNT_PREFIXES):
+                try:
+                    usage[mountpoint] = statvfs_pct_used(mountpoint)
+                except OSError:
+                    pass
+    return usage
+
+
+def read_disk_bytes(path="/proc/diskstats"):
+    # Returns {disk: (bytes read, bytes written)} for whole disks, skipping partitions,
+    # loop and RAM devices. /proc/diskstats counts 512-byte sectors regardless of the device.
+    disks = {}
+    with open(path, "r") as f:
+        for line in f:
+            fields = line.split()
+            name = fields[2]
+            if name.startswith(("loop", "ram", "zram")):
+                continue
+            if not os.path.isdir(os.path.join("/sys/block", name)):
+                continue
+            disks[name] = (int(fields[5]) * 512, int(fields[9]) * 512)
+    return disks
+
+
+def read_net_bytes(path="/proc/net/dev"):
+    # Returns {interface: (bytes received, bytes sent)}, skipping loopback and container veths
+    interfaces = {}
+    with open(path, "r") as f:
+        for line in f.readlines()[2:]:
+            name, counters = line.split(":", maxsplit=1)
+            name = name.strip()
+            if name == "lo" or name.startswith("veth"):
+                continue
+            fields = counters.split()
+            interfaces[name] = (int(fields[0]), int(fields[8]))
+    return interfaces
+
+
+def read_rss_kb(path="/proc/self/statm"):
+    # Returns the resident memory of this process, or None where /proc isn't readable
     try:
-        gpu_utilization = cmd_stdout_lines(
-            [
-                "nvidia-smi",
-                "--query-gpu=utilization.gpu",
-                "--format=csv,noheader,nounits",
-            ]
-        )
-        return [int(l) for l in gpu_utilization]
-    except:
+        with open(path, "r") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
         return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+def read_load_avg(path="/proc/loadavg"):
+    with open(path, "r") as f:
+        return [float(v) for v in f.read().split()[:3]]
+
+
+def byte_rates(prev, current, elapsed):
+    # Returns per-second rates for each counter pair present in both readings
+    return {
+        name: [max(0, round((c - p) / elapsed)) for c, p in zip(counters, prev[name])]
+        for name, counters in current.items()
+        if name in prev
+    }
+
+
+class ExtendedCollector:
+    # Collects the "ext" object from /proc, averaging rates since the previous call
+
+    def __init__(self):
+        self.prev_counters = None
+
+    def counters(self):
+        return {
+            "time": time.monotonic(),
+            "cores": read_core_times(),
+            "disks": read_disk_bytes(),
+            "net": read_net_bytes(),
+        }
+
+    def collect(self):
+        if self.prev_counters is None:
+            self.prev_counters = self.counters()
+            time.sleep(ProcCollector.FIRST_SAMPLE_SECONDS)
+        counters = self.counters()
+        prev = self.prev_counters
+        self.prev_counters = counters
+        elapsed = counters["time"] - prev["time"]
+
+        meminfo = read_meminfo()
+        swap_total = meminfo.get("SwapTotal", 0)
+        swap_used = swap_total - meminfo.get("SwapFree", 0)
+
+        return {
+            "v": EXTENDED_VERSION,
+            "cpuCorePctUsed": [
+                pct_of(busy - prev_busy, total - prev_total)
+                for (busy, total), (prev_busy, prev_total) in zip(
+                    counters["cores"], prev["cores"]
+                )
+            ],
+            "loadAvg": read_load_avg(),
+            "swapPctUsed": pct_of(swap_used, swap_total),
+            "mountPctUsed": read_mount_usage(),
+            "diskBytesPerSec": byte_rates(prev["disks"], counters["disks"], elapsed),
+            "netBytesPerSec": byte_rates(prev["net"], counters["net"], elapsed),
+        }
+
+
+def make_collector(backend):
+    if backend == "auto":
+        backend = "proc" if os.access("/proc/stat", os.R_OK) else "subprocess"
+    return ProcCollector() if backend == "proc" else SubprocessCollector()
+
+
+class NoGpuCollector:
+    # Used when no GPUs were found at start-up
+
+    def read(self):
+        return None
+
+    def close(self):
+        pass
+
+
+class NvidiaSmiGpuCollector:
+    # Runs nvidia-smi once per sample. Slow, but needs nothing else installed.
+
+    QUERY = [
+        "nvidia-smi",
+        "--query-gpu=index,utilization.gpu,memory.used,memory.total",
+        "--format=csv,noheader,nounits",
+    ]
+
+    def read(self):
+        try:
+            return parse_nvidia_smi_lines(cmd_stdout_lines(self.QUERY))
+        except (OSError, subprocess.CalledProcessError, ValueError):
+            return None
+
+    def close(self):
+        pass
+
+
+def parse_nvidia_smi_lines(lines):
+    # Returns [(utilization percent, memory percent used), ...] from QUERY output lines
+    readings = []
+    for line in lines:
+        _, utilization, mem_used, mem_total = [int(v) for v in line.split(",")]
+        readings.append((utilization, pct_of(mem_used, mem_total)))
+    return readings
+
+
+class NvidiaSmiLoopGpuCollector:
+    # Keeps one nvidia-smi running with --loop-ms and remembers the last complete reading of
+    # all GPUs, so sampling never waits for nvidia-smi to start up.
+
+    # Seconds to wait for the first reading after nvidia-smi (re)starts
+    FIRST_READING_TIMEOUT = 5
+
+    def __init__(self, interval, gpu_count):
+        self.interval_ms = max(100, round(interval * 1000))
+        self.gpu_count = gpu_count
+        self.latest = None
+        self.process = None
+        self.start()
+
+    def start(self):
+        self.process = subprocess.Popen(
+            NvidiaSmiGpuCollector.QUERY + [f"--loop-ms={self.interval_ms}"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        self.ready = threading.Event()
+        self.follower = threading.Thread(
+            target=self.follow, args=(self.process, self.ready), daemon=True
+        )
+        self.follower.start()
+
+    def follow(self, process, ready):
+        # nvidia-smi prints one line per GPU each loop, starting from GPU 0. Each loop starts a
+        # new group, so a dropped or extra line only loses that loop's reading.
+        lines = []
+        for line in process.stdout:
+            if line.partition(",")[0].strip() == "0":
+                lines = []
+            elif not lines:
+                continue
+            lines.append(line)
+            if len(lines) == self.gpu_count:
+                try:
+                    self.latest = parse_nvidia_smi_lines(lines)
+                    ready.set()
+                except ValueError:
+                    pass
+                lines = []
+
+    def read(self):
+        if self.process.poll() is not None:
+            # Drop the stale reading and start again
+            self.latest = None
+            self.start()
+        if not self.ready.wait(self.FIRST_READING_TIMEOUT):
+            # Only wait once for an nvidia-smi that never reports
+            self.ready.set()
+        return self.latest
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        self.follower.join()
+
+
+class NvmlGpuCollector:
+    # Reads NVML through ctypes, without starting any processes
+
+    class Utilization(ctypes.Structure):
+        _fields_ = [("gpu", ctypes.c_uint), ("memory", ctypes.c_uint)]
+
+    class Memory(ctypes.Structure):
+        _fields_ = [
+            ("total", ctypes.c_ulonglong),
+            ("free", ctypes.c_ulonglong),
+            ("used", ctypes.c_ulonglong),
+        ]
+
+    def __init__(self, library="libnvidia-ml.so.1"):
+        # Raises OSError if NVML cannot be loaded or has no GPUs
+        self.nvml = ctypes.CDLL(library)
+        self.check(self.nvml.nvmlInit_v2())
+        count = ctypes.c_uint()
+        self.check(self.nvml.nvmlDeviceGetCount_v2(ctypes.byref(count)))
+        if count.value == 0:
+            self.close()
+            raise OSError("NVML found no GPUs")
+        self.handles = []
+        for index in range(count.value):
+            handle = ctypes.c_void_p()
+            self.check(
+                self.nvml.nvmlDeviceGetHandleByIndex_v2(index, ctypes.byref(handle))
+            )
+            self.handles.append(handle)
+
+    @staticmethod
+    def check(result):
+        if result != 0:
+            raise OSError(f"NVML call failed with error {result}")
+
+    def read(self):
+        readings = []
+        try:
+            for handle in self.handles:
+                utilization = self.Utilization()
+                memory = self.Memory()
+                self.check(
+                    self.nvml.nvmlDeviceGetUtilizationRates(
+                        handle, ctypes.byref(utilization)
+                    )
+                )
+                self.check(
+                    self.nvml.nvmlDeviceGetMemoryInfo(handle, ctypes.byref(memory))
+                )
+                readings.append((utilization.gpu, pct_of(memory.used, memory.total)))
+        except OSError:
+            return None
+        return readings
+
+    def close(self):
+        self.nvml.nvmlShutdown()
+
+
+def make_gpu_collector(backend, interval=None):
+    # Picks a GPU collector once, at start-up. "auto" prefers NVML, then a persistent nvidia-smi
+    # loop (or a single nvidia-smi run when not sampling repeatedly), and otherwise gives up on
+    # GPUs so hosts without them pay nothing per sample. The nvidia-smi loop reads GPUs every
+    # interval, which should be the sample interval.
+    if backend in ("auto", "nvml"):
+        try:
+            return NvmlGpuCollector()
+        except (OSError, AttributeError):
+            if backend == "nvml":
+                return NoGpuCollector()
+    if backend == "none" or shutil.which("nvidia-smi") is None:
+        return NoGpuCollector()
+    readings = NvidiaSmiGpuCollector().read()
+    if not readings:
+        return NoGpuCollector()
+    if backend == "nvidia-smi-loop" or (backend == "auto" and interval is not None):
+        return NvidiaSmiLoopGpuCollector(interval or 1, len(readings))
+    return NvidiaSmiGpuCollector()
+
+
+def sample(collector, gpus):
+    record = {
+        "epoch": round(time.time()),
+        "cpuPctUsed": collector.cpu(),
+        "memPctUsed": collector.mem(),
+        "rootfsPctUsed": collector.disk(),
+        "gpuPctUsed": None,
+    }
+    readings = gpus.read()
+    if readings:
+        record["gpuPctUsed"] = [utilization for utilization, _ in readings]
+        record["gpuMemPctUsed"] = [mem_pct for _, mem_pct in readings]
+    return record
+
+
+def summarize(values):
+    # Returns (mean, [min, max, p95]) of a list of numbers, p95 by the nearest-rank method
+    ordered = sorted(values)
+    mean = round(sum(ordered) / len(ordered))
+    return mean, [ordered[0], ordered[-1], ordered[math.ceil(0.95 * len(ordered)) - 1]]
+
+
+def summary_record(samples):
+    # Folds several samples into one record. The usual fields hold the mean, so existing
+    # consumers see an interval average. Root filesystem usage barely moves within an
+    # interval, so only its mean is kept.
+    record = {"epoch": samples[-1]["epoch"]}
+    stats = {}
+    for key in ("cpuPctUsed", "memPctUsed"):
+        record[key], stats[key] = summarize([s[key] for s in samples])
+    record["rootfsPctUsed"] = summarize([s["rootfsPctUsed"] for s in samples])[0]
+
+    for key in ("gpuPctUsed", "gpuMemPctUsed"):
+        gpu_samples = [s[key] for s in samples if s.get(key)]
+        if gpu_samples and all(len(g) == len(gpu_samples[0]) for g in gpu_samples):
+            per_gpu = [summarize(values) for values in zip(*gpu_samples)]
+            record[key] = [mean for mean, _ in per_gpu]
+            stats[key] = [gpu_stats for _, gpu_stats in per_gpu]
+        elif key in samples[-1]:
+            record[key] = samples[-1][key]
+
+    record["stats"] = stats
+    record["samples"] = len(samples)
+    return record
+
+
+class SelfStats:
+    # Measures the agent's own overhead, for the "self" object
+
+    def __init__(self):
+        self.prev_cpu = self.cpu_seconds()
+        self.collect_seconds = 0.0
+
+    @staticmethod
+    def cpu_seconds():
+        times = os.times()
+        return times.user + times.system + times.children_user + times.children_system
+
+    def add_collect_time(self, seconds):
+        self.collect_seconds += seconds
+
+    def collect(self, seconds=0.0):
+        # Returns the overhead since the previous call, including `seconds` more collecting
+        self.add_collect_time(seconds)
+        cpu = self.cpu_seconds()
+        stats = {
+            "collectMs": round(self.collect_seconds * 1000, 2),
+            "cpuMs": round((cpu - self.prev_cpu) * 1000, 1),
+            "rssKb": read_rss_kb(),
+        }
+        self.prev_cpu = cpu
+        self.collect_seconds = 0.0
+        return stats
+
+
+COMPACT_VERSION = 2
+
+
+def encode_compact(records):
+    # Encodes a list of records as one version 2 batch, with epochs stored as deltas
+    prev_epoch = records[0]["epoch"]
+    samples = []
+    for record in records:
+        compact_sample = [
+            record["epoch"] - prev_epoch,
+            record["cpuPctUsed"],
+            record["memPctUsed"],
+            record["rootfsPctUsed"],
+        ]
+        if record.get("gpuPctUsed"):
+            compact_sample.append(record["gpuPctUsed"])
+        samples.append(compact_sample)
+        prev_epoch = record["epoch"]
+    return {"v": COMPACT_VERSION, "e": records[0]["epoch"], "s": samples}
+
+
+def decode_compact(batch):
+    # Expands a version 2 batch back into a list of records
+    if batch.get("v") != COMPACT_VERSION:
+        raise ValueError(f"Unsupported record version {batch.get('v')}")
+    epoch = batch["e"]
+    records = []
+    for compact_sample in batch["s"]:
+        epoch += compact_sample[0]
+        records.append(
+            {
+                "epoch": epoch,
+                "cpuPctUsed": compact_sample[1],
+                "memPctUsed": compact_sample[2],
+                "rootfsPctUsed": compact_sample[3],
+                "gpuPctUsed": compact_sample[4] if len(compact_sample) > 4 else None,
+            }
+        )
+    return records
+
+
+def decode_line(line):
+    # Returns the records in one console log line, in either format. Like Exosphere, skips
+    # anything before the first "{", e.g. the time since boot on lines written to /dev/kmsg.
+    start = line.find("{")
+    if start < 0:
+        return []
+    try:
+        data = json.loads(line[start:])
+    except ValueError:
+        return []
+    if not isinstance(data, dict):
+        return []
+    if "v" in data:
+        try:
+            return decode_compact(data)
+        except (ValueError, KeyError, IndexError, TypeError):
+            return []
+    if "epoch" in data and "cpuPctUsed" in data:
+        return [data]
+    return []
+
+
+class HistoryRing:
+    # Fixed-size ring buffer of records in a memory-mapped file. The header counts every record
+    # ever appended; slot (count % slots) is the next one written. There is one slot more than
+    # the capacity, so readers can skip the slot that may be mid-write. Each slot holds the
+    # epoch, CPU, memory and root filesystem percentages, and up to MAX_GPUS GPU percentages.
+
+    MAGIC = b"EXOLOAD1"
+    MAX_GPUS = 4
+    # magic, capacity, slot size, records appended
+    HEADER = struct.Struct("<8sIIQ")
+    # epoch, cpu, mem, rootfs, GPU count, GPU percentages
+    SLOT = struct.Struct("<IBBBB4B")
+
+    # A week of one-minute records, about 120 KB
+    DEFAULT_CAPACITY = 7 * 24 * 60
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY, writable=False):
+        self.writable = writable
+        if writable:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        else:
+            fd = os.open(path, os.O_RDONLY)
+        try:
+            with os.fdopen(fd, "r+b" if writable else "rb", closefd=False) as f:
+                self._open(f, capacity)
+        finally:
+            os.close(fd)
+
+    def _open(self, f, capacity):
+        size = self.HEADER.size + (capacity + 1) * self.SLOT.size
+        existing = os.fstat(f.fileno()).st_size
+        if existing >= self.HEADER.size:
+            magic, existing_capacity, slot_size, _ = self.HEADER.unpack(
+                f.read(self.HEADER.size)
+            )
+            valid = magic == self.MAGIC and slot_size == self.SLOT.size
+            if valid and not self.writable:
+                capacity = existing_capacity
+                size = self.HEADER.size + (capacity + 1) * self.SLOT.size
+            elif not valid or existing_capacity != capacity:
+                existing = 0
+        if existing == 0 or existing < size:
+            if not self.writable:
+                raise ValueError("Not a resource usage history file")
+            # Start over rather than reinterpret slots laid out for another capacity
+            f.seek(0)
+            f.truncate(size)
+            f.write(self.HEADER.pack(self.MAGIC, capacity, self.SLOT.size, 0))
+            f.flush()
+        self.capacity = capacity
+        self.slots = capacity + 1
+        self.map = mmap.mmap(
+            f.fileno(),
+            size,
+            access=mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ,
+        )
+
+    def close(self):
+        self.map.close()
+
+    def _count(self):
+        return self.HEADER.unpack_from(self.map, 0)[3]
+
+    def append(self, record):
+        count = self._count()
+        gpus = (record.get("gpuPctUsed") or [])[: self.MAX_GPUS]
+        self.SLOT.pack_into(
+            self.map,
+            self.HEADER.size + (count % self.slots) * self.SLOT.size,
+            record["epoch"],
+            record["cpuPctUsed"],
+            record["memPctUsed"],
+            record["rootfsPctUsed"],
+            len(gpus),
+            *(gpus + [0] * (self.MAX_GPUS - len(gpus))),
+        )
+        # Only count the slot once it is fully written, so readers never see a partial record
+        self.HEADER.pack_into(
+            self.map, 0, self.MAGIC, self.capacity, self.SLOT.size, count + 1
+        )
+
+    def query(self, since=None, until=None):
+        # Returns records with since <= epoch <= until, oldest first
+        count = self._count()
+        first = max(0, count - self.capacity)
+        records = []
+        for i in range(first, count):
+            epoch, cpu_pct, mem_pct, rootfs_pct, gpu_count, *gpus = (
+                self.SLOT.unpack_from(
+                    self.map, self.HEADER.size + (i % self.slots) * self.SLOT.size
+                )
+            )
+            if (since is not None and epoch < since) or (
+                until is not None and epoch > until
+            ):
+                continue
+            records.append(
+                {
+                    "epoch": epoch,
+                    "cpuPctUsed": cpu_pct,
+                    "memPctUsed": mem_pct,
+                    "rootfsPctUsed": rootfs_pct,
+                    "gpuPctUsed": gpus[:gpu_count] if gpu_count else None,
+                }
+            )
+        return records
+
+
+def write_line(output, line):
+    # One write() per line, so /dev/kmsg sees each line as a single log message
+    output.write((line + "\n").encode())
+    output.flush()
+
+
+class RecordWriter:
+    # Writes each record as its own JSON line, or batches them into compact lines
+
+    def __init__(self, output, compact=False, batch_size=1, history=None):
+        self.output = output
+        self.compact = compact
+        self.batch_size = batch_size
+        self.history = history
+        self.pending = []
+
+    def write(self, record):
+        if self.history is not None:
+            self.history.append(record)
+        if not self.compact:
+            write_line(self.output, json.dumps(record))
+            return
+        self.pending.append(record)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            batch = encode_compact(self.pending)
+            write_line(self.output, json.dumps(batch, separators=(",", ":")))
+            self.pending = []
+
+
+def run_forever(
+    writer, collector, gpus, interval, sample_interval, extended=None, self_stats=None
+):
+    # Ticks are scheduled on the monotonic clock so records don't drift by the time each
+    # sample takes. If a sample overruns the interval, skip ahead instead of bursting.
+    samples_per_record = max(1, round(interval / sample_interval))
+    samples = []
+    next_tick = time.monotonic()
+    while True:
+        started = time.perf_counter()
+        samples.append(sample(collector, gpus))
+        if len(samples) >= samples_per_record:
+            record = samples[0] if samples_per_record == 1 else summary_record(samples)
+            if extended is not None:
+                record["ext"] = extended.collect()
+            if self_stats is not None:
+                record["self"] = self_stats.collect(time.perf_counter() - started)
+            writer.write(record)
+            samples = []
+        elif self_stats is not None:
+            self_stats.add_collect_time(time.perf_counter() - started)
+        next_tick += sample_interval
+        delay = next_tick - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_tick = time.monotonic()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Log system resource usage as JSON")
+    parser.add_argument(
+        "--interval",
+        type=float,
+        help="keep running and write a record every INTERVAL seconds",
+    )
+    parser.add_argument(
+        "--sample-interval",
+        type=float,
+        help="with --interval, sample every SAMPLE_INTERVAL seconds and write one summary "
+        "record per interval (defaults to the interval, i.e. no summarizing)",
+    )
+    parser.add_argument(
+        "--output",
+        help="file or device to append records to (defaults to stdout)",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["auto", "proc", "subprocess"],
+        default="auto",
+        help="read /proc directly, or scrape top/free/df (default: proc when readable)",
+    )
+    parser.add_argument(
+        "--gpu",
+        choices=["auto", "nvml", "nvidia-smi-loop", "nvidia-smi", "none"],
+        default="auto",
+        help="how to read GPU usage (default: NVML, falling back to nvidia-smi)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["json", "compact"],
+        default="json",
+        help="write one JSON record per line, or compact version 2 batches",
+    )
+    parser.add_argument(
+        "--batch",
+        type=int,
+        default=1,
+        help="with --format compact, number of records per line",
+    )
+    parser.add_argument(
+        "--extended",
+        action="store_true",
+        help="add per-core, per-mount, swap, load average and I/O metrics to full-format records",
+    )
+    parser.add_argument(
+        "--self-stats",
+        action="store_true",
+        help="add this agent's own collection time, CPU time and memory to full-format records",
+    )
+    parser.add_argument(
+        "--decode",
+        action="store_true",
+        help="read a console log on stdin and write its records, expanded, one per line",
+    )
+    parser.add_argument(
+        "--history-file",
+        help="also keep records in this ring buffer file, or read them back with --query",
+    )
+    parser.add_argument(
+        "--history-size",
+        type=int,
+        default=HistoryRing.DEFAULT_CAPACITY,
+        help="number of records the history file holds (default: a week of one-minute records)",
+    )
+    parser.add_argument(
+        "--query",
+        action="store_true",
+        help="write the records in the history file between --since and --until as a JSON list",
+    )
+    parser.add_argument(
+        "--since", type=int, help="epoch, or negative seconds before now"
+    )
+    parser.add_argument(
+        "--until", type=int, help="epoch, or negative seconds before now"
+    )
+    args = parser.parse_args()
+
+    if args.query:
+        if not args.history_file:
+            parser.error("--query requires --history-file")
+        now = round(time.time())
+        since = (
+            now + args.since
+            if args.since is not None and args.since < 0
+            else args.since
+        )
+        until = (
+            now + args.until
+            if args.until is not None and args.until < 0
+            else args.until
+        )
+        try:
+            history = HistoryRing(args.history_file)
+        except (OSError, ValueError) as e:
+            sys.exit(f"Cannot read {args.history_file}: {e}")
+        try:
+            print(json.dumps(history.query(since, until)))
+        finally:
+            history.close()
+        return
+
+    if args.decode:
+        for line in sys.stdin:
+            for record in decode_line(line):
+                print(json.dumps(record))
+        return
+
+    if args.interval is not None and args.interval <= 0:
+        parser.error("--interval must be greater than zero")
+    if args.sample_interval is not None:
+        if args.interval is None:
+            parser.error("--sample-interval requires --interval")
+        if not 0 < args.sample_interval <= args.interval:
+            parser.error("--sample-interval must be between zero and --interval")
+    if args.batch < 1:
+        parser.error("--batch must be at least 1")
+    if args.batch > 1 and args.format != "compact":
+        parser.error("--batch requires --format compact")
+    if args.format == "compact" and (args.extended or args.self_stats):
+        parser.error("--extended and --self-stats require --format json")
+    if args.history_size < 1:
+        parser.error("--history-size must be at least 1")
+
+    collector = make_collector(args.backend)
+    extended = ExtendedCollector() if args.extended else None
+    self_stats = SelfStats() if args.self_stats else None
+    gpus = make_gpu_collector(args.gpu, args.sample_interval or args.interval)
+
+    # The output stays open between ticks; only the records are written each interval
+    output = open(args.output, "ab", buffering=0) if args.output else sys.stdout.buffer
+    history = (
+        HistoryRing(args.history_file, args.history_size, writable=True)
+        if args.history_file
+        else None
+    )
+    writer = RecordWriter(
+        output,
+        compact=args.format == "compact",
+        batch_size=args.batch,
+        history=history,
+    )
+
+    # Exit through the finally block below when systemd stops us, so a partial batch is written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        if args.interval is None:
+            started = time.perf_counter()
+            record = sample(collector, gpus)
+            if extended is not None:
+                record["ext"] = extended.collect()
+            if self_stats is not None:
+                record["self"] = self_stats.collect(time.perf_counter() - started)
+            writer.write(record)
+        else:
+            run_forever(
+                writer,
+                collector,
+                gpus,
+                args.interval,
+                args.sample_interval or args.interval,
+                extended,
+                self_stats,
+            )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.flush()
+        gpus.close()
+        if history is not None:
+            history.close()
+        if output is not sys.stdout.buffer:
+            output.close()
 
 
-json_dict = {
-    "epoch": round(time.time()),
-    "cpuPctUsed": cpu(),
-    "memPctUsed": mem(),
-    "rootfsPctUsed": disk(),
-    "gpuPctUsed": gpu(),
-}
-output_line = json.dumps(json_dict) + "\n"
-sys.stdout.buffer.write(output_line.encode())
+if __name__ == "__main__":
+    main()
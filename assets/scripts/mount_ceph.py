@@ -2,12 +2,28 @@
 
 import textwrap
 import argparse
+import contextlib
+import itertools
+import json
 import logging
+import os
 import pathlib
+import shutil
+import socket
 import subprocess
 import sys
+import time
 import typing as t
 
+# The systemd client that Exosphere's auto-mount-volumes role installs. When this script is run
+# elsewhere, unit names are escaped with systemd-escape, and systemd is driven with systemctl (as
+# it is without PyGObject).
+sys.path.append("/usr/lib/exosphere")
+try:
+    import exosphere_systemd
+except ImportError:
+    exosphere_systemd = None
+
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 logger = logging.getLogger(sys.argv[0])
 
@@ -17,8 +33,70 @@ logger = logging.getLogger(sys.argv[0])
 
 SYSTEMD_PATH = pathlib.Path("/etc/systemd/system/")
 MOUNT_PATH = pathlib.Path("/media/share/")
+JOURNAL_SOCKET = "/run/systemd/journal/socket"
+
+# How long to spend looking for the processes that keep a share busy
+OPEN_FILES_TIMEOUT_SECONDS = 5.0
+
+# Set by --check-escape, to compare exosphere_systemd.escape_path() with systemd-escape
+CHECK_ESCAPE = False
+
+# The systemd client, from systemd(); an exosphere_systemd.SystemdDBus if it can connect, else
+# Systemctl
+SYSTEMD = None
 
 DEFAULT_MOUNT_OPTIONS = ["noatime", "rw", "_netdev", "auto", "nofail"]
+
+# Kernel CephFS client tunables for each performance profile, added to the defaults; see
+# mount.ceph(8) and https://docs.kernel.org/filesystems/ceph.html
+MOUNT_PROFILES = {
+    "default": [],
+    # Large sequential reads and writes: the largest requests, and 64 MiB of readahead
+    "streaming": ["rsize=67108864", "wsize=67108864", "rasize=67108864"],
+    # Many small files: little readahead, so reading one file doesn't fetch far past its end
+    "small-files": ["rsize=4194304", "wsize=4194304", "rasize=1048576"],
+    # Big directories and many creates and deletes: larger readdir replies, listings from the
+    # dentry cache, and asynchronous directory operations (nowsync needs Linux 5.7 or later)
+    "metadata-heavy": [
+        "readdir_max_entries=8192",
+        "readdir_max_bytes=4194304",
+        "dcache",
+        "nowsync",
+    ],
+}
+
+
+def _integer_option(
+    low: int, high: t.Optional[int] = None, multiple: int = 1
+) -> t.Callable[[str], bool]:
+    def check(value: str) -> bool:
+        return (
+            value.isdigit()
+            and low <= int(value)
+            and (high is None or int(value) <= high)
+            and int(value) % multiple == 0
+        )
+
+    return check
+
+
+# Options a share may set, beyond its profile's: the values each takes, and a check for them
+MOUNT_OPTION_VALUES = {
+    "rsize": ("a multiple of 4096 up to 64 MiB", _integer_option(4096, 64 << 20, 4096)),
+    "wsize": ("a multiple of 4096 up to 64 MiB", _integer_option(4096, 64 << 20, 4096)),
+    "rasize": ("a multiple of 4096", _integer_option(0, multiple=4096)),
+    "readdir_max_entries": ("a positive integer", _integer_option(1)),
+    "readdir_max_bytes": ("a positive integer", _integer_option(1)),
+    "caps_max": ("a number of capabilities, or 0 for no limit", _integer_option(0)),
+    "recover_session": ("no or clean", lambda value: value in ("no", "clean")),
+    "ms_mode": (
+        "legacy, crc, secure, prefer-crc or prefer-secure",
+        lambda value: value
+        in ("legacy", "crc", "secure", "prefer-crc", "prefer-secure"),
+    ),
+}
+# Flags a share may set, each of which can be turned off with a "no" prefix
+MOUNT_FLAGS = {"fsc", "dcache", "wsync", "asyncreaddir", "rbytes"}
 MOUNT_TEMPLATE = """
 [Unit]
 Description=Share {share_name}
@@ -55,98 +133,365 @@ ExecStart=/usr/bin/env chown exouser:exouser "/media/share/{share_name}"
 #
 
 
+def journal_send(message: str, **fields) -> bool:
+    """
+    Sends a message with structured fields to the systemd journal, using its native protocol
+
+    Returns False if the journal isn't available
+    """
+
+    entry = {"MESSAGE": message, "SYSLOG_IDENTIFIER": "mount_ceph", **fields}
+    datagram = "".join(
+        f"{key}={str(value).replace(chr(10), ' ')}\n" for key, value in entry.items()
+    )
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as journal:
+            journal.sendto(datagram.encode("utf-8"), JOURNAL_SOCKET)
+    except OSError:
+        return False
+    return True
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """
+    Times a phase of mounting or unmounting, and records it in the journal
+
+    Each span is a JSON message, with the same data in EXO_* fields, e.g.
+        journalctl -o json SYSLOG_IDENTIFIER=mount_ceph EXO_SPAN=systemd
+    """
+
+    start = time.monotonic()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        record = {
+            "span": name,
+            "duration_ms": round((time.monotonic() - start) * 1000, 1),
+            "outcome": outcome,
+            **attributes,
+        }
+        message = json.dumps(record)
+        fields = {f"EXO_{key.upper()}": value for key, value in record.items()}
+        if not journal_send(message, **fields):
+            logger.debug(message)
+
+
+def systemd_escape_paths(vals: t.List[str]) -> t.List[str]:
+    """
+    Escapes path names as systemd unit names
+
+    With --check-escape, or without exosphere_systemd, systemd-escape is run (once, for all of
+    the paths) and its result is used; with --check-escape, any difference is logged
+    """
+
+    if not vals:
+        return []
+    if exosphere_systemd is not None:
+        escaped = [exosphere_systemd.escape_path(val) for val in vals]
+        if not CHECK_ESCAPE:
+            return escaped
+
+    # Escaped names never contain spaces, so the space-separated output splits cleanly
+    expected = subprocess.check_output(
+        ["systemd-escape", "--path", *vals],
+        text=True,
+    ).split()
+    if exosphere_systemd is None:
+        return expected
+    for val, ours, theirs in zip(vals, escaped, expected):
+        if ours != theirs:
+            logger.warning(
+                "Escaped %r as %r, but systemd-escape gives %r", val, ours, theirs
+            )
+    return expected
+
+
 def systemd_escape_path(val: str) -> str:
     r"""
-    Uses systemd-escape to escape path names as systemd mount file names
+    Escapes a path name as a systemd mount file name
 
     Example:
         systemd_escape_path("/media/share/test-share") == "media-share-test\x2dshare"
     """
 
-    return subprocess.check_output(
-        [
-            "systemd-escape",
-            "--path",
-            val,
-        ],
-        text=True,
-    ).strip()
+    return systemd_escape_paths([val])[0]
 
 
-class OpenFile(t.NamedTuple):
-    """Represents an open file as determined by lsof"""
+def option_name(option: str) -> str:
+    """The name of a mount option, which later options with the same name replace"""
 
-    pid: int
-    command: str
-    fd: t.Optional[str]
-    name: t.Optional[str]
+    name = option.split("=", maxsplit=1)[0]
+    if name.startswith("no") and name[2:] in MOUNT_FLAGS:
+        return name[2:]
+    return name
 
 
-def split_iterable(
-    predicate: t.Callable[[t.T], bool],
-    iterable: t.Iterable[t.T],
-    *,
-    before_predicate: bool = True,
-) -> t.Iterable[t.List[t.T]]:
+def validate_mount_option(option: str):
+    name, has_value, value = option.partition("=")
+    if option_name(option) in MOUNT_FLAGS and not has_value:
+        return
+    if name not in MOUNT_OPTION_VALUES:
+        allowed = sorted(MOUNT_OPTION_VALUES) + sorted(MOUNT_FLAGS)
+        raise ValueError(
+            f"{name!r} can't be set for a share, only {', '.join(allowed)}"
+        )
+
+    description, check = MOUNT_OPTION_VALUES[name]
+    if not check(value):
+        raise ValueError(f"{name} must be {description}, not {value!r}")
+
+
+def mount_options(
+    profile: str = "default",
+    overrides: t.Iterable[str] = (),
+    access_rule_name: t.Optional[str] = None,
+    access_rule_key: t.Optional[str] = None,
+) -> t.List[str]:
     """
-    Split an iterable into chunks, separating on a predicate
+    Returns the options to mount a share with: the defaults, then its profile's, then overrides
 
-    Empty chunks (e.g, where the first element matches the predicate) are not yielded
+    Raises ValueError for an unknown profile or option, or a value the kernel client won't take
     """
 
-    chunk = []
-    for element in iterable:
-        if predicate(element):
-            if not before_predicate:
-                chunk.append(element)
+    if profile not in MOUNT_PROFILES:
+        raise ValueError(
+            f"Unknown profile {profile!r}, expected one of {', '.join(MOUNT_PROFILES)}"
+        )
+    overrides = list(overrides)
+    for option in overrides:
+        validate_mount_option(option)
+
+    # Later options replace earlier ones with the same name, in the earlier one's place
+    options = {}
+    for option in DEFAULT_MOUNT_OPTIONS + MOUNT_PROFILES[profile] + overrides:
+        options[option_name(option)] = option
+
+    if options.get("fsc") == "fsc" and shutil.which("cachefilesd") is None:
+        raise ValueError("fsc needs cachefilesd, which isn't installed")
 
-            if chunk:
-                yield chunk
-                chunk.clear()
+    share_options = list(options.values())
+    if access_rule_name:
+        share_options.append(f"name={access_rule_name}")
+
+    if access_rule_key:
+        share_options.append(f"secret={access_rule_key}")
+
+    return share_options
+
+
+class ShareUnits(t.NamedTuple):
+    """The unit files that mount a share, and keep its permissions set"""
+
+    share_name: str
+    mount_point: pathlib.Path
+    mount: pathlib.Path
+    service: pathlib.Path
+
+    @classmethod
+    def from_escaped_name(cls, share_name: str, escaped_name: str) -> "ShareUnits":
+        return cls(
+            share_name=share_name,
+            mount_point=MOUNT_PATH / share_name,
+            mount=(SYSTEMD_PATH / escaped_name).with_suffix(".mount"),
+            service=(SYSTEMD_PATH / escaped_name).with_suffix(".service"),
+        )
 
-            if before_predicate:
-                chunk.append(element)
+    @property
+    def names(self) -> t.Tuple[str, str]:
+        return (self.mount.name, self.service.name)
 
+    def exist(self) -> bool:
+        return self.mount.exists() or self.service.exists()
+
+    def write(self, share_path: str, options: t.List[str]):
+        systemd_mount = MOUNT_TEMPLATE.format(
+            share_path=share_path,
+            share_name=self.share_name,
+            service_name=self.service.name,
+            options=",".join(options),
+        )
+        systemd_service = SERVICE_TEMPLATE.format(
+            share_name=self.share_name,
+            mount_name=self.mount.name,
+        )
+
+        logger.info("Creating %s", self.mount, extra={"content": systemd_mount})
+        self.mount.write_text(systemd_mount)
+
+        logger.info("Creating %s", self.service, extra={"content": systemd_service})
+        self.service.write_text(systemd_service)
+
+    def remove(self):
+        logger.debug("Deleting %s and %s", *self.names)
+        self.mount.unlink(missing_ok=True)
+        self.service.unlink(missing_ok=True)
+
+
+class Systemctl:
+    """Starts and stops units by running systemctl, for systems without PyGObject"""
+
+    def run(self, *args: str) -> subprocess.CompletedProcess:
+        return subprocess.run(("systemctl", *args), check=False, capture_output=True)
+
+    def reload(self):
+        self.run("daemon-reload")
+
+    def start(
+        self, units: t.List[str], *, enable: bool = False, reload: bool = False
+    ) -> t.Dict[str, str]:
+        if enable:
+            # Enabling reloads unless it's told not to
+            command = ("enable", "--now") + (() if reload else ("--no-reload",))
         else:
-            chunk.append(element)
+            if reload:
+                self.reload()
+            command = ("start",)
+        return self._results(self.run(*command, *units), units, ("active",))
+
+    def stop(self, units: t.List[str], *, disable: bool = False) -> t.Dict[str, str]:
+        command = ("disable", "--now", "--no-reload") if disable else ("stop",)
+        return self._results(self.run(*command, *units), units, ("inactive", "failed"))
+
+    def _results(
+        self,
+        process: subprocess.CompletedProcess,
+        units: t.List[str],
+        expected_states: t.Tuple[str, ...],
+    ) -> t.Dict[str, str]:
+        if process.returncode == 0:
+            return {unit: "done" for unit in units}
+
+        logger.debug(
+            "systemctl failed:\n%s", (process.stderr or process.stdout).decode()
+        )
+        states = self.states(units)
+        results = {}
+        for unit in units:
+            if states[unit].get("ActiveState") in expected_states:
+                results[unit] = "done"
+            else:
+                # Result is "success" when a unit is running but failed to stop
+                result = states[unit].get("Result", "success")
+                results[unit] = "failed" if result == "success" else result
+        return results
+
+    def states(self, units: t.List[str]) -> t.Dict[str, t.Dict[str, str]]:
+        """Reads the state of several units with one `systemctl show`"""
+
+        show = self.run("show", "--property=ActiveState,Result", *units)
+        # Units are separated by a blank line, in the order they were asked for
+        blocks = show.stdout.decode().split("\n\n")
+        return {
+            unit: dict(
+                line.split("=", maxsplit=1)
+                for line in block.splitlines()
+                if "=" in line
+            )
+            for unit, block in itertools.zip_longest(
+                units, blocks[: len(units)], fillvalue=""
+            )
+        }
+
+
+def systemd() -> t.Union["exosphere_systemd.SystemdDBus", Systemctl]:
+    """Returns the systemd client, connecting over D-Bus if possible"""
+
+    global SYSTEMD
+    if SYSTEMD is None:
+        if exosphere_systemd is not None:
+            SYSTEMD = exosphere_systemd.SystemdDBus.connect()
+        SYSTEMD = SYSTEMD or Systemctl()
+    return SYSTEMD
 
-    if chunk:
-        yield chunk
 
+def describe_failures(results: t.Dict[str, str]) -> str:
+    return "\n".join(
+        f"  {unit}: {result}" for unit, result in results.items() if result != "done"
+    )
+
+
+class OpenFile(t.NamedTuple):
+    """
+    Represents a file held open by a process
 
-def iter_open_files(path: pathlib.Path) -> t.Iterable[OpenFile]:
+    fd is a descriptor number, or as lsof names them, "cwd" (working directory), "rtd" (root
+    directory), "txt" (executable) or "mem" (memory-mapped file)
     """
-    Parses the output of `lsof -F pfcn` to find any open files within a path
 
-    `-F` is "Output for processing by other programs"
-    `pfcn` selects the pid, command, fd, and filename for output
+    pid: int
+    command: str
+    fd: t.Optional[str]
+    name: t.Optional[str]
+
+
+def _within(name: str, path: str) -> bool:
+    return name == path or name.startswith(path + "/")
 
-    lsof outputs the following for each open file
-        p[pid]
-        c[command]
-        f[fd]
-        n[file_path]
 
-    Note: f/n may not be included in some cases
+def iter_process_files(pid: str) -> t.Iterable[t.Tuple[str, str]]:
     """
+    Lists the files a process holds, as (fd, name) pairs, from /proc/[pid]
 
-    lsof = subprocess.run(
-        ("lsof", "-F", "pcfn", str(path)),
-        capture_output=True,
-        check=False,
-    )
+    Links are only read, never followed, so nothing on a network filesystem is stat-ed
+    """
 
-    output_lines = lsof.stdout.decode().splitlines()
+    for fd, link in (("cwd", "cwd"), ("rtd", "root"), ("txt", "exe")):
+        with contextlib.suppress(OSError):
+            yield fd, os.readlink(f"/proc/{pid}/{link}")
+
+    with contextlib.suppress(OSError):
+        for fd in sorted(os.listdir(f"/proc/{pid}/fd"), key=int):
+            with contextlib.suppress(OSError):
+                yield fd, os.readlink(f"/proc/{pid}/fd/{fd}")
+
+    mapped = set()
+    with contextlib.suppress(OSError):
+        with open(f"/proc/{pid}/maps", "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                # address perms offset dev inode [pathname], where the pathname may have spaces
+                fields = line.rstrip("\n").split(maxsplit=5)
+                if len(fields) == 6 and fields[5] not in mapped:
+                    mapped.add(fields[5])
+                    yield "mem", fields[5]
+
+
+def iter_open_files(
+    path: pathlib.Path, timeout: float = OPEN_FILES_TIMEOUT_SECONDS
+) -> t.Iterable[OpenFile]:
+    """
+    Finds the files within a path that processes hold open, by reading /proc
 
-    for open_file_lines in split_iterable(lambda x: x.startswith("p"), output_lines):
-        open_file_data = {l[0]: l[1:] for l in open_file_lines}
+    This finds open files, working directories, executables and memory-mapped files, any of
+    which keep a mount busy. Processes that exit, or that we may not inspect, are skipped. If
+    scanning takes longer than the timeout, what was found so far is returned.
+    """
 
-        yield OpenFile(
-            pid=int(open_file_data.get("p", "-1")),
-            command=open_file_data.get("c", "[unknown]"),
-            fd=open_file_data.get("f", None),
-            name=open_file_data.get("n", None),
-        )
+    deadline = time.monotonic() + timeout
+    path = str(path).rstrip("/")
+
+    for pid in sorted((p for p in os.listdir("/proc") if p.isdigit()), key=int):
+        if time.monotonic() > deadline:
+            logger.warning("Stopped looking for open files after %gs", timeout)
+            return
+
+        command = None
+        for fd, name in iter_process_files(pid):
+            if not _within(name, path):
+                continue
+
+            if command is None:
+                try:
+                    with open(f"/proc/{pid}/comm", "r", encoding="utf-8") as f:
+                        command = f.read().strip()
+                except OSError:
+                    command = "[unknown]"
+
+            yield OpenFile(pid=int(pid), command=command, fd=fd, name=name)
 
 
 #
@@ -159,127 +504,274 @@ def do_mount(
     share_path: str,
     access_rule_name: t.Optional[str] = None,
     access_rule_key: t.Optional[str] = None,
+    profile: str = "default",
+    options: t.Optional[t.List[str]] = None,
 ):
-    mount_point = MOUNT_PATH / share_name
-    mount_options = list(DEFAULT_MOUNT_OPTIONS)
-    escaped_name = systemd_escape_path(str(mount_point))
-
-    if access_rule_name:
-        mount_options.append(f"name={access_rule_name}")
+    try:
+        share_options = mount_options(
+            profile, options or [], access_rule_name, access_rule_key
+        )
+    except ValueError as e:
+        logger.error("Invalid mount options: %s", e)
+        sys.exit(1)
 
-    if access_rule_key:
-        mount_options.append(f"secret={access_rule_key}")
+    with span("mount", share=share_name, profile=profile):
+        _do_mount(share_name, share_path, share_options)
 
-    systemd_mount_path = (SYSTEMD_PATH / escaped_name).with_suffix(".mount")
-    systemd_service_path = (SYSTEMD_PATH / escaped_name).with_suffix(".service")
 
-    systemd_mount = MOUNT_TEMPLATE.format(
-        share_path=share_path,
-        share_name=share_name,
-        access_rule_name=access_rule_name,
-        service_name=systemd_service_path.name,
-        options=",".join(mount_options),
-    )
-    systemd_service = SERVICE_TEMPLATE.format(
-        share_name=share_name,
-        mount_name=systemd_mount_path.name,
-    )
+def _do_mount(share_name: str, share_path: str, share_options: t.List[str]):
+    with span("escape", share=share_name):
+        escaped_name = systemd_escape_path(str(MOUNT_PATH / share_name))
 
-    logger.info("Creating %s", systemd_mount_path, extra={"content": systemd_mount})
-    systemd_mount_path.write_text(systemd_mount)
+    units = ShareUnits.from_escaped_name(share_name, escaped_name)
 
-    logger.info("Creating %s", systemd_service_path, extra={"content": systemd_service})
-    systemd_service_path.write_text(systemd_service)
+    with span("write_units", share=share_name):
+        units.write(share_path, share_options)
 
     # Enable and start
-    try:
-        subprocess.run(
-            (
-                "systemctl",
-                "enable",
-                "--now",
-                systemd_mount_path.name,
-                systemd_service_path.name,
-            ),
-            check=True,
-            capture_output=True,
-        )
+    with span("systemd", share=share_name, action="start"):
+        results = systemd().start(list(units.names), enable=True, reload=True)
 
-    except subprocess.CalledProcessError as e:
-        logger.error(
-            "Failed to start mount scripts:\n%s",
-            textwrap.indent((e.stderr or e.stdout).decode(), "  "),
-        )
+    if any(result != "done" for result in results.values()):
+        logger.error("Failed to start mount scripts:\n%s", describe_failures(results))
 
     else:
-        print(f"Successfully mounted at {mount_point}")
+        print(f"Successfully mounted at {units.mount_point}")
 
 
 def do_unmount(share_name: str):
+    with span("unmount", share=share_name):
+        _do_unmount(share_name)
+
+
+def _do_unmount(share_name: str):
     mount_point = MOUNT_PATH / share_name
-    escaped_name = systemd_escape_path(str(mount_point))
+    with span("escape", share=share_name):
+        escaped_name = systemd_escape_path(str(mount_point))
 
-    systemd_mount_path = (SYSTEMD_PATH / escaped_name).with_suffix(".mount")
-    systemd_service_path = (SYSTEMD_PATH / escaped_name).with_suffix(".service")
+    units = ShareUnits.from_escaped_name(share_name, escaped_name)
 
-    if systemd_mount_path.exists() or systemd_service_path.exists():
-        try:
-            logger.debug(
-                "Disabling services %s and %s",
-                systemd_mount_path.name,
-                systemd_service_path.name,
-            )
-            subprocess.run(
-                (
-                    "systemctl",
-                    "disable",
-                    "--now",
-                    systemd_mount_path.name,
-                    systemd_service_path.name,
-                ),
-                check=True,
-                capture_output=True,
-            )
+    if units.exist():
+        logger.debug("Disabling services %s and %s", *units.names)
+        with span("systemd", share=share_name, action="stop"):
+            results = systemd().stop(list(units.names), disable=True)
 
-        except subprocess.CalledProcessError as e:
-            open_files = list(iter_open_files(mount_point))
-            max_file_name_length = max(len(f.name) for f in open_files)
+        if any(result != "done" for result in results.values()):
+            with span("open_files", share=share_name):
+                open_files = list(iter_open_files(mount_point))
+            max_file_name_length = max((len(f.name) for f in open_files), default=0)
 
             logger.error(
                 "Failed to stop mount:\n%s\n\nOpen files:\n%s",
-                textwrap.indent((e.stderr or e.stdout).decode(), "  "),
+                describe_failures(results),
                 textwrap.indent(
                     "\n".join(
-                        f"{f.name.ljust(max_file_name_length)}  (Open in {f.pid}: {f.command})"
-                        for f in iter_open_files(mount_point)
-                    ),
+                        f"{f.name.ljust(max_file_name_length)}  (Open in {f.pid}: {f.command}, {f.fd})"
+                        for f in open_files
+                    )
+                    or "(none found)",
                     "  ",
                 ),
             )
 
             sys.exit(1)
 
-        else:
-            logger.debug(
-                "Deleting %s and %s",
-                systemd_mount_path.name,
-                systemd_service_path.name,
+        units.remove()
+
+        with span("systemd", share=share_name, action="reload"):
+            systemd().reload()
+
+
+class BatchShare(t.NamedTuple):
+    """One share to mount or unmount in a batch"""
+
+    action: str
+    share_name: str
+    share_path: t.Optional[str] = None
+    access_rule_name: t.Optional[str] = None
+    access_rule_key: t.Optional[str] = None
+    profile: str = "default"
+    options: t.Optional[t.List[str]] = None
+
+    def mount_options(self) -> t.List[str]:
+        return mount_options(
+            self.profile,
+            self.options or [],
+            self.access_rule_name,
+            self.access_rule_key,
+        )
+
+
+def parse_batch_share(entry: t.Any) -> BatchShare:
+    """
+    Validates a share from a batch, raising ValueError if it can't be mounted or unmounted
+    """
+
+    if not isinstance(entry, dict):
+        raise ValueError("expected an object")
+
+    unknown = set(entry) - set(BatchShare._fields)
+    if unknown:
+        raise ValueError(f"unknown keys {', '.join(sorted(unknown))}")
+
+    share = BatchShare(**{"action": "mount", **entry})
+    if not all(value is None or isinstance(value, str) for value in share[:-1]):
+        raise ValueError("values must be strings")
+    if share.options is not None and not (
+        isinstance(share.options, list)
+        and all(isinstance(option, str) for option in share.options)
+    ):
+        raise ValueError("options must be a list of strings")
+    if share.action not in ("mount", "unmount"):
+        raise ValueError(f"unknown action {share.action!r}")
+    if not isinstance(share.share_name, str) or share.share_name in ("", ".", ".."):
+        raise ValueError("share_name is required")
+    if "/" in share.share_name:
+        raise ValueError("share_name may not contain '/'")
+    if share.action == "mount":
+        if not share.share_path:
+            raise ValueError("share_path is required to mount")
+        share.mount_options()
+    return share
+
+
+def do_batch(file: t.TextIO):
+    """
+    Mounts and unmounts several shares, with one daemon-reload and one systemd transaction
+
+    The shares are a JSON list read from a file, or stdin, e.g.
+        [
+            {"share_name": "results", "share_path": "10.0.0.5:6789:/volumes/...",
+             "access_rule_name": "exouser", "access_rule_key": "...",
+             "profile": "streaming", "options": ["ms_mode=secure"]},
+            {"action": "unmount", "share_name": "scratch"}
+        ]
+
+    A JSON summary of each share's result is printed, and the exit status is 1 if any failed
+    """
+
+    try:
+        entries = json.load(file)
+        if not isinstance(entries, list):
+            raise ValueError("expected a list of shares")
+    except ValueError as e:
+        logger.error("Couldn't read the shares to mount: %s", e)
+        sys.exit(1)
+
+    with span("batch", shares=len(entries)):
+        results = run_batch(entries)
+
+    failed = sum(not result["ok"] for result in results)
+    print(
+        json.dumps(
+            {"ok": len(results) - failed, "failed": failed, "shares": results},
+            indent=2,
+        )
+    )
+    if failed:
+        sys.exit(1)
+
+
+def run_batch(entries: t.List[t.Any]) -> t.List[t.Dict[str, t.Any]]:
+    results = [{"share_name": None, "action": None, "ok": False} for _ in entries]
+    shares: t.Dict[int, BatchShare] = {}
+    seen = set()
+    for i, entry in enumerate(entries):
+        try:
+            share = parse_batch_share(entry)
+            if share.share_name in seen:
+                raise ValueError("listed more than once")
+        except (TypeError, ValueError) as e:
+            if isinstance(entry, dict):
+                results[i]["share_name"] = entry.get("share_name")
+                results[i]["action"] = entry.get("action", "mount")
+            results[i]["error"] = f"Invalid share: {e}"
+            continue
+        seen.add(share.share_name)
+        shares[i] = share
+        results[i].update(share_name=share.share_name, action=share.action)
+
+    with span("escape", shares=len(shares)):
+        escaped_names = systemd_escape_paths(
+            [str(MOUNT_PATH / share.share_name) for share in shares.values()]
+        )
+    units = {
+        i: ShareUnits.from_escaped_name(share.share_name, escaped_name)
+        for (i, share), escaped_name in zip(shares.items(), escaped_names)
+    }
+    mounts = [i for i, share in shares.items() if share.action == "mount"]
+    unmounts = [i for i, share in shares.items() if share.action == "unmount"]
+    reload = False
+
+    for i in unmounts:
+        results[i]["mount_point"] = str(units[i].mount_point)
+    for i in [i for i in unmounts if not units[i].exist()]:
+        results[i]["ok"] = True
+        unmounts.remove(i)
+
+    if unmounts:
+        with span("systemd", shares=len(unmounts), action="stop"):
+            stopped = systemd().stop(
+                [name for i in unmounts for name in units[i].names], disable=True
             )
-            systemd_mount_path.unlink(missing_ok=True)
-            systemd_service_path.unlink(missing_ok=True)
 
-            subprocess.run(
-                (
-                    "systemctl",
-                    "daemon-reload",
-                ),
-                check=False,
-                capture_output=True,
+        for i in unmounts:
+            if stopped[units[i].mount.name] == "done":
+                units[i].remove()
+                results[i]["ok"] = True
+                reload = True
+                continue
+
+            with span("open_files", share=units[i].share_name):
+                open_files = list(iter_open_files(units[i].mount_point))
+            results[i][
+                "error"
+            ] = f"Couldn't stop {units[i].mount.name} ({stopped[units[i].mount.name]})"
+            results[i]["open_files"] = [
+                {"name": f.name, "pid": f.pid, "command": f.command, "fd": f.fd}
+                for f in open_files
+            ]
+
+    if mounts:
+        with span("write_units", shares=len(mounts)):
+            for i in mounts:
+                share = shares[i]
+                units[i].write(share.share_path, share.mount_options())
+        reload = True
+
+    if reload and not mounts:
+        with span("systemd", action="reload"):
+            systemd().reload()
+
+    if mounts:
+        # Enabling links the units into remote-fs.target.wants/, which systemd only loads when
+        # it reloads, so the one reload comes after enabling, as with `systemctl enable`
+        with span("systemd", shares=len(mounts), action="start"):
+            started = systemd().start(
+                [name for i in mounts for name in units[i].names],
+                enable=True,
+                reload=True,
             )
 
+        for i in mounts:
+            results[i]["mount_point"] = str(units[i].mount_point)
+            if started[units[i].mount.name] == "done":
+                results[i]["ok"] = True
+            else:
+                results[i][
+                    "error"
+                ] = f"Couldn't start {units[i].mount.name} ({started[units[i].mount.name]})"
+
+    return results
+
 
 parser = argparse.ArgumentParser()
 parser.set_defaults(action=parser.print_help)
+parser.add_argument(
+    "--check-escape",
+    action="store_true",
+    help="check unit names against systemd-escape, and use its result",
+)
 
 subparsers = parser.add_subparsers()
 mount_parser = subparsers.add_parser(
@@ -290,6 +782,19 @@ mount_parser.add_argument("--access-rule-name")
 mount_parser.add_argument("--access-rule-key")
 mount_parser.add_argument("--share-name", required=True)
 mount_parser.add_argument("--share-path", required=True)
+mount_parser.add_argument(
+    "--profile",
+    choices=list(MOUNT_PROFILES),
+    default="default",
+    help="performance profile of kernel client options (default: default)",
+)
+mount_parser.add_argument(
+    "--option",
+    action="append",
+    dest="options",
+    metavar="NAME[=VALUE]",
+    help=f"set a kernel client option, one of {', '.join(sorted(MOUNT_OPTION_VALUES) + sorted(MOUNT_FLAGS))}",
+)
 mount_parser.set_defaults(action=do_mount)
 
 unmount_parser = subparsers.add_parser(
@@ -299,7 +804,20 @@ unmount_parser = subparsers.add_parser(
 unmount_parser.add_argument("--share-name", required=True)
 unmount_parser.set_defaults(action=do_unmount)
 
+batch_parser = subparsers.add_parser(
+    "batch",
+    help="Mount and unmount several shares, listed as JSON, in one systemd transaction",
+)
+batch_parser.add_argument(
+    "--file",
+    type=argparse.FileType("r"),
+    default="-",
+    help="JSON list of shares (default: stdin)",
+)
+batch_parser.set_defaults(action=do_batch)
+
 if __name__ == "__main__":
     args = dict(parser.parse_args().__dict__)
     action = args.pop("action")
+    CHECK_ESCAPE = args.pop("check_escape")
     action(**args)
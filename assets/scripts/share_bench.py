@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Measures the throughput and metadata operation rate of a mounted share, to compare mount profiles
+
+Example, to compare mount_ceph.py's profiles by remounting a share with each:
+    curl https://.../assets/scripts/share_bench.py | python3 - /media/share/results
+"""
+
+import argparse
+import json
+import os
+import pathlib
+import re
+import shutil
+import sys
+import tempfile
+import time
+import typing as t
+
+MIB = 1024 * 1024
+SMALL_FILE_SIZE = 4096
+
+
+class Mount(t.NamedTuple):
+    source: str
+    mount_point: str
+    fs_type: str
+    options: t.List[str]
+
+
+def mount_of(path: pathlib.Path) -> t.Optional[Mount]:
+    """Finds the mount a path is on, from /proc/mounts"""
+
+    path = os.path.abspath(path)
+    found = None
+    with open("/proc/mounts", "r", encoding="utf-8") as f:
+        for line in f:
+            source, mount_point, fs_type, options, *_ = line.split()
+            # Spaces and other special characters are escaped in octal, e.g. \040
+            mount_point = re.sub(
+                r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), mount_point
+            )
+            within = path == mount_point or path.startswith(
+                mount_point.rstrip("/") + "/"
+            )
+            if within and (found is None or len(mount_point) >= len(found.mount_point)):
+                found = Mount(source, mount_point, fs_type, options.split(","))
+    return found
+
+
+def drop_cached_pages(fd: int):
+    """Drops a file's pages from the page cache, so reading it goes back to the server"""
+
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def sequential_write(path: pathlib.Path, size: int, block_size: int) -> float:
+    """
+    Writes a file of `size` bytes, rounded down to whole blocks, returning MiB/s including the
+    final fsync
+    """
+
+    block = os.urandom(block_size)
+    blocks = size // block_size
+    started = time.perf_counter()
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        for _ in range(blocks):
+            os.write(fd, block)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return blocks * block_size / MIB / (time.perf_counter() - started)
+
+
+def sequential_read(path: pathlib.Path, block_size: int) -> float:
+    """Reads a file without its cached pages, returning MiB/s"""
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        drop_cached_pages(fd)
+        size = 0
+        started = time.perf_counter()
+        while True:
+            block = os.read(fd, block_size)
+            if not block:
+                break
+            size += len(block)
+        return size / MIB / (time.perf_counter() - started)
+    finally:
+        os.close(fd)
+
+
+def metadata_rates(directory: pathlib.Path, files: int) -> t.Dict[str, float]:
+    """Creates, stats, lists and deletes small files, returning operations per second of each"""
+
+    content = os.urandom(SMALL_FILE_SIZE)
+    paths = [directory / f"file-{i:06d}" for i in range(files)]
+    rates = {}
+
+    def rate(operation: str, run: t.Callable[[], None], count: int = files):
+        started = time.perf_counter()
+        run()
+        rates[operation] = count / (time.perf_counter() - started)
+
+    def create():
+        for path in paths:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            os.write(fd, content)
+            os.close(fd)
+
+    def stat():
+        for path in paths:
+            os.stat(path)
+
+    def list_directory():
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                entry.stat()
+
+    def unlink():
+        for path in paths:
+            os.unlink(path)
+
+    rate("create", create)
+    rate("stat", stat)
+    rate("readdir", list_directory)
+    rate("unlink", unlink)
+    return rates
+
+
+def run(
+    path: pathlib.Path, size: int, block_size: int, files: int
+) -> t.Dict[str, t.Any]:
+    mount = mount_of(path)
+    # Secrets are in the options of a Ceph mount
+    options = [o for o in mount.options if not o.startswith("secret=")] if mount else []
+    directory = pathlib.Path(tempfile.mkdtemp(prefix=".share-bench-", dir=path))
+    try:
+        data = directory / "sequential"
+        write = sequential_write(data, size, block_size)
+        read = sequential_read(data, block_size)
+        data.unlink()
+
+        rates = metadata_rates(directory, files)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        "path": str(path),
+        "fsType": mount.fs_type if mount else None,
+        "options": options,
+        "sizeMiB": size // MIB,
+        "blockSizeKiB": block_size // 1024,
+        "files": files,
+        "writeMiBPerSec": round(write, 1),
+        "readMiBPerSec": round(read, 1),
+        "opsPerSec": {operation: round(r) for operation, r in rates.items()},
+    }
+
+
+def print_report(result: t.Dict[str, t.Any]):
+    print(f"{result['path']} ({result['fsType']}: {','.join(result['options'])})")
+    print(f"  sequential write  {result['writeMiBPerSec']:>10.1f} MiB/s")
+    print(f"  sequential read   {result['readMiBPerSec']:>10.1f} MiB/s")
+    for operation, rate in result["opsPerSec"].items():
+        print(f"  {operation:<17} {rate:>10} ops/s")
+
+
+def main(argv: t.Optional[t.List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("path", type=pathlib.Path, help="a directory on the share")
+    parser.add_argument(
+        "--size", type=int, default=256, help="MiB to write and read (default: 256)"
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=4096,
+        help="KiB per read and write (default: 4096)",
+    )
+    parser.add_argument(
+        "--files",
+        type=int,
+        default=2000,
+        help="small files to create, stat, list and delete (default: 2000)",
+    )
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    if not args.path.is_dir():
+        parser.error(f"{args.path} isn't a directory")
+    if args.block_size < 1:
+        parser.error("--block-size must be at least 1")
+    if args.size * 1024 < args.block_size:
+        parser.error("--size must be at least one block (--block-size)")
+    if args.files < 1:
+        parser.error("--files must be at least 1")
+
+    result = run(args.path, args.size * MIB, args.block_size * 1024, args.files)
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print_report(result)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
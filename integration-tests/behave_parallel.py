@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Runs behave scenarios sharded across worker processes, and merges their results
+
+Scenarios with the same @shard.<name> tag, e.g. launching an instance and then deleting it, run in file
+order on the same worker and so share its unique tag. Every other scenario goes to whichever worker has
+the fewest steps so far. Anything after `--` is passed to each behave worker.
+
+Example, with four workers against a local Exosphere:
+    python3 behave_parallel.py --workers 4 features/exosphere.feature -- \\
+        -D EXOSPHERE_BASE_URL=http://app.exosphere.localhost:8000
+"""
+
+import argparse
+import json
+import pathlib
+import random
+import shutil
+import string
+import subprocess
+import sys
+import time
+import typing as t
+import xml.etree.ElementTree as ET
+
+from behave.parser import parse_file
+
+SHARD_TAG_PREFIX = "shard."
+
+
+class Scenario(t.NamedTuple):
+    location: str
+    name: str
+    steps: int
+    shard: t.Optional[str]
+
+
+class Worker(t.NamedTuple):
+    index: int
+    scenarios: t.List[Scenario]
+    directory: pathlib.Path
+
+
+def generate_unique_string():
+    return "".join(
+        random.SystemRandom().choice(string.ascii_letters + string.digits)
+        for _ in range(10)
+    )
+
+
+def feature_files(paths: t.List[pathlib.Path]) -> t.List[pathlib.Path]:
+    files = []
+    for path in paths:
+        files.extend(sorted(path.rglob("*.feature")) if path.is_dir() else [path])
+    return files
+
+
+def collect_scenarios(paths: t.List[pathlib.Path]) -> t.List[Scenario]:
+    scenarios = []
+    for path in feature_files(paths):
+        feature = parse_file(str(path))
+        if feature is None:
+            continue
+        background_steps = len(feature.background.steps) if feature.background else 0
+        for scenario in feature.scenarios:
+            # A scenario outline runs once per example row
+            runs = len(getattr(scenario, "scenarios", None) or [scenario])
+            shards = [
+                tag[len(SHARD_TAG_PREFIX) :]
+                for tag in [*feature.tags, *scenario.tags]
+                if tag.startswith(SHARD_TAG_PREFIX)
+            ]
+            scenarios.append(
+                Scenario(
+                    location=f"{path}:{scenario.line}",
+                    name=scenario.name,
+                    steps=(background_steps + len(scenario.steps)) * runs,
+                    shard=shards[-1] if shards else None,
+                )
+            )
+    return scenarios
+
+
+def shard(scenarios: t.List[Scenario], workers: int) -> t.List[t.List[Scenario]]:
+    """Splits scenarios between workers, largest groups first onto the least loaded worker"""
+
+    groups: t.Dict[str, t.List[Scenario]] = {}
+    for scenario in scenarios:
+        groups.setdefault(scenario.shard or scenario.location, []).append(scenario)
+
+    shards: t.List[t.List[Scenario]] = [[] for _ in range(workers)]
+    load = [0] * workers
+    for group in sorted(
+        groups.values(), key=lambda g: sum(s.steps for s in g), reverse=True
+    ):
+        lightest = load.index(min(load))
+        shards[lightest].extend(group)
+        load[lightest] += sum(s.steps for s in group)
+
+    # Keep each worker's scenarios in the order they're written
+    order = {scenario.location: i for i, scenario in enumerate(scenarios)}
+    return [
+        sorted(scenarios_, key=lambda s: order[s.location])
+        for scenarios_ in shards
+        if scenarios_
+    ]
+
+
+def start_worker(
+    worker: Worker, unique_tag: str, reuse_browsers: bool, behave_args: t.List[str]
+) -> subprocess.Popen:
+    worker.directory.mkdir(parents=True, exist_ok=True)
+    command = [
+        sys.executable,
+        "-m",
+        "behave",
+        *[scenario.location for scenario in worker.scenarios],
+        "-D",
+        f"UNIQUE_TAG={unique_tag}-w{worker.index}",
+        "-D",
+        f"SCREENSHOTS_DIR={worker.directory / 'screenshots'}",
+        "-D",
+        f"REUSE_BROWSERS={'yes' if reuse_browsers else 'no'}",
+        "-D",
+        f"STEP_REPORT_DIR={worker.directory}",
+        # Leave out the scenarios that other workers run
+        "--no-skipped",
+        "--junit",
+        "--junit-directory",
+        str(worker.directory / "junit"),
+        "--format",
+        "json",
+        "--outfile",
+        str(worker.directory / "results.json"),
+        "--format",
+        "plain",
+        *behave_args,
+    ]
+    log = open(worker.directory / "behave.log", "w", encoding="utf-8")
+    with log:
+        return subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+
+
+def merge_results(workers: t.List[Worker], out_dir: pathlib.Path) -> t.Dict[str, int]:
+    """Merges the workers' JSON results, JUnit reports and screenshots, returning scenario counts by status"""
+
+    features = []
+    testsuites = ET.Element("testsuites")
+    screenshots = out_dir / "screenshots"
+    for worker in workers:
+        results = worker.directory / "results.json"
+        if results.exists() and results.stat().st_size:
+            with open(results, "r", encoding="utf-8") as f:
+                features.extend(json.load(f))
+
+        for report in sorted((worker.directory / "junit").glob("*.xml")):
+            testsuite = ET.parse(report).getroot()
+            testsuite.set("name", f"{testsuite.get('name')} (worker {worker.index})")
+            testsuites.append(testsuite)
+
+        for screenshot in sorted((worker.directory / "screenshots").glob("*")):
+            screenshots.mkdir(exist_ok=True)
+            shutil.copy2(
+                screenshot, screenshots / f"worker-{worker.index}-{screenshot.name}"
+            )
+
+    with open(out_dir / "results.json", "w", encoding="utf-8") as f:
+        json.dump(features, f, indent=2)
+    ET.ElementTree(testsuites).write(
+        out_dir / "junit.xml", encoding="utf-8", xml_declaration=True
+    )
+
+    statuses: t.Dict[str, int] = {}
+    for feature in features:
+        for element in feature.get("elements", []):
+            if element.get("type") == "scenario":
+                status = element.get("status", "untested")
+                statuses[status] = statuses.get(status, 0) + 1
+    return statuses
+
+
+def main(argv: t.Optional[t.List[str]] = None):
+    argv = sys.argv[1:] if argv is None else argv
+    behave_args = []
+    if "--" in argv:
+        behave_args = argv[argv.index("--") + 1 :]
+        argv = argv[: argv.index("--")]
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        type=pathlib.Path,
+        default=[pathlib.Path("features")],
+        help="feature files or directories (default: features)",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=2, help="behave processes (default: 2)"
+    )
+    parser.add_argument(
+        "--unique-tag",
+        default=generate_unique_string(),
+        help="namespace for instance names, suffixed with each worker's number (default: random)",
+    )
+    parser.add_argument(
+        "--out-dir",
+        type=pathlib.Path,
+        default=pathlib.Path("parallel-results"),
+        help="where to write each worker's output and the merged results (default: parallel-results)",
+    )
+    parser.add_argument(
+        "--no-reuse-browsers",
+        dest="reuse_browsers",
+        action="store_false",
+        help="start a new browser for every scenario",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="print which scenarios each worker would run",
+    )
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    shards = shard(collect_scenarios(args.paths), args.workers)
+    workers = [
+        Worker(index, scenarios, args.out_dir / f"worker-{index}")
+        for index, scenarios in enumerate(shards, start=1)
+    ]
+    for worker in workers:
+        print(f"Worker {worker.index} ({args.unique_tag}-w{worker.index}):")
+        for scenario in worker.scenarios:
+            print(f"  {scenario.location} {scenario.name}")
+    if args.dry_run:
+        return 0
+
+    if args.out_dir.exists():
+        shutil.rmtree(args.out_dir)
+    started = time.monotonic()
+    processes = [
+        start_worker(worker, args.unique_tag, args.reuse_browsers, behave_args)
+        for worker in workers
+    ]
+    returncodes: t.Dict[int, int] = {}
+    while len(returncodes) < len(workers):
+        time.sleep(1)
+        for worker, process in zip(workers, processes):
+            if worker.index in returncodes or process.poll() is None:
+                continue
+            returncodes[worker.index] = process.returncode
+            print(
+                f"Worker {worker.index} finished with exit code {process.returncode} "
+                f"after {time.monotonic() - started:.0f} s, see {worker.directory / 'behave.log'}"
+            )
+
+    statuses = merge_results(workers, args.out_dir)
+    print(
+        f"{sum(statuses.values())} scenarios in {time.monotonic() - started:.0f} s: "
+        + ", ".join(f"{count} {status}" for status, count in sorted(statuses.items()))
+    )
+    print(f"Merged results are in {args.out_dir}")
+    return 1 if any(returncodes.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
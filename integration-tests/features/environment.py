@@ -1,8 +1,16 @@
+import csv
+import json
 import os
+import pathlib
 import random
+import re
 import string
+import time
+from collections import Counter
+from urllib.error import URLError
 
 from behaving import environment as benv
+from selenium.common.exceptions import WebDriverException
 
 PERSONAS = {
 }
@@ -17,6 +25,202 @@ def generate_unique_string():
 
 BEHAVE_DEBUG_ON_ERROR = False
 UNIQUE_TAG = None
+REUSE_BROWSERS = False
+PROFILE_STEPS = False
+# Browsers kept from passing scenarios by name, for the next scenario to use
+BROWSER_POOL = {}
+
+
+class PageCache:
+    """
+    Values derived from the page that is loaded, e.g. its runtime config, kept
+    until the browser navigates.
+
+    Whether the page changed (a new browser session or URL) is checked once per
+    step, on the first lookup, so a step costs at most one WebDriver round-trip
+    for its cached values.
+    """
+
+    def __init__(self):
+        self.page = None
+        self.values = {}
+        self.checked = False
+        self.stats = Counter()
+
+    def new_step(self):
+        self.checked = False
+
+    def invalidate(self):
+        self.page = None
+        self.values.clear()
+        self.stats["invalidations"] += 1
+
+    def get(self, browser, key, compute):
+        if not self.checked:
+            page = (browser.driver.session_id, browser.url)
+            if page != self.page:
+                if self.page is not None:
+                    self.invalidate()
+                self.page = page
+            self.checked = True
+
+        if key in self.values:
+            self.stats["hits"] += 1
+        else:
+            self.stats["misses"] += 1
+            self.values[key] = compute()
+        return self.values[key]
+
+
+# What the page has done since it loaded: requests (and how many were XHR or
+# fetch calls, i.e. to OpenStack), long tasks where the browser reports them,
+# and its navigation timing
+PAGE_METRICS_SCRIPT = """
+var performance = window.performance;
+if (!performance || !performance.getEntriesByType) {
+  return null;
+}
+if (!window.__stepProfiler) {
+  var types =
+    (window.PerformanceObserver && PerformanceObserver.supportedEntryTypes) || [];
+  var profiler = (window.__stepProfiler = {
+    longTasks: types.indexOf("longtask") >= 0 ? 0 : null,
+    longTaskMs: 0,
+  });
+  // The default buffer of 250 entries fills up on a busy project page
+  if (performance.setResourceTimingBufferSize) {
+    performance.setResourceTimingBufferSize(100000);
+  }
+  if (profiler.longTasks !== null) {
+    new PerformanceObserver(function (list) {
+      list.getEntries().forEach(function (entry) {
+        profiler.longTasks += 1;
+        profiler.longTaskMs += entry.duration;
+      });
+    }).observe({ type: "longtask", buffered: true });
+  }
+}
+var resources = performance.getEntriesByType("resource");
+var navigation = performance.getEntriesByType("navigation")[0];
+return {
+  timeOrigin: performance.timeOrigin,
+  requests: resources.length,
+  apiRequests: resources.filter(function (resource) {
+    return (
+      resource.initiatorType === "xmlhttprequest" ||
+      resource.initiatorType === "fetch"
+    );
+  }).length,
+  longTasks: window.__stepProfiler.longTasks,
+  longTaskMs: window.__stepProfiler.longTaskMs,
+  domContentLoadedMs: navigation ? navigation.domContentLoadedEventEnd : null,
+  loadMs: navigation ? navigation.loadEventEnd : null,
+};
+"""
+
+FIXED_WAIT_STEP = re.compile(r"^I wait for \d+ seconds?$")
+
+STEP_REPORT_FIELDS = [
+    "step", "location", "status", "kind", "depth", "wall_ms", "requests",
+    "api_requests", "long_tasks", "long_task_ms", "dom_content_loaded_ms",
+    "load_ms",
+]
+
+COUNTED_METRICS = ["requests", "api_requests", "long_tasks", "long_task_ms"]
+
+
+def add_page_metrics(metrics, more):
+    for name, value in more.items():
+        if name in COUNTED_METRICS:
+            metrics[name] = metrics.get(name, 0) + value
+        else:
+            metrics.setdefault(name, value)
+
+
+class StepProfiler:
+    """
+    Records each step's wall time, and what the page did during it, for
+    step_timings.py to compare against a baseline.
+
+    Steps run by other steps are recorded too, keyed under their parent, and
+    their page metrics count towards the parent's.
+    """
+
+    def __init__(self):
+        self.records = {}
+        self.running = []
+        self.sample = None
+
+    def start(self, context, step):
+        parent = self.running[-1]["key"] if self.running else context.scenario.name
+        key = f"{parent} / {step.keyword} {step.name}"
+        # The same step can appear more than once in a scenario
+        repeat = 2
+        while key in self.records or any(r["key"] == key for r in self.running):
+            key = f"{parent} / {step.keyword} {step.name} #{repeat}"
+            repeat += 1
+        self.running.append(
+            {"key": key, "started": time.perf_counter(), "metrics": {}})
+
+    def finish(self, context, step):
+        running = self.running.pop()
+        wall_ms = (time.perf_counter() - running["started"]) * 1000
+        metrics = running["metrics"]
+        add_page_metrics(metrics, self.page_metrics(context))
+        if self.running:
+            add_page_metrics(self.running[-1]["metrics"], metrics)
+
+        self.records[running["key"]] = {
+            "location": str(step.location),
+            "status": step.status.name,
+            "kind": "wait" if FIXED_WAIT_STEP.match(step.name) else "step",
+            "depth": len(self.running),
+            "wall_ms": round(wall_ms, 1),
+            **{name: round(value, 1) for name, value in metrics.items()},
+        }
+
+    def page_metrics(self, context):
+        browser = getattr(context, "browser", None)
+        if browser is None:
+            return {}
+        try:
+            sample = browser.driver.execute_script(PAGE_METRICS_SCRIPT)
+        except (WebDriverException, URLError):
+            return {}
+        if not sample:
+            return {}
+
+        # Counts are since the page loaded, so only the increase is this step's
+        same_page = self.sample and self.sample["timeOrigin"] == sample["timeOrigin"]
+        previous = self.sample if same_page else {}
+        self.sample = sample
+        metrics = {
+            "requests": sample["requests"] - previous.get("requests", 0),
+            "api_requests": sample["apiRequests"] - previous.get("apiRequests", 0),
+        }
+        if sample["longTasks"] is not None:
+            metrics["long_tasks"] = (
+                sample["longTasks"] - previous.get("longTasks", 0))
+            metrics["long_task_ms"] = round(
+                sample["longTaskMs"] - previous.get("longTaskMs", 0), 1)
+        if not same_page and sample["loadMs"]:
+            metrics["dom_content_loaded_ms"] = round(
+                sample["domContentLoadedMs"], 1)
+            metrics["load_ms"] = round(sample["loadMs"], 1)
+        return metrics
+
+    def write_report(self, directory):
+        directory = pathlib.Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        with open(directory / "steps.json", "w", encoding="utf-8") as f:
+            json.dump(self.records, f, indent=2)
+            f.write("\n")
+        with open(directory / "steps.csv", "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, STEP_REPORT_FIELDS)
+            writer.writeheader()
+            for key, record in self.records.items():
+                writer.writerow({"step": key, **record})
+        print(f"Step timings written to {directory}")
 
 
 def setup_debug_on_error(userdata):
@@ -29,10 +233,61 @@ def setup_unique_tag(userdata):
     UNIQUE_TAG = userdata.get('UNIQUE_TAG', generate_unique_string())
 
 
+def setup_browser_reuse(userdata):
+    global REUSE_BROWSERS
+    REUSE_BROWSERS = userdata.getbool("REUSE_BROWSERS", False)
+
+
+def reset_browser(browser):
+    # Exosphere keeps its logged-in projects in local storage, so a reused
+    # browser has to be cleared before it leaves the app's origin
+    if browser.url.startswith("http"):
+        browser.driver.execute_script(
+            "window.localStorage.clear(); window.sessionStorage.clear();")
+        browser.driver.delete_all_cookies()
+    browser.visit("about:blank")
+
+
+def pool_browsers(context, scenario):
+    # A failed scenario's browsers may be in any state, so they are quit as
+    # usual (after behaving's screenshot) rather than reused
+    if not REUSE_BROWSERS or scenario.status != "passed":
+        return
+    for name, browser in list(context.browsers.items()):
+        try:
+            reset_browser(browser)
+        except (WebDriverException, URLError):
+            continue
+        BROWSER_POOL[name] = context.browsers.pop(name)
+
+
+def quit_pooled_browsers():
+    for browser in BROWSER_POOL.values():
+        try:
+            browser.quit()
+        except (WebDriverException, URLError):
+            pass
+    BROWSER_POOL.clear()
+
+
+def setup_step_profiler(userdata):
+    global PROFILE_STEPS
+    PROFILE_STEPS = userdata.getbool("PROFILE_STEPS", False)
+
+
 def before_all(context):
     setup_debug_on_error(context.config.userdata)
     setup_unique_tag(context.config.userdata)
+    setup_browser_reuse(context.config.userdata)
+    setup_step_profiler(context.config.userdata)
+    context.step_profiler = StepProfiler()
+    # performance-tests/reports, next to the other performance reports
+    default_step_report_dir = pathlib.Path(
+        __file__).resolve().parents[2] / "performance-tests" / "reports"
+    context.step_report_dir = context.config.userdata.get(
+        "STEP_REPORT_DIR", str(default_step_report_dir))
     context.unique_tag = UNIQUE_TAG
+    context.page_cache = PageCache()
     context.remote_webdriver = context.config.userdata.getbool(
         "REMOTE_WEBDRIVER", False)
     if not hasattr(context, "browser_args"):
@@ -49,7 +304,15 @@ def before_all(context):
 
 
 def after_all(context):
+    quit_pooled_browsers()
     benv.after_all(context)
+    stats = context.page_cache.stats
+    print(
+        f"Page cache: {stats['hits']} hits, {stats['misses']} misses, "
+        f"{stats['invalidations']} invalidations"
+    )
+    if PROFILE_STEPS:
+        context.step_profiler.write_report(context.step_report_dir)
 
 
 def before_feature(context, feature):
@@ -62,14 +325,26 @@ def after_feature(context, feature):
 
 def before_scenario(context, scenario):
     benv.before_scenario(context, scenario)
+    # behaving's "Given a browser" only starts a browser that isn't in here
+    context.browsers.update(BROWSER_POOL)
+    BROWSER_POOL.clear()
     context.personas = PERSONAS
 
 
 def after_scenario(context, scenario):
+    pool_browsers(context, scenario)
     benv.after_scenario(context, scenario)
 
 
+def before_step(context, step):
+    context.page_cache.new_step()
+    if PROFILE_STEPS:
+        context.step_profiler.start(context, step)
+
+
 def after_step(context, step):
+    if PROFILE_STEPS:
+        context.step_profiler.finish(context, step)
     if BEHAVE_DEBUG_ON_ERROR and step.status == "failed":
         # -- ENTER DEBUGGER: Zoom in on failure location.
         # NOTE: Use PyCharm debugger. Same for IPython debugger and pdb (basic python debugger).
@@ -28,7 +28,7 @@ Feature: Text presence
         Then I should see "Jetstream2 IU - INI210003" within 5 seconds
         And I should see an element whose xpath "//h3" matches the runtime regex "^\s*{virtualComputer}(?:s|es)?\s*$" within 20 seconds
 
-    @launch
+    @launch @shard.instance
     Scenario: Launch an instance
         Given a browser
         When I go to Exosphere
@@ -67,7 +67,7 @@ Feature: Text presence
         Then I should see an element with xpath "//div[contains(string(),'Ready')]" within 600 seconds
 
 
-    @delete
+    @delete @shard.instance
     Scenario: Delete instance
         Given a browser
         When I go to Exosphere
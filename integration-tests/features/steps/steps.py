@@ -6,6 +6,7 @@ from behaving.personas.persona import persona_vars
 from behaving.web.steps import i_press_xpath
 from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.support.ui import WebDriverWait
+from splinter.element_list import ElementList
 
 
 DEFAULT_LOCALIZATION = {
@@ -39,6 +40,35 @@ DEFAULT_CONFIG = {
 }
 
 
+# Evaluates an XPath and filters the nodes in the page, so a lookup is one
+# WebDriver round-trip however many nodes match. Nodes are filtered by a regex
+# (arguments[1]) against their text, and/or ranked by a label (arguments[2]):
+# exact text matches first, then case-insensitive ones, then any node.
+MATCH_ELEMENTS_SCRIPT = """
+var snapshot = document.evaluate(
+  arguments[0], document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null
+);
+var regex = arguments[1] === null ? null : new RegExp(arguments[1], "i");
+var label = arguments[2];
+var nodes = [];
+for (var i = 0; i < snapshot.snapshotLength; i++) {
+  var node = snapshot.snapshotItem(i);
+  var text = (node.innerText ?? node.textContent ?? "").trim();
+  if (regex === null || regex.test(text)) {
+    nodes.push({ node: node, text: text });
+  }
+}
+if (label !== null) {
+  var exact = nodes.filter(function (n) { return n.text === label; });
+  var caseless = nodes.filter(function (n) {
+    return n.text.toUpperCase() === label.toUpperCase();
+  });
+  nodes = exact.length ? exact : caseless.length ? caseless : nodes;
+}
+return nodes.map(function (n) { return n.node; });
+"""
+
+
 @step('I pause for a breakpoint')
 def i_pause_for_breakpoint(context):
     print('Stopping for a breakpoint')
@@ -60,6 +90,7 @@ def i_go_to_exosphere(context):
     exosphere_url = context.config.userdata.get('EXOSPHERE_BASE_URL',
                                                 'https://try.exosphere.app/exosphere')
     context.browser.visit(exosphere_url)
+    context.page_cache.invalidate()
 
 
 def find_by_label(context, label, element_type, wait_time=None):
@@ -96,28 +127,16 @@ def xpath_literal(value):
     return "concat(" + ", \"'\", ".join(f"'{part}'" for part in parts) + ")"
 
 
-def find_element_with_role_and_label(context, role, label, wait_time=None):
+def role_and_label_xpath(role, label):
     upper = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
     lower = upper.lower()
     normalized_label = xpath_literal(label.lower())
-    return context.browser.find_by_xpath(
-        xpath=(
-            f"//div[@role='{role}']"
-            f"//div[contains("
-            f"translate(string(), '{upper}', '{lower}'), "
-            f"{normalized_label}"
-            f")]"
-        ),
-        wait_time=wait_time
-    )
-
-
-def find_button_with_label(context, label, wait_time=None):
-    return find_element_with_role_and_label(
-        context=context,
-        role='button',
-        label=label,
-        wait_time=wait_time
+    return (
+        f"//div[@role='{role}']"
+        f"//div[contains("
+        f"translate(string(), '{upper}', '{lower}'), "
+        f"{normalized_label}"
+        f")]"
     )
 
 
@@ -133,7 +152,10 @@ def find_radio_with_label(context, label, wait_time=None):
         wait_time=wait_time)
 
 
-def runtime_config(context):
+TEMPLATE_PLACEHOLDER = re.compile(r"{([A-Za-z0-9_]+)}")
+
+
+def read_runtime_config(context):
     return context.browser.driver.execute_script(
         """
         var runtimeConfig = window.config || {};
@@ -153,83 +175,105 @@ def runtime_config(context):
     )
 
 
+# window.config is only read once per page load, see PageCache in environment.py
+def runtime_config(context):
+    return context.page_cache.get(
+        context.browser, "config", lambda: read_runtime_config(context)
+    )
+
+
 def runtime_template_values(context):
-    config = runtime_config(context)
-    values = {
-        key: value for key, value in config.items() if isinstance(value, str)
-    }
-    values.update(config["localization"])
-    return values
+    def template_values():
+        config = runtime_config(context)
+        values = {
+            key: value for key, value in config.items() if isinstance(value, str)
+        }
+        values.update(config["localization"])
+        return values
+
+    return context.page_cache.get(
+        context.browser, "template_values", template_values
+    )
 
 
 def render_runtime_template(context, template, regex_escape_values=False):
-    values = runtime_template_values(context)
+    def render():
+        values = runtime_template_values(context)
 
-    def replace_placeholder(match):
-        key = match.group(1)
-        assert key in values, (
-            f'Unknown runtime template key "{key}" in template "{template}"'
-        )
-        value = values[key]
-        return re.escape(value) if regex_escape_values else value
+        def replace_placeholder(match):
+            key = match.group(1)
+            assert key in values, (
+                f'Unknown runtime template key "{key}" in template "{template}"'
+            )
+            value = values[key]
+            return re.escape(value) if regex_escape_values else value
 
-    return re.sub(r"{([A-Za-z0-9_]+)}", replace_placeholder, template)
+        return TEMPLATE_PLACEHOLDER.sub(replace_placeholder, template)
+
+    return context.page_cache.get(
+        context.browser, ("template", template, regex_escape_values), render
+    )
 
 
 def default_login_view(context):
     return runtime_config(context).get("defaultLoginView")
 
 
-def find_elements_by_xpath_matching_regex(context, xpath, pattern, timeout):
-    compiled_pattern = re.compile(pattern, re.IGNORECASE)
-
-    def matching_elements():
-        return [
-            element for element in context.browser.find_by_xpath(xpath)
-            if compiled_pattern.search(element.text)
-        ]
+# Polls until something matches or `timeout` seconds (the browser's wait time
+# by default) pass, with one script call per poll. `pattern` is evaluated as a
+# JavaScript RegExp, which agrees with Python's re for the escapes, groups and
+# anchors the runtime regex steps use.
+def match_elements(context, xpath, pattern=None, label=None, timeout=None):
+    browser = context.browser
+    query = xpath if pattern is None else f"{xpath} =~ /{pattern}/i"
+
+    def elements():
+        return ElementList(
+            [
+                browser.element_class(element, browser)
+                for element in browser.driver.execute_script(
+                    MATCH_ELEMENTS_SCRIPT, xpath, pattern, label
+                )
+            ],
+            find_by="xpath",
+            query=query,
+        )
 
+    if timeout is None:
+        timeout = browser.wait_time
     if timeout <= 0:
-        return matching_elements()
+        return elements()
 
     try:
         return WebDriverWait(
-            context.browser.driver,
+            browser.driver,
             timeout,
             poll_frequency=0.2,
-        ).until(lambda _driver: matching_elements() or False)
+        ).until(lambda _driver: elements() or False)
     except TimeoutException:
-        return []
+        return ElementList([], find_by="xpath", query=query)
+
+
+def find_elements_by_xpath_matching_regex(context, xpath, pattern, timeout):
+    return match_elements(context, xpath, pattern=pattern, timeout=timeout)
+
+
+def find_buttons_ranked_by_label(context, label):
+    return match_elements(
+        context, role_and_label_xpath('button', label), label=label
+    )
 
 
 @step(u'I click the "{label}" button')
 @persona_vars
 def i_press_label_button(context, label):
-    all_elements = find_button_with_label(context, label)
-    case_insensitive_elements = [e for e in all_elements if
-                                 str.upper(e.text) == str.upper(label)]
-    case_sensitive_elements = [e for e in all_elements if e.text == label]
-    elements = case_sensitive_elements or case_insensitive_elements
-    if elements:
-        element = elements[0]
-    else:
-        element = all_elements.first
-    element.click()
+    find_buttons_ranked_by_label(context, label).first.click()
 
 
 @step(u'I click the last "{label}" button')
 @persona_vars
 def i_press_last_label_button(context, label):
-    all_elements = find_button_with_label(context, label)
-    case_insensitive_elements = [e for e in all_elements if
-                                 str.upper(e.text) == str.upper(label)]
-    case_sensitive_elements = [e for e in all_elements if e.text == label]
-    elements = case_sensitive_elements or case_insensitive_elements
-    if elements:
-        element = elements[-1]
-    else:
-        element = all_elements.last
-    element.click()
+    find_buttons_ranked_by_label(context, label).last.click()
 
 
 @step(u'I click the button with runtime text "{template}"')
@@ -322,13 +366,19 @@ def i_navigate_to_openstack_login_form(context):
     """)
 
 
+def openstack_setting(context, name, default=None):
+    # Userdata (e.g. -D OS_AUTH_URL=...) wins over the environment, so each run can pick a cloud,
+    # such as performance-tests/fake_openstack.py
+    return context.config.userdata.get(name, os.environ.get(name, default))
+
+
 @step("I enter OpenStack credentials")
 @persona_vars
 def i_login_to_exosphere(context):
-    os_auth_url = os.environ.get('OS_AUTH_URL', 'https://js2.jetstream-cloud.org:5000/v3/')
-    os_user_domain_name = os.environ.get('OS_USER_DOMAIN_NAME', 'access')
-    os_username = os.environ.get('OS_USERNAME')
-    os_password = os.environ.get('OS_PASSWORD')
+    os_auth_url = openstack_setting(context, 'OS_AUTH_URL', 'https://js2.jetstream-cloud.org:5000/v3/')
+    os_user_domain_name = openstack_setting(context, 'OS_USER_DOMAIN_NAME', 'access')
+    os_username = openstack_setting(context, 'OS_USERNAME')
+    os_password = openstack_setting(context, 'OS_PASSWORD')
     context.execute_steps(f"""
     Then I fill input labeled "Keystone auth URL" with "{os_auth_url}"
     Then I fill input labeled "User Domain (name or ID)" with "{os_user_domain_name}"
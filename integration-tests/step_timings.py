@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Summarises the step timings recorded by `behave -D PROFILE_STEPS=yes`, and compares them against a baseline
+
+A report is the steps.json written to performance-tests/reports (or STEP_REPORT_DIR). Reports from several
+behave_parallel.py workers can be given together. To make a baseline, keep a copy of a report.
+
+Examples:
+    python3 step_timings.py summary ../performance-tests/reports/steps.json
+    python3 step_timings.py compare step-baseline.json ../performance-tests/reports/steps.json
+"""
+
+import argparse
+import json
+import pathlib
+import sys
+import typing as t
+
+# A step is slower when its wall time is over this many times its baseline...
+DEFAULT_TOLERANCE = 1.5
+# ...and also slower by at least this much, so ordinary jitter in the browser is ignored
+DEFAULT_MIN_REGRESSION_MS = 1000.0
+
+Report = t.Dict[str, t.Dict[str, t.Any]]
+
+
+def load_reports(paths: t.List[pathlib.Path]) -> Report:
+    steps: Report = {}
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            steps.update(json.load(f))
+    return steps
+
+
+def summary(steps: Report, top: int):
+    # Steps run by other steps are already counted in their parent's time
+    top_level = {key: step for key, step in steps.items() if step["depth"] == 0}
+    total_ms = sum(step["wall_ms"] for step in top_level.values())
+    # Fixed waits never run other steps, so they can be counted at any depth
+    waits_ms = sum(step["wall_ms"] for step in steps.values() if step["kind"] == "wait")
+    print(
+        f"{len(top_level)} steps in {total_ms / 1000:.1f} s, "
+        f"{waits_ms / 1000:.1f} s of which are fixed waits"
+    )
+    print(
+        f"{'wall ms':>9} {'requests':>9} {'api':>5} {'long tasks':>11} {'load ms':>8}  step"
+    )
+    for key, step in sorted(steps.items(), key=lambda s: s[1]["wall_ms"], reverse=True)[
+        :top
+    ]:
+        long_tasks = (
+            f"{step['long_tasks']} ({step['long_task_ms']:g} ms)"
+            if "long_tasks" in step
+            else "-"
+        )
+        print(
+            f"{step['wall_ms']:>9.0f} {step.get('requests', '-'):>9} "
+            f"{step.get('api_requests', '-'):>5} {long_tasks:>11} "
+            f"{step.get('load_ms', '-'):>8}  {key}"
+        )
+
+
+def compare(
+    baseline: Report, steps: Report, tolerance: float, min_regression_ms: float
+) -> t.List[str]:
+    """Returns a line for each step that got slower than its baseline"""
+
+    slower = []
+    for key, step in steps.items():
+        expected = baseline.get(key)
+        if expected is None or step["status"] != "passed":
+            continue
+        wall_ms, expected_ms = step["wall_ms"], expected["wall_ms"]
+        if (
+            wall_ms > expected_ms * tolerance
+            and wall_ms - expected_ms >= min_regression_ms
+        ):
+            slower.append(
+                f"{key}: {wall_ms:.0f} ms, baseline {expected_ms:.0f} ms "
+                f"({wall_ms / max(expected_ms, 1):.1f}x)"
+            )
+    return slower
+
+
+def main(argv: t.Optional[t.List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    summary_parser = subparsers.add_parser(
+        "summary", help="show the slowest steps and how long was spent in fixed waits"
+    )
+    summary_parser.add_argument("reports", nargs="+", type=pathlib.Path)
+    summary_parser.add_argument(
+        "--top", type=int, default=20, help="steps to show (default: 20)"
+    )
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="list the steps that got slower, exiting with 1 if any did"
+    )
+    compare_parser.add_argument("baseline", type=pathlib.Path)
+    compare_parser.add_argument("reports", nargs="+", type=pathlib.Path)
+    compare_parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help=f"how many times its baseline a step may take (default: {DEFAULT_TOLERANCE:g})",
+    )
+    compare_parser.add_argument(
+        "--min-ms",
+        type=float,
+        default=DEFAULT_MIN_REGRESSION_MS,
+        help=f"how much slower a step must also be, in ms (default: {DEFAULT_MIN_REGRESSION_MS:g})",
+    )
+
+    args = parser.parse_args(argv)
+    steps = load_reports(args.reports)
+
+    if args.command == "summary":
+        summary(steps, args.top)
+        return 0
+
+    baseline = load_reports([args.baseline])
+    slower = compare(baseline, steps, args.tolerance, args.min_ms)
+    new = [key for key in steps if key not in baseline]
+    print(
+        f"Compared {len(steps) - len(new)} steps against {args.baseline}, "
+        f"{len(new)} steps have no baseline"
+    )
+    if slower:
+        print(f"{len(slower)} steps got slower:")
+        for line in slower:
+            print(f"  {line}")
+        return 1
+    print("No steps got slower")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,617 @@
+"""
+Benchmark harness for the Python agents that run on instances.
+
+Each agent is loaded straight from its source file. External commands are replaced by a fake
+`subprocess.Popen` that answers from recorded fixtures and counts every process spawned, reads
+of /proc (and other instance files) are redirected into `fixtures/`, and a local HTTP server
+stands in for the OpenStack metadata service. The `bench` fixture then measures an operation
+and compares it against `baseline.json`.
+"""
+
+import hashlib
+import http.server
+import importlib.util
+import io
+import json
+import math
+import os
+import pathlib
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import typing as t
+
+import pytest
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parents[2]
+FIXTURES = pathlib.Path(__file__).resolve().parent / "fixtures"
+BASELINE_PATH = pathlib.Path(__file__).resolve().parent / "baseline.json"
+REPORT_PATH = REPO_ROOT / "performance-tests" / "reports" / "agents.json"
+
+# The systemd client that automount-volume.py and mount_ceph.py import, found here rather than
+# where the auto-mount-volumes role installs it
+sys.path.insert(0, str(REPO_ROOT / "ansible/roles/auto-mount-volumes/files"))
+
+AGENTS = {
+    "system_load": REPO_ROOT
+    / "ansible/roles/system-load-logging/files/system_load_json.py",
+    "automount_volume": REPO_ROOT
+    / "ansible/roles/auto-mount-volumes/files/automount-volume.py",
+    "mount_ceph": REPO_ROOT / "assets/scripts/mount_ceph.py",
+    "share_bench": REPO_ROOT / "assets/scripts/share_bench.py",
+    "fake_openstack": REPO_ROOT / "performance-tests/fake_openstack.py",
+}
+
+# A measurement regresses when it is this many times its baseline (a baseline entry's own
+# "tolerance" overrides it)...
+DEFAULT_TOLERANCE = float(os.environ.get("AGENT_BENCH_TOLERANCE", "3"))
+# ...and also worse by at least this much. The baseline is recorded on another machine, and CPU
+# time on a busy CI runner varies by a few milliseconds, so only a larger difference counts.
+# Wall time varies far more, with the runner's load, so it is reported but never compared.
+MIN_REGRESSION_CPU_MS = 5.0
+MIN_REGRESSION_KB = 4.0
+MIN_RSS_GROWTH_KB = 512.0
+# Timings are the fastest of this many repeats, which is the one least disturbed by other load
+REPEATS = 5
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--update-baseline",
+        action="store_true",
+        help="write the measurements to baseline.json instead of comparing against it",
+    )
+
+
+def load_agent(name: str):
+    spec = importlib.util.spec_from_file_location(f"agent_{name}", AGENTS[name])
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+#
+# Fake external commands
+#
+
+
+class CommandResult(t.NamedTuple):
+    stdout: str = ""
+    stderr: str = ""
+    returncode: int = 0
+
+
+class FakeCommands:
+    """Registry of fake commands, keyed by program name, and a log of what was spawned"""
+
+    def __init__(self):
+        self.handlers: t.Dict[
+            str, t.Callable[[t.List[str]], t.Union[CommandResult, str]]
+        ] = {}
+        self.spawned: t.List[t.List[str]] = []
+
+    def add(
+        self,
+        program: str,
+        result: t.Union[
+            CommandResult, t.Callable[[t.List[str]], t.Union[CommandResult, str]]
+        ],
+    ):
+        self.handlers[program] = result if callable(result) else (lambda argv: result)
+
+    def add_output(
+        self, program: str, stdout: str = "", stderr: str = "", returncode: int = 0
+    ):
+        self.add(program, CommandResult(stdout, stderr, returncode))
+
+    def add_fixture(self, program: str, fixture: str, returncode: int = 0):
+        self.add(
+            program,
+            CommandResult(
+                (FIXTURES / "commands" / fixture).read_text(), "", returncode
+            ),
+        )
+
+    def run(self, argv: t.List[str]) -> CommandResult:
+        self.spawned.append(argv)
+        # Commands are sometimes run through /usr/bin/env or by absolute path
+        args = list(argv[1:]) if os.path.basename(argv[0]) == "env" else list(argv)
+        program = os.path.basename(args[0])
+        if program not in self.handlers:
+            raise FileNotFoundError(2, "No such file or directory (not faked)", program)
+        result = self.handlers[program](args)
+        # Handlers may return just the output
+        return CommandResult(result) if isinstance(result, str) else result
+
+
+class FakePopen:
+    """Just enough of subprocess.Popen for subprocess.run/check_output and pipe readers"""
+
+    commands: FakeCommands
+
+    def __init__(
+        self,
+        args,
+        stdin=None,
+        stdout=None,
+        stderr=None,
+        text=None,
+        universal_newlines=None,
+        encoding=None,
+        **kwargs,
+    ):
+        argv = [args] if isinstance(args, str) else [str(a) for a in args]
+        self.args = args
+        self.pid = 4242
+        self.returncode = None
+        self._text = bool(text or universal_newlines or encoding)
+        self._result = self.commands.run(argv)
+        self.stdin = None
+        self.stdout = (
+            self._stream(self._result.stdout) if stdout == subprocess.PIPE else None
+        )
+        self.stderr = (
+            self._stream(self._result.stderr) if stderr == subprocess.PIPE else None
+        )
+
+    def _convert(self, value: str):
+        return value if self._text else value.encode()
+
+    def _stream(self, value: str):
+        return io.StringIO(value) if self._text else io.BytesIO(value.encode())
+
+    def communicate(self, input=None, timeout=None):
+        self.returncode = self._result.returncode
+        return (
+            None if self.stdout is None else self._convert(self._result.stdout),
+            None if self.stderr is None else self._convert(self._result.stderr),
+        )
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        self.returncode = self._result.returncode
+        return self.returncode
+
+    def terminate(self):
+        self.returncode = -15
+
+    kill = terminate
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+@pytest.fixture
+def commands(monkeypatch) -> FakeCommands:
+    fake = FakeCommands()
+    monkeypatch.setattr(FakePopen, "commands", fake, raising=False)
+    monkeypatch.setattr(subprocess, "Popen", FakePopen)
+    return fake
+
+
+#
+# Fake instance filesystem
+#
+
+
+class FakeFilesystem:
+    """Redirects reads of instance paths such as /proc/stat into fixtures/"""
+
+    REDIRECTED = ("/proc/", "/sys/", "/run/udev/")
+
+    def __init__(self, root: pathlib.Path):
+        self.root = root
+        self.statvfs: t.Dict[str, os.statvfs_result] = {}
+
+    def path(self, path) -> str:
+        path = os.fspath(path)
+        if (path + "/").startswith(self.REDIRECTED):
+            return str(self.root / path.lstrip("/"))
+        return path
+
+    def add_statvfs(
+        self, path: str, blocks: int, free: int, avail: int, block_size: int = 4096
+    ):
+        self.statvfs[path] = os.statvfs_result(
+            (block_size, block_size, blocks, free, avail, 1000, 500, 500, 0, 255)
+        )
+
+
+@pytest.fixture
+def instance_fs(monkeypatch) -> FakeFilesystem:
+    fs = FakeFilesystem(FIXTURES)
+    fs.add_statvfs("/", blocks=5_000_000, free=2_000_000, avail=1_800_000)
+
+    real_open = open
+    real_isdir = os.path.isdir
+    real_access = os.access
+    real_statvfs = os.statvfs
+    real_listdir = os.listdir
+    real_readlink = os.readlink
+
+    def fake_statvfs(path):
+        path = os.fspath(path)
+        return fs.statvfs[path] if path in fs.statvfs else real_statvfs(fs.path(path))
+
+    monkeypatch.setattr(os.path, "isdir", lambda p: real_isdir(fs.path(p)))
+    monkeypatch.setattr(
+        os, "access", lambda p, mode, **kw: real_access(fs.path(p), mode, **kw)
+    )
+    monkeypatch.setattr(os, "statvfs", fake_statvfs)
+    monkeypatch.setattr(os, "listdir", lambda p=".": real_listdir(fs.path(p)))
+    monkeypatch.setattr(os, "readlink", lambda p, **kw: real_readlink(fs.path(p), **kw))
+
+    # Agents call the builtin open(); shadow it in each agent module's globals
+    fs.open = lambda file, *args, **kwargs: real_open(fs.path(file), *args, **kwargs)
+    return fs
+
+
+@pytest.fixture
+def agent(instance_fs, monkeypatch):
+    """Loads an agent by name, with its open() reading from the fake filesystem"""
+
+    def load(name: str):
+        module = load_agent(name)
+        monkeypatch.setattr(module, "open", instance_fs.open, raising=False)
+        return module
+
+    return load
+
+
+class FakeMetadataServer(http.server.ThreadingHTTPServer):
+    """
+    A local OpenStack metadata service, serving fixtures/metadata/meta_data.json
+
+    Change `metadata` to change what it serves. Every request is logged with its status, and
+    responses carry an ETag honoured by If-None-Match unless `etags` is turned off.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeMetadataHandler)
+        self.metadata = json.loads(
+            (FIXTURES / "metadata" / "meta_data.json").read_text()
+        )
+        self.etags = True
+        self.delay = 0.0
+        self.requests: t.List[t.Tuple[str, int]] = []
+        self.url = (
+            f"http://127.0.0.1:{self.server_address[1]}/openstack/latest/meta_data.json"
+        )
+
+    def tag_volume(self, serial: str, name: str):
+        """Adds a volume's exoVolume tag, as Exosphere does when attaching it"""
+        self.metadata["devices"].append(
+            {
+                "type": "disk",
+                "bus": "scsi",
+                "serial": serial,
+                "tags": ["exoVolume::" + json.dumps({"name": name})],
+            }
+        )
+
+    def statuses(self) -> t.List[int]:
+        return [status for _, status in self.requests]
+
+
+class FakeMetadataHandler(http.server.BaseHTTPRequestHandler):
+    server: FakeMetadataServer
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        body = json.dumps(self.server.metadata).encode()
+        etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+
+        if self.path != "/openstack/latest/meta_data.json":
+            status = 404
+        elif self.server.etags and self.headers.get("If-None-Match") == etag:
+            status = 304
+        else:
+            status = 200
+        self.server.requests.append((self.path, status))
+
+        self.send_response(status)
+        if self.server.etags:
+            self.send_header("ETag", etag)
+        if status == 200:
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if status == 200:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def metadata_service() -> FakeMetadataServer:
+    server = FakeMetadataServer()
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class FakeJournal:
+    """Receives entries sent with the journal's native protocol"""
+
+    def __init__(self):
+        # Unix socket paths are limited to about 100 characters, too short for tmp_path
+        self.directory = tempfile.mkdtemp(prefix="journal-")
+        self.path = os.path.join(self.directory, "socket")
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.path)
+        self.socket.setblocking(False)
+
+    def entries(self) -> t.List[t.Dict[str, str]]:
+        entries = []
+        while True:
+            try:
+                datagram = self.socket.recv(65536).decode()
+            except BlockingIOError:
+                return entries
+            entries.append(dict(line.split("=", 1) for line in datagram.splitlines()))
+
+    def close(self):
+        self.socket.close()
+        shutil.rmtree(self.directory)
+
+
+@pytest.fixture
+def journal() -> FakeJournal:
+    fake = FakeJournal()
+    yield fake
+    fake.close()
+
+
+#
+# Measurement
+#
+
+
+class FakeSystemdBus:
+    """
+    Just enough of exosphere_systemd.ManagerBus for its SystemdDBus client
+
+    Jobs finish as soon as they are queued: "done", or "failed" for units in `failing`.
+    """
+
+    def __init__(self):
+        self.calls: t.List[t.Tuple] = []
+        self.active: t.Set[str] = set()
+        self.enabled: t.Set[str] = set()
+        self.failing: t.Set[str] = set()
+        self.transient: t.Dict[str, t.Dict[str, t.Any]] = {}
+        self.jobs: t.Dict[str, str] = {}
+
+    def variant(self, signature: str, value: t.Any) -> t.Any:
+        return value
+
+    def call(self, method: str, signature: str = "", *args) -> tuple:
+        self.calls.append((method, *args))
+        if method == "EnableUnitFiles":
+            self.enabled |= set(args[0])
+            return (True, [])
+        if method == "DisableUnitFiles":
+            self.enabled -= set(args[0])
+            return ([],)
+        if method in ("StartUnit", "StopUnit", "StartTransientUnit"):
+            unit = args[0]
+            if method == "StartTransientUnit":
+                self.transient[unit] = dict(args[2])
+            job = f"/org/freedesktop/systemd1/job/{len(self.calls)}"
+            self.jobs[job] = "failed" if unit in self.failing else "done"
+            if unit not in self.failing:
+                if method == "StopUnit":
+                    self.active.discard(unit)
+                else:
+                    self.active.add(unit)
+            return (job,)
+        return ()
+
+    def start_job(self, method: str, signature: str, *args) -> str:
+        (job,) = self.call(method, signature, *args)
+        return job
+
+    def wait(self, jobs: t.List[str], timeout: float) -> t.Dict[str, str]:
+        return {job: self.jobs.pop(job) for job in jobs}
+
+    def methods(self) -> t.List[str]:
+        return [call[0] for call in self.calls]
+
+
+@pytest.fixture
+def systemd_bus() -> FakeSystemdBus:
+    return FakeSystemdBus()
+
+
+class Measurement(t.NamedTuple):
+    wall_ms: float
+    cpu_ms: float
+    peak_alloc_kb: float
+    max_rss_kb: float
+    rss_growth_kb: float
+    subprocesses: float
+    files_opened: float
+
+
+RESULTS: t.Dict[str, Measurement] = {}
+
+# Files opened while an operation is being counted. Like processes spawned, this doesn't depend
+# on how fast the machine is, so it is compared exactly.
+OPENS = {"counting": False, "count": 0}
+
+
+def count_opens(event: str, args: tuple):
+    if event == "open" and OPENS["counting"]:
+        OPENS["count"] += 1
+
+
+# Audit hooks can't be removed, so this one is added once and switched on by bench()
+sys.addaudithook(count_opens)
+
+
+def load_baseline() -> t.Dict[str, t.Dict[str, float]]:
+    if BASELINE_PATH.exists():
+        return json.loads(BASELINE_PATH.read_text())
+    return {}
+
+
+def regressions(
+    name: str, measured: Measurement, baseline: t.Dict[str, float]
+) -> t.List[str]:
+    problems = []
+    if measured.subprocesses > baseline["subprocesses"]:
+        problems.append(
+            f"spawns {measured.subprocesses:g} processes per operation, baseline {baseline['subprocesses']:g}"
+        )
+    if measured.files_opened > baseline["files_opened"]:
+        problems.append(
+            f"opens {measured.files_opened:g} files per operation, baseline {baseline['files_opened']:g}"
+        )
+    tolerance = baseline.get("tolerance", DEFAULT_TOLERANCE)
+    for field, floor in (
+        ("cpu_ms", MIN_REGRESSION_CPU_MS),
+        ("peak_alloc_kb", MIN_REGRESSION_KB),
+        ("rss_growth_kb", MIN_RSS_GROWTH_KB),
+    ):
+        value, expected = getattr(measured, field), baseline[field]
+        if value > expected * tolerance and value - expected > floor:
+            problems.append(
+                f"{field} {value:.3f} is over {tolerance:g}x baseline {expected:.3f}"
+            )
+    return [f"{name}: {p}" for p in problems]
+
+
+def rss_kb() -> float:
+    # The process's current resident set, unlike ru_maxrss, falls again when memory is freed
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 1024
+
+
+@pytest.fixture
+def bench(request, commands):
+    """
+    Measures an operation: bench(operation, rounds=N)
+
+    Reports wall and CPU time, processes spawned and files opened per operation, peak Python
+    allocations during the run, the process's peak RSS, and how much its RSS grew over all the
+    rounds, which is memory the operation kept hold of. Fails if the operation regressed
+    against baseline.json (in anything but wall time), unless pytest was run with
+    --update-baseline.
+    """
+
+    name = request.node.name
+
+    def run(operation: t.Callable[[], t.Any], rounds: int = 100, warmup: int = 3):
+        for _ in range(warmup):
+            operation()
+
+        rss_before = rss_kb()
+        spawned_before = len(commands.spawned)
+        per_repeat = max(1, rounds // REPEATS)
+        wall_ms = cpu_ms = math.inf
+        OPENS.update(counting=True, count=0)
+        try:
+            for _ in range(REPEATS):
+                wall_start, cpu_start = time.perf_counter(), time.process_time()
+                for _ in range(per_repeat):
+                    operation()
+                wall_ms = min(
+                    wall_ms, (time.perf_counter() - wall_start) * 1000 / per_repeat
+                )
+                cpu_ms = min(
+                    cpu_ms, (time.process_time() - cpu_start) * 1000 / per_repeat
+                )
+        finally:
+            OPENS["counting"] = False
+        subprocesses = (len(commands.spawned) - spawned_before) / (per_repeat * REPEATS)
+        files_opened = OPENS["count"] / (per_repeat * REPEATS)
+        rss_growth_kb = max(0.0, rss_kb() - rss_before)
+
+        # Allocations are traced in a separate pass, since tracing slows everything down
+        tracemalloc.start()
+        try:
+            operation()
+            peak_alloc_kb = tracemalloc.get_traced_memory()[1] / 1024
+        finally:
+            tracemalloc.stop()
+
+        # ru_maxrss is in kB on Linux
+        max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        measured = Measurement(
+            wall_ms,
+            cpu_ms,
+            peak_alloc_kb,
+            max_rss_kb,
+            rss_growth_kb,
+            subprocesses,
+            files_opened,
+        )
+        RESULTS[name] = measured
+
+        baseline = load_baseline().get(name)
+        if baseline is not None and not request.config.getoption("--update-baseline"):
+            problems = regressions(name, measured, baseline)
+            assert not problems, "Performance regression:\n" + "\n".join(problems)
+        return measured
+
+    return run
+
+
+def pytest_sessionfinish(session, exitstatus):
+    if not RESULTS:
+        return
+
+    if session.config.getoption("--update-baseline"):
+        baseline = load_baseline()
+        for name, measured in RESULTS.items():
+            entry = {
+                "wall_ms": round(measured.wall_ms, 4),
+                "cpu_ms": round(measured.cpu_ms, 4),
+                "peak_alloc_kb": round(measured.peak_alloc_kb, 1),
+                "rss_growth_kb": round(measured.rss_growth_kb),
+                "subprocesses": measured.subprocesses,
+                "files_opened": measured.files_opened,
+            }
+            # Tolerances are set by hand, for operations that need a looser one
+            if "tolerance" in baseline.get(name, {}):
+                entry["tolerance"] = baseline[name]["tolerance"]
+            baseline[name] = entry
+        BASELINE_PATH.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+
+    if REPORT_PATH.parent.is_dir():
+        REPORT_PATH.write_text(
+            json.dumps(
+                {name: m._asdict() for name, m in sorted(RESULTS.items())}, indent=2
+            )
+            + "\n"
+        )
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not RESULTS:
+        return
+    terminalreporter.section("agent benchmarks")
+    terminalreporter.write_line(
+        f"{'operation':<44} {'wall ms':>9} {'cpu ms':>9} {'alloc kB':>9} {'rss kB':>9} {'+rss kB':>9} {'procs':>6} {'opens':>6}"
+    )
+    for name, m in sorted(RESULTS.items()):
+        terminalreporter.write_line(
+            f"{name:<44} {m.wall_ms:>9.3f} {m.cpu_ms:>9.3f} {m.peak_alloc_kb:>9.1f} {m.max_rss_kb:>9.0f} {m.rss_growth_kb:>9.0f} {m.subprocesses:>6g} {m.files_opened:>6g}"
+        )
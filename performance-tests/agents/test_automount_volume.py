@@ -0,0 +1,584 @@
+import fcntl
+import json
+import os
+import pathlib
+import struct
+import threading
+import time
+import typing as t
+
+import exosphere_systemd
+import pytest
+from conftest import FIXTURES
+
+DATA_SERIAL = "6f1c4b2a-9d3e-4f5a-8b7c-0123456789ab"
+RESULTS_SERIAL = "3b2a1c0d-4e5f-4a6b-8c7d-9e0f1a2b3c4d"
+
+
+@pytest.fixture
+def automount(agent, metadata_service, monkeypatch, tmp_path):
+    module = agent("automount_volume")
+    monkeypatch.setattr(module, "METADATA_URL", metadata_service.url)
+    monkeypatch.setattr(module, "MOUNT_PATH", tmp_path / "media" / "volume")
+    monkeypatch.setattr(module, "JOURNAL_SOCKET", str(tmp_path / "no-journal"))
+    monkeypatch.setattr(module, "RUN_PATH", tmp_path / "run")
+    monkeypatch.setattr(module, "STATE_PATH", tmp_path / "state")
+    monkeypatch.setattr(module, "SYSTEMD", module.SystemdMount())
+    return module
+
+
+def test_get_volume_name(bench, automount, metadata_service):
+    assert automount.get_volume_name(DATA_SERIAL) == "data"
+    assert (
+        automount.get_volume_name("0e4a6d3c-5b2f-4c11-9a8e-1f2d3c4b5a69")
+        == "scratch space"
+    )
+
+    bench(lambda: automount.get_volume_name(DATA_SERIAL))
+    assert len(metadata_service.requests) == 1
+
+
+def test_get_volume_name_cache_expires(automount, metadata_service, monkeypatch):
+    assert automount.get_volume_name(DATA_SERIAL) == "data"
+
+    monkeypatch.setattr(automount.VolumeMetadataCache, "TTL_SECONDS", 0)
+    assert automount.get_volume_name(DATA_SERIAL) == "data"
+    assert len(metadata_service.requests) == 2
+
+
+def test_get_volume_name_gives_up_at_deadline(automount, metadata_service):
+    started = time.monotonic()
+    assert (
+        automount.get_volume_name("not-attached", timeout=0.5, default="vdd") == "vdd"
+    )
+    assert 0.5 <= time.monotonic() - started < 1.5
+
+    # The metadata didn't change, so each retry was answered with 304 Not Modified
+    statuses = metadata_service.statuses()
+    assert statuses[0] == 200
+    assert 2 < len(statuses) < 10
+    assert set(statuses[1:]) == {304}
+
+
+def test_get_volume_name_waits_for_tag(automount, metadata_service):
+    threading.Timer(0.3, metadata_service.tag_volume, ["new-volume", "new"]).start()
+    started = time.monotonic()
+    assert automount.get_volume_name("new-volume", timeout=10, default="vdd") == "new"
+    assert time.monotonic() - started < 1
+    assert metadata_service.statuses()[-1] == 200
+
+
+def test_unchanged_metadata_is_not_parsed_again(
+    automount, metadata_service, monkeypatch
+):
+    metadata_service.etags = False
+    parse = automount.parse_volume_metadata
+    parsed = []
+    monkeypatch.setattr(
+        automount,
+        "parse_volume_metadata",
+        lambda body: parsed.append(body) or parse(body),
+    )
+
+    assert automount.get_volume_name("not-attached", timeout=0.3) is None
+    assert set(metadata_service.statuses()) == {200}
+    assert len(metadata_service.requests) > 1
+    assert len(parsed) == 1
+
+
+def test_concurrent_lookups_share_one_refresh(automount, metadata_service):
+    # A slow metadata service, so every lookup misses before the first refresh finishes
+    metadata_service.delay = 0.1
+    serials = [DATA_SERIAL, "3b2a1c0d-4e5f-4a6b-8c7d-9e0f1a2b3c4d"] * 5
+    names = {}
+    threads = [
+        threading.Thread(
+            target=lambda i=i, serial=serial: names.update(
+                {i: automount.get_volume_name(serial)}
+            )
+        )
+        for i, serial in enumerate(serials)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [names[i] for i in range(len(serials))] == ["data", "results"] * 5
+    assert len(metadata_service.requests) == 1
+
+
+def test_do_mount_formatted_volume(bench, automount, commands, metadata_service):
+    commands.add_fixture("udevadm", "udevadm-vdb.txt")
+    commands.add_output("systemd-mount")
+    commands.add_output("chown")
+
+    automount.do_mount(pathlib.Path("/dev/vdb"))
+    programs = [pathlib.Path(argv[0]).name for argv in commands.spawned]
+    # vdb's properties are read from fixtures/run/udev rather than udevadm
+    assert programs == ["systemd-mount", "chown"]
+    assert commands.spawned[1][-1] == str(automount.MOUNT_PATH / "data")
+    assert (automount.MOUNT_PATH / "data").is_dir()
+
+    bench(lambda: automount.do_mount(pathlib.Path("/dev/vdb")))
+
+
+def test_udev_db_matches_udevadm(bench, automount, commands):
+    commands.add_fixture("udevadm", "udevadm-vdb.txt")
+    vdb = pathlib.Path("/dev/vdb")
+
+    assert automount.udev_db_info(vdb) == automount.udevadm_info(vdb)
+
+    bench(lambda: automount.udev_db_info(vdb))
+
+
+def test_device_info_falls_back_to_udevadm(automount, attached, commands):
+    attached.update(vdc=RESULTS_SERIAL)
+    vdc = pathlib.Path("/dev/vdc")
+
+    assert automount.udev_db_info(vdc) is None
+    assert automount.device_info(vdc)["ID_SERIAL_SHORT"] == RESULTS_SERIAL
+    assert automount.get_disk_uuid(vdc) == RESULTS_SERIAL
+    assert [argv[0] for argv in commands.spawned] == ["udevadm"]
+
+
+def test_do_mount_timing_spans(
+    automount, commands, journal, metadata_service, monkeypatch
+):
+    commands.add_fixture("udevadm", "udevadm-vdb.txt")
+    commands.add_output("systemd-mount")
+    commands.add_output("chown")
+    monkeypatch.setattr(automount, "JOURNAL_SOCKET", journal.path)
+
+    automount.do_mount(pathlib.Path("/dev/vdb"))
+    entries = journal.entries()
+    assert [e["EXO_SPAN"] for e in entries] == [
+        "udev",
+        "metadata",
+        "mount",
+        "chown",
+        "attach",
+    ]
+    assert all(e["SYSLOG_IDENTIFIER"] == "automount-volume" for e in entries)
+    assert all(
+        e["EXO_DEVICE"] == "/dev/vdb" and e["EXO_OUTCOME"] == "ok" for e in entries
+    )
+    assert json.loads(entries[2]["MESSAGE"])["mountpoint"] == str(
+        automount.MOUNT_PATH / "data"
+    )
+
+
+def test_do_unmount(bench, automount, commands):
+    commands.add_output("systemd-mount")
+    commands.add_output("rmdir")
+
+    automount.do_unmount(pathlib.Path("/dev/vdb"))
+    assert commands.spawned == [
+        ["/usr/bin/env", "systemd-mount", "--unmount", "/media/volume/data"],
+        ["/usr/bin/rmdir", "/media/volume/data"],
+    ]
+
+    bench(lambda: automount.do_unmount(pathlib.Path("/dev/vdb")))
+
+
+def test_do_mount_formatted_volume_dbus(
+    bench, automount, commands, monkeypatch, systemd_bus
+):
+    monkeypatch.setattr(automount, "SYSTEMD", automount.SystemdDBus(systemd_bus))
+    commands.add_output("chown")
+    mountpoint = automount.MOUNT_PATH / "data"
+    unit = exosphere_systemd.escape_path(str(mountpoint)) + ".mount"
+
+    automount.do_mount(pathlib.Path("/dev/vdb"))
+    assert [argv[0] for argv in commands.spawned] == ["/usr/bin/chown"]
+    assert systemd_bus.methods() == ["StartTransientUnit"]
+    assert systemd_bus.transient[unit] == {
+        "Description": "Volume /dev/vdb",
+        "What": "/dev/vdb",
+        "Where": str(mountpoint),
+        "Options": automount.MOUNT_OPTIONS,
+        "Requires": ["systemd-fsck@dev-vdb.service"],
+        "After": ["systemd-fsck@dev-vdb.service"],
+        "CollectMode": "inactive-or-failed",
+    }
+
+    bench(lambda: automount.do_mount(pathlib.Path("/dev/vdb")))
+
+
+def test_do_unmount_dbus(automount, commands, monkeypatch, systemd_bus):
+    monkeypatch.setattr(automount, "SYSTEMD", automount.SystemdDBus(systemd_bus))
+    commands.add_output("rmdir")
+
+    automount.do_unmount(pathlib.Path("/dev/vdb"))
+    assert systemd_bus.calls == [("StopUnit", "media-volume-data.mount", "replace")]
+    assert commands.spawned == [["/usr/bin/rmdir", "/media/volume/data"]]
+
+    systemd_bus.failing.add("media-volume-data.mount")
+    with pytest.raises(
+        exosphere_systemd.SystemdError, match="media-volume-data.mount: failed"
+    ):
+        automount.do_unmount(pathlib.Path("/dev/vdb"))
+
+
+@pytest.fixture
+def attached(commands):
+    """Fakes udevadm for several attached volumes, given as {kernel name: serial}"""
+
+    template = (FIXTURES / "commands" / "udevadm-vdb.txt").read_text()
+    devices = {}
+
+    def udevadm(argv):
+        name = pathlib.Path(argv[-1]).name
+        return template.replace("vdb", name).replace(DATA_SERIAL, devices[name])
+
+    commands.add("udevadm", udevadm)
+    commands.add_output("systemd-mount")
+    commands.add_output("chown")
+    commands.add_output("e2label")
+    return devices
+
+
+def test_mount_batch(
+    bench, automount, attached, commands, metadata_service, monkeypatch
+):
+    monkeypatch.setattr(automount, "METADATA_TIMEOUT_SECONDS", 0)
+    metadata_service.tag_volume("another-data-volume", "data")
+    attached.update(
+        vdc=DATA_SERIAL, vdd=RESULTS_SERIAL, vde="not-tagged", vdf="another-data-volume"
+    )
+    devices = [pathlib.Path(f"/dev/{name}") for name in attached]
+
+    results = automount.mount_batch(devices)
+    assert results == {device: "mounted" for device in devices}
+    assert len(metadata_service.requests) == 1
+
+    mounted = {
+        argv[-2]: argv[-1] for argv in commands.spawned if argv[0] == "systemd-mount"
+    }
+    assert mounted == {
+        "/dev/vdc": str(automount.MOUNT_PATH / "data"),
+        "/dev/vdd": str(automount.MOUNT_PATH / "results"),
+        "/dev/vde": str(automount.MOUNT_PATH / "vde"),
+        "/dev/vdf": str(automount.MOUNT_PATH / "data-1"),
+    }
+
+    bench(lambda: automount.mount_batch(devices), rounds=20)
+
+
+@pytest.fixture
+def device_nodes(monkeypatch):
+    """Devices under /dev that exist, as far as the agents can tell"""
+
+    nodes = set()
+    real_exists = os.path.exists
+    monkeypatch.setattr(
+        os.path,
+        "exists",
+        lambda path: (
+            os.fspath(path) in nodes
+            if os.fspath(path).startswith("/dev/")
+            else real_exists(path)
+        ),
+    )
+    return nodes
+
+
+def test_coalesced_attach_storm(
+    automount, attached, commands, device_nodes, metadata_service, monkeypatch
+):
+    # A slow metadata service, so runs that didn't make the first batch queue up behind it
+    metadata_service.delay = 0.1
+    names = [f"vd{letter}" for letter in "cdefghij"]
+    for i, name in enumerate(names):
+        attached[name] = f"serial-{name}"
+        device_nodes.add(f"/dev/{name}")
+        metadata_service.tag_volume(f"serial-{name}", "data" if i % 2 else "results")
+
+    started = time.monotonic()
+    threads = [
+        threading.Timer(
+            0.02 * i, automount.do_mount_coalesced, [pathlib.Path(f"/dev/{name}")]
+        )
+        for i, name in enumerate(names)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.monotonic() - started
+    assert elapsed < 2 * automount.COALESCE_WINDOW_SECONDS + 0.5
+    assert len(metadata_service.requests) == 1
+    mountpoints = [argv[-1] for argv in commands.spawned if argv[0] == "systemd-mount"]
+    assert len(mountpoints) == len(set(mountpoints)) == len(names)
+    assert not list((automount.RUN_PATH / "attach-queue").iterdir())
+
+
+def test_coalesced_attach_skips_stale_entries(
+    automount, attached, commands, device_nodes
+):
+    attached.update(vdc=DATA_SERIAL, vdd=RESULTS_SERIAL)
+    device_nodes.update(["/dev/vdc", "/dev/vdd"])
+    queue = automount.RUN_PATH / "attach-queue"
+    queue.mkdir(parents=True)
+    # Left by a run that was killed (no process has a pid above the kernel's limit of 2^22),
+    # and by one whose device was detached again while it waited
+    (queue / "vdc").write_text(json.dumps({"device": "/dev/vdc", "pid": 2**22 + 1}))
+    (queue / "vde").write_text(json.dumps({"device": "/dev/vde", "pid": os.getpid()}))
+
+    automount.do_mount_coalesced(pathlib.Path("/dev/vdd"))
+
+    assert list(mounted_at(commands)) == ["/dev/vdd"]
+    assert not (queue / "vdc").exists()
+    assert json.loads((queue / "vde").read_text())["result"] == "skipped"
+
+
+def test_coalesced_attach_of_detached_device(automount, commands, device_nodes):
+    # The device is gone by the end of the window, and nothing else was queued
+    assert automount.do_mount_coalesced(pathlib.Path("/dev/vdd")) == 2
+    assert commands.spawned == []
+    assert not list((automount.RUN_PATH / "attach-queue").iterdir())
+
+
+def test_coalesced_attach_failure_is_recorded(
+    automount, attached, commands, device_nodes, monkeypatch
+):
+    attached.update(vdc=DATA_SERIAL)
+    device_nodes.update(["/dev/vdc", "/dev/vdd"])
+    queue = automount.RUN_PATH / "attach-queue"
+    queue.mkdir(parents=True)
+    (queue / "vdc").write_text(json.dumps({"device": "/dev/vdc", "pid": os.getpid()}))
+
+    def fail(devices):
+        raise OSError("metadata service unreachable")
+
+    monkeypatch.setattr(automount, "mount_batch", fail)
+    with pytest.raises(OSError):
+        automount.do_mount_coalesced(pathlib.Path("/dev/vdd"))
+
+    # The other queued run finds its result instead of mounting the device itself
+    assert not (queue / "vdd").exists()
+    assert json.loads((queue / "vdc").read_text())["result"] == "failed"
+
+
+def mounted_at(commands) -> t.Dict[str, str]:
+    return {
+        argv[-2]: argv[-1] for argv in commands.spawned if argv[0] == "systemd-mount"
+    }
+
+
+def test_concurrent_mounts_get_distinct_mountpoints(
+    automount, attached, commands, monkeypatch
+):
+    names = [f"vd{letter}" for letter in "cdefghij"]
+    attached.update({name: f"serial-{name}" for name in names})
+    # Every volume has the same name
+    monkeypatch.setattr(
+        automount, "get_volume_metadata", lambda uuid, **kwargs: {"name": "data"}
+    )
+
+    threads = [
+        threading.Thread(target=automount.do_mount, args=[pathlib.Path(f"/dev/{name}")])
+        for name in names
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    mountpoints = list(mounted_at(commands).values())
+    assert len(mountpoints) == len(set(mountpoints)) == len(names)
+
+
+def test_reattached_volume_keeps_mountpoint(automount, attached, commands, monkeypatch):
+    attached.update(vdc=DATA_SERIAL, vdd="another-data-volume")
+    monkeypatch.setattr(
+        automount, "get_volume_metadata", lambda uuid, **kwargs: {"name": "data"}
+    )
+    data = automount.MOUNT_PATH / "data"
+
+    automount.do_mount(pathlib.Path("/dev/vdd"))
+    automount.do_mount(pathlib.Path("/dev/vdc"))
+    assert mounted_at(commands) == {"/dev/vdd": str(data), "/dev/vdc": f"{data}-1"}
+
+    # After a reboot, the first volume back keeps its mount point rather than taking "data"
+    monkeypatch.setattr(automount, "read_boot_id", lambda: "next-boot")
+    commands.spawned.clear()
+    automount.do_mount(pathlib.Path("/dev/vdc"))
+    automount.do_mount(pathlib.Path("/dev/vdd"))
+    assert mounted_at(commands) == {"/dev/vdc": f"{data}-1", "/dev/vdd": str(data)}
+
+
+def test_unmounted_volume_releases_mountpoint(
+    automount, attached, commands, monkeypatch
+):
+    attached.update(vdc="another-data-volume")
+    monkeypatch.setattr(
+        automount, "get_volume_metadata", lambda uuid, **kwargs: {"name": "data"}
+    )
+    commands.add_output("rmdir")
+
+    # vdb is mounted at /media/volume/data in fixtures/proc/mounts
+    with automount.MountpointIndex() as index:
+        index.entries[DATA_SERIAL] = {
+            "mountpoint": "/media/volume/data",
+            "boot": index.boot_id,
+        }
+        index.changed = True
+
+    automount.do_unmount(pathlib.Path("/dev/vdb"))
+    with automount.MountpointIndex() as index:
+        assert index.entries[DATA_SERIAL]["boot"] is None
+
+
+def test_mountpoint_index_unlocks_on_error(automount, monkeypatch):
+    def unreadable(device=None):
+        raise PermissionError("/proc/mounts")
+
+    monkeypatch.setattr(automount, "get_mounts", unreadable)
+    index = automount.MountpointIndex()
+    with pytest.raises(PermissionError):
+        with index:
+            pass
+
+    assert index.lock_file.closed
+    with open(automount.RUN_PATH / "mountpoints.lock") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def new_volume(automount, name="vdc", **metadata) -> "automount.Volume":
+    device = pathlib.Path(f"/dev/{name}")
+    return automount.Volume(
+        device,
+        {
+            "DEVNAME": str(device),
+            "DEVTYPE": "disk",
+            "ID_SERIAL_SHORT": f"serial-{name}",
+        },
+        metadata.get("name", "data"),
+        automount.MOUNT_PATH / metadata.get("name", "data"),
+        {"name": "data", **metadata},
+    )
+
+
+def test_mkfs_command_from_tag(automount):
+    ext4 = automount.mkfs_command(new_volume(automount))
+    assert ext4[0] == "mkfs.ext4"
+    assert "nodiscard,lazy_itable_init=1,lazy_journal_init=1" in ext4
+    assert "-T" not in ext4
+
+    large = automount.mkfs_command(new_volume(automount, profile="largefile"))
+    assert large[-3:] == ["-T", "largefile", "/dev/vdc"]
+
+    xfs = automount.mkfs_command(
+        new_volume(automount, filesystem="xfs", profile="smallfiles")
+    )
+    assert xfs == [
+        "mkfs.xfs",
+        "-L",
+        "data",
+        "-m",
+        "uuid=serial-vdc",
+        "-K",
+        "-i",
+        "maxpct=50",
+        "/dev/vdc",
+    ]
+
+    # Anything unsupported gets the defaults
+    unsupported = new_volume(automount, filesystem="btrfs", profile="turbo")
+    assert automount.volume_format(unsupported) == ("ext4", "default")
+
+
+def test_format_progress_and_lazy_init(automount, commands, capsys, monkeypatch):
+    statuses = []
+    fixture = (FIXTURES / "commands" / "mkfs.ext4.txt").read_text()
+    status_path = automount.RUN_PATH / "format" / "vdc.json"
+
+    def mkfs(argv):
+        return fixture
+
+    commands.add("mkfs.ext4", mkfs)
+    commands.add_output("systemd-mount")
+    commands.add_output("chown")
+    record = automount.FormatStatus.update
+
+    def update(self, force=True, **status):
+        statuses.append(dict(self.status, **status))
+        record(self, force=True, **status)
+
+    volume = new_volume(automount)
+    monkeypatch.setattr(automount.FormatStatus, "update", update)
+    monkeypatch.setattr(
+        automount, "lazy_init_pending", lambda device: device == volume.device
+    )
+    automount.format_and_mount(volume, volume.mountpoint)
+
+    steps = [(s["step"], s.get("done"), s.get("total")) for s in statuses]
+    assert steps[0] == ("starting", None, None)
+    assert ("Writing inode tables", 7, 8) in steps
+    assert steps[-1][0] == "mounted"
+
+    assert json.loads(status_path.read_text())["lazy_init"] is True
+    automount.format_status()
+    (status,) = json.loads(capsys.readouterr().out)
+    assert status["device"] == "/dev/vdc"
+    assert status["mountpoint"] == str(volume.mountpoint)
+
+
+def ext4_image(path: pathlib.Path, zeroed: t.List[bool], checksums: bool = True):
+    """Writes the superblock and group descriptors of a 64-bit ext4 filesystem"""
+
+    superblock = bytearray(1024)
+    struct.pack_into("<I", superblock, 0x04, 32768 * len(zeroed))  # Blocks
+    struct.pack_into("<I", superblock, 0x18, 2)  # 4 KiB blocks
+    struct.pack_into("<I", superblock, 0x20, 32768)  # Blocks per group
+    struct.pack_into("<H", superblock, 0x38, 0xEF53)
+    struct.pack_into("<I", superblock, 0x60, 0x80)  # 64bit
+    struct.pack_into("<I", superblock, 0x64, 0x400 if checksums else 0)
+    struct.pack_into("<H", superblock, 0xFE, 64)  # Descriptor size
+    descriptors = bytearray(64 * len(zeroed))
+    for group, is_zeroed in enumerate(zeroed):
+        # INODE_UNINIT, and ITABLE_ZEROED once lazy init has reached the group
+        struct.pack_into(
+            "<H", descriptors, 64 * group + 0x12, 0x5 if is_zeroed else 0x1
+        )
+    path.write_bytes(bytes(1024) + superblock + bytes(2048) + descriptors)
+    return path
+
+
+def test_lazy_init_pending(automount, tmp_path):
+    pending = ext4_image(tmp_path / "pending", [True, False, True])
+    assert automount.lazy_init_pending(pending) is True
+    done = ext4_image(tmp_path / "done", [True, True, True])
+    assert automount.lazy_init_pending(done) is False
+    # Without group checksums every inode table was zeroed by mkfs
+    old = ext4_image(tmp_path / "old", [False], checksums=False)
+    assert automount.lazy_init_pending(old) is False
+
+    (tmp_path / "xfs").write_bytes(b"XFSB" + bytes(4092))
+    assert automount.lazy_init_pending(tmp_path / "xfs") is None
+    assert automount.lazy_init_pending(tmp_path / "detached") is None
+
+
+def test_batch_formats_concurrently(automount, commands, monkeypatch):
+    names = ["vdc", "vdd", "vde", "vdf"]
+    volumes = {
+        pathlib.Path(f"/dev/{name}"): new_volume(automount, name) for name in names
+    }
+
+    def mkfs(argv):
+        time.sleep(0.2)
+        return ""
+
+    commands.add("mkfs.ext4", mkfs)
+    commands.add_output("systemd-mount")
+    commands.add_output("chown")
+    monkeypatch.setattr(
+        automount, "resolve_volume", lambda device, since=None: volumes[device]
+    )
+
+    started = time.monotonic()
+    results = automount.mount_batch(list(volumes))
+    assert set(results.values()) == {"mounted"}
+    assert time.monotonic() - started < 0.2 * len(names) / 2
@@ -0,0 +1,90 @@
+import json
+import random
+import shutil
+import subprocess
+
+import exosphere_systemd
+import pytest
+from conftest import FIXTURES
+
+ESCAPE_CORPUS = json.loads((FIXTURES / "systemd-escape.json").read_text())
+
+
+@pytest.mark.parametrize("path, escaped", ESCAPE_CORPUS)
+def test_escape_path_corpus(path, escaped):
+    assert exosphere_systemd.escape_path(path) == escaped
+
+
+def random_paths(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    alphabet = "abcXYZ019-_.:/ \\\t%@~'éü日😀"
+    for _ in range(count):
+        path = "/" + "".join(rng.choice(alphabet) for _ in range(rng.randrange(1, 24)))
+        # systemd-escape refuses to escape paths that aren't normalized
+        if ".." not in path.split("/"):
+            yield path
+
+
+@pytest.mark.skipif(
+    shutil.which("systemd-escape") is None, reason="systemd-escape isn't installed"
+)
+def test_escape_path_matches_systemd_escape():
+    paths = list(random_paths(2000))
+    expected = subprocess.run(
+        ["systemd-escape", "--path", "--", *paths],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.split()
+
+    assert [exosphere_systemd.escape_path(path) for path in paths] == expected
+
+
+def test_escape_path_rejects_parent_directories():
+    with pytest.raises(ValueError):
+        exosphere_systemd.escape_path("/media/share/../etc")
+
+
+def test_escape_path_cached(bench):
+    paths = [f"/media/share/share-{i}" for i in range(12)]
+
+    bench(lambda: [exosphere_systemd.escape_path(path) for path in paths], rounds=1000)
+
+
+class JobRemoved:
+    """The parameters of a JobRemoved signal: the job's id and path, its unit, and its result"""
+
+    def __init__(self, job: str, unit: str, result: str):
+        self.values = (int(job.rsplit("/", 1)[1]), job, unit, result)
+
+    def unpack(self) -> tuple:
+        return self.values
+
+
+def test_manager_bus_keeps_only_awaited_jobs():
+    bus = exosphere_systemd.ManagerBus(connection=None)
+    bus.call = lambda method, signature, *args: ("/org/freedesktop/systemd1/job/7",)
+
+    def job_removed(job: str, unit: str, result: str):
+        bus._job_removed(
+            None, None, None, None, "JobRemoved", JobRemoved(job, unit, result)
+        )
+
+    job = bus.start_job("StartUnit", "ss", "media-share-a.mount", "replace")
+    # Other clients' jobs, which are announced to every subscriber
+    for i in range(100):
+        job_removed(f"/org/freedesktop/systemd1/job/{100 + i}", "other.service", "done")
+    assert bus.awaited == {job: None}
+
+    job_removed(job, "media-share-a.mount", "failed")
+    assert bus.wait([job], timeout=1) == {job: "failed"}
+    assert bus.awaited == {}
+
+
+def test_manager_bus_wait_timeout():
+    bus = exosphere_systemd.ManagerBus(connection=None)
+    bus.call = lambda method, signature, *args: ("/org/freedesktop/systemd1/job/7",)
+
+    job = bus.start_job("StopUnit", "ss", "media-share-a.mount", "replace")
+    assert bus.wait([job], timeout=0.01) == {job: "timeout"}
+    assert bus.awaited == {}
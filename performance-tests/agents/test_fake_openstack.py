@@ -0,0 +1,212 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from conftest import load_agent
+
+PROJECT_ID = "44359c085e124766bad6e2c69d867291"
+
+
+@pytest.fixture(scope="module")
+def fake_openstack():
+    return load_agent("fake_openstack")
+
+
+@pytest.fixture(scope="module")
+def system_load():
+    return load_agent("system_load")
+
+
+class Client:
+    def __init__(self, url: str):
+        self.url = url
+        self.token = None
+
+    def request(self, method, path, body=None, headers=None):
+        request = urllib.request.Request(
+            self.url + path,
+            method=method,
+            data=None if body is None else json.dumps(body).encode(),
+            headers={"Content-Type": "application/json", **(headers or {})},
+        )
+        if self.token:
+            request.add_header("X-Auth-Token", self.token)
+        try:
+            with urllib.request.urlopen(request) as response:
+                content = response.read()
+                return response.status, json.loads(content) if content else None
+        except urllib.error.HTTPError as error:
+            return error.code, json.loads(error.read())
+
+    def log_in(self, scope=None, headers=None):
+        auth = {
+            "identity": {
+                "methods": ["password"],
+                "password": {
+                    "user": {
+                        "name": "demo",
+                        "domain": {"name": "access"},
+                        "password": "x",
+                    }
+                },
+            }
+        }
+        if scope:
+            auth["scope"] = {"project": scope}
+        request = urllib.request.Request(
+            self.url + "/v3/auth/tokens",
+            method="POST",
+            data=json.dumps({"auth": auth}).encode(),
+            headers={"Content-Type": "application/json", **(headers or {})},
+        )
+        with urllib.request.urlopen(request) as response:
+            self.token = response.headers["X-Subject-Token"]
+            return json.loads(response.read())["token"]
+
+    def console_output(self, server_id, length=None):
+        status, body = self.request(
+            "POST",
+            f"/compute/v2.1/servers/{server_id}/action",
+            {"os-getConsoleOutput": {} if length is None else {"length": length}},
+        )
+        assert status == 200
+        return body["output"].splitlines()
+
+
+@pytest.fixture
+def serve(fake_openstack):
+    servers = []
+
+    def start(**config):
+        latency = config.pop("service_latency", None)
+        cloud = fake_openstack.Cloud(fake_openstack.CloudConfig(**config))
+        server = fake_openstack.FakeOpenStackServer(
+            ("127.0.0.1", 0), cloud, service_latency=latency, quiet=True
+        )
+        threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True).start()
+        servers.append(server)
+        return Client(f"http://127.0.0.1:{server.server_address[1]}")
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_log_in(serve):
+    client = serve(servers=3)
+    token = client.log_in()
+    assert "catalog" not in token
+    status, body = client.request("GET", "/v3/auth/projects")
+    assert [p["name"] for p in body["projects"]] == ["INI210003"]
+
+    token = client.log_in(scope={"id": PROJECT_ID})
+    catalog = {service["type"]: service for service in token["catalog"]}
+    assert catalog["compute"]["endpoints"][0]["url"] == client.url + "/compute/v2.1"
+    assert catalog["volumev3"]["endpoints"][0]["url"].endswith(PROJECT_ID)
+
+    status, body = client.request("GET", "/compute/v2.1/servers/detail")
+    assert status == 200 and len(body["servers"]) == 3
+
+    client.token = "expired"
+    assert client.request("GET", "/compute/v2.1/servers/detail")[0] == 401
+
+
+def test_log_in_through_proxy(serve):
+    client = serve(servers=0)
+    token = client.log_in(
+        scope={"name": "INI210003", "domain": {"name": "access"}},
+        headers={
+            "exo-proxy-orig-host": "js2.jetstream-cloud.org",
+            "exo-proxy-orig-port": "5000",
+        },
+    )
+    # The catalog keeps the cloud's host name, for Exosphere to find its configuration
+    assert {
+        endpoint["url"]
+        for service in token["catalog"]
+        for endpoint in service["endpoints"]
+        if service["type"] == "identity"
+    } == {"https://js2.jetstream-cloud.org:5000/v3"}
+
+    status, body = client.request(
+        "GET",
+        "/proxy/image/v2/images?limit=999999&visibility=public",
+        headers={"exo-proxy-orig-host": "js2.jetstream-cloud.org"},
+    )
+    assert "Featured-Ubuntu22" in {image["name"] for image in body["images"]}
+
+
+@pytest.mark.parametrize("console_format", ["full", "compact"])
+def test_console_output(serve, system_load, console_format):
+    client = serve(
+        servers=5, console_records=100, console_format=console_format, batch_size=10
+    )
+    client.log_in(scope={"id": PROJECT_ID})
+    servers = client.request("GET", "/compute/v2.1/servers/detail")[1]["servers"]
+    server = next(s for s in servers if s["status"] == "ACTIVE")
+
+    lines = client.console_output(server["id"])
+    records = [record for line in lines for record in system_load.decode_line(line)]
+    # The compact format only has whole batches, so a batch may be cut off at either end
+    assert 100 - 2 * 9 <= len(records) <= 100
+    assert all(b["epoch"] - a["epoch"] == 60 for a, b in zip(records, records[1:]))
+    assert all(0 <= r["cpuPctUsed"] <= 100 for r in records)
+    assert any('"status":"complete"' in line for line in lines)
+    # Exosphere skips the time since boot written before each record
+    assert all(line.startswith("[") for line in lines if '"cpuPctUsed"' in line)
+
+    last = client.console_output(server["id"], length=3)
+    assert last == lines[-3:]
+
+
+def test_launch_instance(serve):
+    client = serve(servers=0, build_seconds=0.2, setup_seconds=0.4)
+    client.log_in(scope={"id": PROJECT_ID})
+    flavor = client.request("GET", "/compute/v2.1/flavors/detail")[1]["flavors"][0]
+    status, body = client.request(
+        "POST",
+        "/compute/v2.1/servers",
+        {
+            "server": {
+                "name": "ubuntu-test",
+                "flavorRef": flavor["id"],
+                "imageRef": "image",
+                "metadata": {"exoSetup": "waiting"},
+            }
+        },
+    )
+    assert status == 202
+    server_id = body["server"]["id"]
+
+    server = client.request("GET", f"/compute/v2.1/servers/{server_id}")[1]["server"]
+    assert server["status"] == "BUILD"
+    assert client.console_output(server_id) == []
+
+    time.sleep(0.8)
+    server = client.request("GET", f"/compute/v2.1/servers/{server_id}")[1]["server"]
+    assert server["status"] == "ACTIVE"
+    assert any(
+        '"status":"complete"' in line for line in client.console_output(server_id)
+    )
+    ports = client.request("GET", "/network/v2.0/ports")[1]["ports"]
+    assert [p["device_id"] for p in ports] == [server_id]
+
+    status, _ = client.request("DELETE", f"/compute/v2.1/servers/{server_id}")
+    assert status == 204
+    assert client.request("GET", "/compute/v2.1/servers/detail")[1]["servers"] == []
+
+
+def test_service_latency(serve):
+    client = serve(servers=1, service_latency={"compute": 200})
+    started = time.perf_counter()
+    client.log_in(scope={"id": PROJECT_ID})
+    assert time.perf_counter() - started < 0.2
+
+    started = time.perf_counter()
+    client.request("GET", "/compute/v2.1/servers/detail")
+    assert time.perf_counter() - started >= 0.2
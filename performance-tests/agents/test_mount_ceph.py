@@ -0,0 +1,358 @@
+import io
+import json
+import pathlib
+
+import pytest
+from conftest import CommandResult
+
+SHARE_PATH = "10.0.0.5:6789,10.0.0.6:6789:/volumes/_nogroup/share-a"
+
+
+@pytest.fixture
+def mount_ceph(agent, monkeypatch, tmp_path):
+    module = agent("mount_ceph")
+    monkeypatch.setattr(module, "SYSTEMD_PATH", tmp_path)
+    monkeypatch.setattr(module, "JOURNAL_SOCKET", str(tmp_path / "no-journal"))
+    monkeypatch.setattr(module, "SYSTEMD", module.Systemctl())
+    return module
+
+
+@pytest.fixture
+def mount_ceph_dbus(mount_ceph, monkeypatch, systemd_bus):
+    monkeypatch.setattr(
+        mount_ceph, "SYSTEMD", mount_ceph.exosphere_systemd.SystemdDBus(systemd_bus)
+    )
+    return mount_ceph
+
+
+def test_do_mount(bench, mount_ceph, commands, tmp_path):
+    commands.add_output("systemctl")
+
+    mount_ceph.do_mount("results", SHARE_PATH, "exouser", "c2VjcmV0")
+    mount_unit = (tmp_path / "media-share-results.mount").read_text()
+    assert f"What={SHARE_PATH}" in mount_unit
+    assert (
+        "Options=noatime,rw,_netdev,auto,nofail,name=exouser,secret=c2VjcmV0"
+        in mount_unit
+    )
+    assert (tmp_path / "media-share-results.service").exists()
+    assert [argv[0] for argv in commands.spawned] == ["systemctl"]
+
+    bench(lambda: mount_ceph.do_mount("results", SHARE_PATH, "exouser", "c2VjcmV0"))
+
+
+def test_do_unmount_busy_share(bench, mount_ceph, commands, tmp_path):
+    (tmp_path / "media-share-results.mount").write_text("")
+    commands.add_output(
+        "systemctl", stderr="Job for media-share-results.mount failed.\n", returncode=1
+    )
+
+    def unmount():
+        with pytest.raises(SystemExit):
+            mount_ceph.do_unmount("results")
+
+    unmount()
+    assert (tmp_path / "media-share-results.mount").exists()
+    # Stopping failed, so the units' states are read to see which
+    assert [argv[:2] for argv in commands.spawned] == [
+        ["systemctl", "disable"],
+        ["systemctl", "show"],
+    ]
+
+    bench(unmount)
+
+
+def test_do_unmount_timing_spans(mount_ceph, commands, journal, monkeypatch, tmp_path):
+    (tmp_path / "media-share-results.mount").write_text("")
+    commands.add_output("systemctl")
+    monkeypatch.setattr(mount_ceph, "JOURNAL_SOCKET", journal.path)
+
+    mount_ceph.do_unmount("results")
+    entries = journal.entries()
+    assert [(e["EXO_SPAN"], e.get("EXO_ACTION")) for e in entries] == [
+        ("escape", None),
+        ("systemd", "stop"),
+        ("systemd", "reload"),
+        ("unmount", None),
+    ]
+    assert all(
+        e["SYSLOG_IDENTIFIER"] == "mount_ceph" and e["EXO_SHARE"] == "results"
+        for e in entries
+    )
+
+
+def test_iter_open_files(bench, mount_ceph):
+    open_files = list(mount_ceph.iter_open_files(pathlib.Path("/media/share/results")))
+    assert [(f.pid, f.command, f.fd, f.name) for f in open_files] == [
+        (2011, "bash", "cwd", "/media/share/results"),
+        (2388, "python3", "3", "/media/share/results/run-01/output.csv"),
+        (2388, "python3", "4", "/media/share/results/run-01/log.txt"),
+        (2388, "python3", "10", "/media/share/results/run-01/old log.txt (deleted)"),
+        (
+            2388,
+            "python3",
+            "mem",
+            "/media/share/results/venv/lib/python3.10/site-packages/numpy/core/_multiarray_umath.cpython-310-x86_64-linux-gnu.so",
+        ),
+        (2388, "python3", "mem", "/media/share/results/run-01/weights 2.bin"),
+        (2390, "tail", "3", "/media/share/results/run-01/log.txt"),
+    ]
+
+    bench(
+        lambda: list(mount_ceph.iter_open_files(pathlib.Path("/media/share/results")))
+    )
+
+
+def test_iter_open_files_timeout(mount_ceph, caplog):
+    open_files = mount_ceph.iter_open_files(pathlib.Path("/media/share"), timeout=-1)
+
+    assert list(open_files) == []
+    assert "Stopped looking for open files after -1s" in caplog.text
+
+
+class FakeSystemctl:
+    """Starts and stops units instantly, except those that are told to fail"""
+
+    def __init__(self, failing=()):
+        self.active = set()
+        self.failing = set(failing)
+
+    def __call__(self, argv):
+        units = [arg for arg in argv[2:] if not arg.startswith("-")]
+        if argv[1] == "show":
+            return "\n".join(
+                f"Id={unit}\nActiveState={self.state(unit)}\nResult={'exit-code' if unit in self.failing else 'success'}\n"
+                for unit in units
+            )
+        if argv[1] == "enable":
+            self.active |= set(units) - self.failing
+        if argv[1] == "disable":
+            self.active -= set(units) - self.failing
+        if self.failing & set(units):
+            return CommandResult("", "Job failed.\n", 1)
+        return ""
+
+    def state(self, unit):
+        if unit in self.active:
+            return "active"
+        return "failed" if unit in self.failing else "inactive"
+
+
+def batch(mount_ceph, shares):
+    return mount_ceph.do_batch(io.StringIO(json.dumps(shares)))
+
+
+def test_batch(bench, capsys, mount_ceph, commands, tmp_path):
+    systemctl = FakeSystemctl()
+    systemctl.active.add("media-share-scratch.mount")
+    commands.add("systemctl", systemctl)
+    (tmp_path / "media-share-scratch.mount").write_text("")
+    (tmp_path / "media-share-scratch.service").write_text("")
+    shares = [
+        {
+            "share_name": f"share_{i}",
+            "share_path": SHARE_PATH,
+            "access_rule_name": "exouser",
+            "access_rule_key": "c2VjcmV0",
+        }
+        for i in range(12)
+    ] + [
+        {"action": "unmount", "share_name": "scratch"},
+        {"share_name": "../etc", "share_path": SHARE_PATH},
+    ]
+
+    with pytest.raises(SystemExit):
+        batch(mount_ceph, shares)
+    summary = json.loads(capsys.readouterr().out)
+    assert (summary["ok"], summary["failed"]) == (13, 1)
+    assert (
+        summary["shares"][-1]["error"]
+        == "Invalid share: share_name may not contain '/'"
+    )
+    assert summary["shares"][12] == {
+        "share_name": "scratch",
+        "action": "unmount",
+        "ok": True,
+        "mount_point": "/media/share/scratch",
+    }
+    assert len(list(tmp_path.glob("*.mount"))) == 12
+    assert systemctl.active == {f"media-share-share_{i}.mount" for i in range(12)} | {
+        f"media-share-share_{i}.service" for i in range(12)
+    }
+    # Stop, then enable and start, which reloads once the new units are linked
+    assert [argv[:2] for argv in commands.spawned] == [
+        ["systemctl", "disable"],
+        ["systemctl", "enable"],
+    ]
+    assert "--no-reload" not in commands.spawned[-1]
+
+    bench(lambda: batch(mount_ceph, shares[:12]))
+
+
+def test_batch_reports_each_share(capsys, mount_ceph, commands):
+    commands.add("systemctl", FakeSystemctl(failing={"media-share-broken.mount"}))
+
+    with pytest.raises(SystemExit):
+        batch(
+            mount_ceph,
+            [
+                {"share_name": "results", "share_path": SHARE_PATH},
+                {"share_name": "broken", "share_path": SHARE_PATH},
+            ],
+        )
+    results = json.loads(capsys.readouterr().out)["shares"]
+    assert [(r["share_name"], r["ok"]) for r in results] == [
+        ("results", True),
+        ("broken", False),
+    ]
+    assert results[1]["error"] == "Couldn't start media-share-broken.mount (exit-code)"
+
+
+def test_check_escape(caplog, mount_ceph, commands, monkeypatch):
+    commands.add_output("systemd-escape", "media-share-a media-share-b\\x2d\n")
+    monkeypatch.setattr(mount_ceph, "CHECK_ESCAPE", True)
+
+    escaped = mount_ceph.systemd_escape_paths(["/media/share/a", "/media/share/b-"])
+    assert escaped == ["media-share-a", "media-share-b\\x2d"]
+    assert [argv[0] for argv in commands.spawned] == ["systemd-escape"]
+    assert not caplog.records
+
+    commands.add_output("systemd-escape", "media-share-c\n")
+    assert mount_ceph.systemd_escape_paths(["/media/share/d"]) == ["media-share-c"]
+    assert "systemd-escape gives 'media-share-c'" in caplog.text
+
+
+def test_without_exosphere_systemd(mount_ceph, commands, monkeypatch):
+    # As when the script is piped from curl onto an instance Exosphere didn't set up
+    monkeypatch.setattr(mount_ceph, "exosphere_systemd", None)
+    monkeypatch.setattr(mount_ceph, "SYSTEMD", None)
+    commands.add_output("systemd-escape", "media-share-a\n")
+
+    assert mount_ceph.systemd_escape_paths(["/media/share/a"]) == ["media-share-a"]
+    assert [argv[0] for argv in commands.spawned] == ["systemd-escape"]
+    assert isinstance(mount_ceph.systemd(), mount_ceph.Systemctl)
+
+
+def test_do_mount_dbus(bench, mount_ceph_dbus, commands, systemd_bus):
+    mount_ceph_dbus.do_mount("results", SHARE_PATH, "exouser", "c2VjcmV0")
+    assert systemd_bus.methods() == [
+        "EnableUnitFiles",
+        "Reload",
+        "StartUnit",
+        "StartUnit",
+    ]
+    assert systemd_bus.active == {
+        "media-share-results.mount",
+        "media-share-results.service",
+    }
+    assert commands.spawned == []
+
+    bench(lambda: mount_ceph_dbus.do_mount("results", SHARE_PATH))
+
+
+def test_do_unmount_busy_share_dbus(mount_ceph_dbus, systemd_bus, tmp_path):
+    (tmp_path / "media-share-results.mount").write_text("")
+    systemd_bus.failing.add("media-share-results.mount")
+
+    with pytest.raises(SystemExit):
+        mount_ceph_dbus.do_unmount("results")
+    assert systemd_bus.methods() == ["DisableUnitFiles", "StopUnit", "StopUnit"]
+    assert (tmp_path / "media-share-results.mount").exists()
+
+
+def test_batch_dbus(capsys, mount_ceph_dbus, commands, systemd_bus):
+    systemd_bus.failing.add("media-share-broken.mount")
+    shares = [
+        {"share_name": f"share_{i}", "share_path": SHARE_PATH} for i in range(12)
+    ] + [{"share_name": "broken", "share_path": SHARE_PATH}]
+
+    with pytest.raises(SystemExit):
+        batch(mount_ceph_dbus, shares)
+    summary = json.loads(capsys.readouterr().out)
+    assert (summary["ok"], summary["failed"]) == (12, 1)
+    assert summary["shares"][-1]["error"] == (
+        "Couldn't start media-share-broken.mount (failed)"
+    )
+    # One reload after enabling, and every unit's job queued before waiting for any
+    assert systemd_bus.methods() == ["EnableUnitFiles", "Reload"] + ["StartUnit"] * 26
+    assert commands.spawned == []
+
+
+def test_mount_options(mount_ceph):
+    assert mount_ceph.mount_options(
+        "metadata-heavy", ["wsync", "ms_mode=secure"], "exouser", "c2VjcmV0"
+    ) == [
+        "noatime",
+        "rw",
+        "_netdev",
+        "auto",
+        "nofail",
+        "readdir_max_entries=8192",
+        "readdir_max_bytes=4194304",
+        "dcache",
+        "wsync",
+        "ms_mode=secure",
+        "name=exouser",
+        "secret=c2VjcmV0",
+    ]
+    assert "rsize=1048576" in mount_ceph.mount_options("streaming", ["rsize=1048576"])
+
+
+@pytest.mark.parametrize(
+    "profile, options, error",
+    [
+        ("fast", [], "Unknown profile 'fast'"),
+        ("default", ["rsize=1000"], "rsize must be a multiple of 4096 up to 64 MiB"),
+        ("default", ["recover_session=yes"], "recover_session must be no or clean"),
+        ("default", ["secret=c2VjcmV0"], "'secret' can't be set for a share"),
+        ("default", ["nowsync=1"], "'nowsync' can't be set for a share"),
+    ],
+)
+def test_mount_options_validated(mount_ceph, profile, options, error):
+    with pytest.raises(ValueError, match=error):
+        mount_ceph.mount_options(profile, options)
+
+
+def test_fsc_needs_cachefilesd(mount_ceph, monkeypatch):
+    monkeypatch.setattr(mount_ceph.shutil, "which", lambda program: None)
+    with pytest.raises(ValueError, match="fsc needs cachefilesd"):
+        mount_ceph.mount_options("default", ["fsc"])
+
+    monkeypatch.setattr(mount_ceph.shutil, "which", lambda program: "/sbin/" + program)
+    assert "fsc" in mount_ceph.mount_options("default", ["fsc"])
+
+
+def test_do_mount_with_profile(mount_ceph, commands, tmp_path):
+    commands.add_output("systemctl")
+
+    mount_ceph.do_mount(
+        "results", SHARE_PATH, profile="streaming", options=["nodcache"]
+    )
+    assert (
+        "Options=noatime,rw,_netdev,auto,nofail,rsize=67108864,wsize=67108864,rasize=67108864,nodcache\n"
+        in (tmp_path / "media-share-results.mount").read_text()
+    )
+
+    with pytest.raises(SystemExit):
+        mount_ceph.do_mount("scratch", SHARE_PATH, options=["caps_max=-1"])
+    assert not (tmp_path / "media-share-scratch.mount").exists()
+
+
+def test_batch_validates_options(capsys, mount_ceph, commands, tmp_path):
+    commands.add("systemctl", FakeSystemctl())
+
+    with pytest.raises(SystemExit):
+        batch(
+            mount_ceph,
+            [
+                {"share_name": "a", "share_path": SHARE_PATH, "profile": "small-files"},
+                {"share_name": "b", "share_path": SHARE_PATH, "options": ["rasize=1"]},
+            ],
+        )
+    results = json.loads(capsys.readouterr().out)["shares"]
+    assert results[0]["ok"]
+    assert "rasize=1048576" in (tmp_path / "media-share-a.mount").read_text()
+    assert results[1]["error"] == (
+        "Invalid share: rasize must be a multiple of 4096, not '1'"
+    )
+    assert not (tmp_path / "media-share-b.mount").exists()
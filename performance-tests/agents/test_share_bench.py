@@ -0,0 +1,50 @@
+import json
+import pathlib
+
+import pytest
+
+
+@pytest.fixture
+def share_bench(agent):
+    return agent("share_bench")
+
+
+def test_mount_of(share_bench):
+    mount = share_bench.mount_of(pathlib.Path("/media/share/results/run-01"))
+    assert mount.fs_type == "ceph"
+    assert "noatime" in mount.options
+
+    assert share_bench.mount_of(pathlib.Path("/media/volume/scratch space")).source == (
+        "/dev/vdc"
+    )
+    assert share_bench.mount_of(pathlib.Path("/media/share")).mount_point == "/"
+
+
+def test_run(capsys, share_bench, tmp_path):
+    share_bench.main(
+        [str(tmp_path), "--size", "4", "--block-size", "256", "--files", "50", "--json"]
+    )
+    result = json.loads(capsys.readouterr().out)
+    assert result["sizeMiB"] == 4
+    assert result["writeMiBPerSec"] > 0 and result["readMiBPerSec"] > 0
+    assert set(result["opsPerSec"]) == {"create", "stat", "readdir", "unlink"}
+    # Everything the benchmark wrote is cleaned up
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ["--block-size", "0"],
+        ["--block-size", "-4"],
+        ["--size", "0"],
+        ["--size", "1", "--block-size", "2048"],
+        ["--files", "0"],
+    ],
+)
+def test_rejects_invalid_sizes(capsys, share_bench, tmp_path, args):
+    with pytest.raises(SystemExit) as exited:
+        share_bench.main([str(tmp_path), *args])
+    assert exited.value.code == 2
+    assert "must be at least" in capsys.readouterr().err
+    assert list(tmp_path.iterdir()) == []
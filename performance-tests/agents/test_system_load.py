@@ -0,0 +1,207 @@
+import pytest
+
+
+@pytest.fixture
+def system_load(agent):
+    return agent("system_load")
+
+
+def primed_proc_collector(system_load):
+    collector = system_load.ProcCollector()
+    # Skip the first-sample sleep
+    collector.prev_cpu_times = system_load.read_cpu_times()
+    return collector
+
+
+def test_proc_sample(bench, system_load):
+    collector = primed_proc_collector(system_load)
+    gpus = system_load.NoGpuCollector()
+
+    record = system_load.sample(collector, gpus)
+    assert record["memPctUsed"] == 21
+    assert record["rootfsPctUsed"] == 63
+    assert record["gpuPctUsed"] is None
+
+    bench(lambda: system_load.sample(collector, gpus), rounds=500)
+
+
+def test_subprocess_sample(bench, commands, system_load):
+    commands.add_fixture("top", "top.txt")
+    commands.add_fixture("free", "free.txt")
+    commands.add_fixture("df", "df.txt")
+    collector = system_load.SubprocessCollector()
+    gpus = system_load.NoGpuCollector()
+
+    record = system_load.sample(collector, gpus)
+    assert (record["cpuPctUsed"], record["memPctUsed"], record["rootfsPctUsed"]) == (
+        3,
+        21,
+        60,
+    )
+
+    bench(lambda: system_load.sample(collector, gpus))
+
+
+def test_nvidia_smi_gpu_read(bench, commands, system_load):
+    commands.add_fixture("nvidia-smi", "nvidia-smi.txt")
+    gpus = system_load.NvidiaSmiGpuCollector()
+
+    assert gpus.read() == [(35, 6), (80, 50)]
+
+    bench(gpus.read)
+
+
+def test_nvidia_smi_loop_gpu_read(commands, system_load):
+    # The second loop is missing GPU 1
+    commands.add_output(
+        "nvidia-smi",
+        "0, 35, 1024, 16384\n1, 80, 8192, 16384\n"
+        "0, 10, 1024, 16384\n"
+        "0, 20, 2048, 16384\n1, 30, 4096, 16384\n"
+        "0, 40, 4096, 16384\n1, 50, 8192, 16384\n",
+    )
+    gpus = system_load.NvidiaSmiLoopGpuCollector(5, 2)
+
+    # The first read waits for nvidia-smi instead of returning nothing
+    assert gpus.read() is not None
+    gpus.follower.join()
+    assert gpus.read() == [(40, 25), (50, 50)]
+    gpus.close()
+
+
+def test_summary_record(bench, system_load):
+    samples = [
+        {
+            "epoch": 1700000000 + i,
+            "cpuPctUsed": i % 100,
+            "memPctUsed": 40,
+            "rootfsPctUsed": 55,
+            "gpuPctUsed": [i % 100, 50],
+            "gpuMemPctUsed": [10, 20],
+        }
+        for i in range(60)
+    ]
+
+    record = system_load.summary_record(samples)
+    assert record["cpuPctUsed"] == 30
+    assert record["stats"]["cpuPctUsed"] == [0, 59, 56]
+    assert record["gpuPctUsed"] == [30, 50]
+
+    bench(lambda: system_load.summary_record(samples))
+
+
+def test_extended_collect(bench, instance_fs, system_load):
+    instance_fs.add_statvfs("/media/volume/data", blocks=1000, free=600, avail=600)
+    instance_fs.add_statvfs(
+        "/media/volume/scratch space", blocks=1000, free=100, avail=50
+    )
+    instance_fs.add_statvfs("/media/share/results", blocks=1000, free=990, avail=990)
+    extended = system_load.ExtendedCollector()
+    extended.prev_counters = extended.counters()
+
+    ext = extended.collect()
+    assert ext["v"] == system_load.EXTENDED_VERSION
+    assert len(ext["cpuCorePctUsed"]) == 4
+    assert ext["loadAvg"] == [0.52, 0.40, 0.33]
+    assert ext["swapPctUsed"] == 13
+    assert ext["mountPctUsed"] == {
+        "/media/volume/data": 40,
+        "/media/volume/scratch space": 95,
+        "/media/share/results": 1,
+    }
+    assert set(ext["diskBytesPerSec"]) == {"sda", "vda", "vdb"}
+    assert set(ext["netBytesPerSec"]) == {"ens3", "docker0"}
+
+    bench(extended.collect)
+
+
+@pytest.mark.parametrize("gpus", [None, [35, 80]])
+def test_compact_round_trip(bench, system_load, gpus):
+    records = [
+        {
+            "epoch": 1700000000 + 60 * i,
+            "cpuPctUsed": i,
+            "memPctUsed": 40 + i,
+            "rootfsPctUsed": 55,
+            "gpuPctUsed": gpus,
+        }
+        for i in range(10)
+    ]
+
+    batch = system_load.encode_compact(records)
+    assert system_load.decode_compact(batch) == records
+
+    bench(lambda: system_load.decode_compact(system_load.encode_compact(records)))
+
+
+def test_decode_console_log_lines(system_load):
+    lines = [
+        '[ 2915.727779] {"epoch": 5, "cpuPctUsed": 1, "memPctUsed": 2, "rootfsPctUsed": 3, "gpuPctUsed": null}',
+        '{"v":2,"e":1700000000,"s":[[0,12,40,55],[60,10,41,55,[3]]]}',
+        '{"v":3,"e":1700000000,"s":[[0,12,40,55]]}',
+        '{"exoSetup":"complete"}',
+        "Ubuntu 22.04 LTS bench-instance ttyS0",
+    ]
+
+    decoded = [record for line in lines for record in system_load.decode_line(line)]
+    assert [r["epoch"] for r in decoded] == [5, 1700000000, 1700000060]
+    assert decoded[2]["gpuPctUsed"] == [3]
+
+
+@pytest.mark.parametrize("flag", ["--extended", "--self-stats"])
+def test_compact_rejects_full_format_fields(capsys, monkeypatch, system_load, flag):
+    monkeypatch.setattr(
+        "sys.argv", ["system_load_json.py", "--format", "compact", flag]
+    )
+    with pytest.raises(SystemExit) as exit_info:
+        system_load.main()
+    assert exit_info.value.code == 2
+    assert "require --format json" in capsys.readouterr().err
+
+
+def test_history_append_and_query(bench, system_load, tmp_path):
+    history = system_load.HistoryRing(
+        tmp_path / "history", capacity=1440, writable=True
+    )
+    epoch = iter(range(1700000000, 1800000000, 60))
+
+    def append():
+        history.append(
+            {
+                "epoch": next(epoch),
+                "cpuPctUsed": 12,
+                "memPctUsed": 40,
+                "rootfsPctUsed": 55,
+                "gpuPctUsed": [35, 80],
+            }
+        )
+
+    bench(append, rounds=2000)
+
+    reader = system_load.HistoryRing(tmp_path / "history")
+    records = reader.query()
+    assert len(records) == 1440
+    assert [r["epoch"] for r in records] == sorted(r["epoch"] for r in records)
+    assert records[-1]["gpuPctUsed"] == [35, 80]
+
+    window = reader.query(records[-10]["epoch"], records[-6]["epoch"])
+    assert len(window) == 5
+    reader.close()
+    history.close()
+
+
+def test_self_stats(bench, commands, system_load):
+    commands.add_fixture("top", "top.txt")
+    commands.add_fixture("free", "free.txt")
+    commands.add_fixture("df", "df.txt")
+    collector = system_load.SubprocessCollector()
+    gpus = system_load.NoGpuCollector()
+    self_stats = system_load.SelfStats()
+
+    system_load.sample(collector, gpus)
+    stats = self_stats.collect(0.0125)
+    assert stats["collectMs"] == 12.5
+    assert stats["cpuMs"] >= 0
+    assert stats["rssKb"] == 3014 * system_load.os.sysconf("SC_PAGE_SIZE") // 1024
+
+    bench(self_stats.collect)
@@ -0,0 +1,1810 @@
+#!/usr/bin/env python3
+"""
+Serves a fake OpenStack cloud, so Exosphere can be tested offline against a fleet of any size
+
+It answers the Keystone, Nova, Cinder, Glance, Neutron and Manila calls that Exosphere makes, from
+one port and in memory. The fleet is generated from a seed, and can be any size. Every response
+can be delayed, to stand in for a slow or distant cloud. Console logs carry resource usage records
+made by system_load_json.py itself, in either of the formats it writes. Instances created through
+Exosphere build, run their setup and become ready within a few seconds.
+
+Exosphere can call it directly, with `http://localhost:8775/v3/` as the Keystone auth URL, or
+through it standing in for the CORS proxy (`cloudCorsProxyUrl: "http://localhost:8775/proxy"` in
+config.js). Through the proxy, any auth URL works, e.g. Jetstream2's, and Exosphere then uses that
+cloud's configuration from cloud_configs.js. Any user name and password are accepted by default.
+
+Example, with 500 instances, 200 volumes and 300 ms added to every response:
+    python3 performance-tests/fake_openstack.py --servers 500 --volumes 200 --latency 300
+"""
+
+import argparse
+import hashlib
+import http
+import http.server
+import importlib.util
+import json
+import math
+import pathlib
+import random
+import re
+import sys
+import threading
+import time
+import typing as t
+import urllib.parse
+import uuid
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parents[1]
+SYSTEM_LOAD_JSON = (
+    REPO_ROOT / "ansible/roles/system-load-logging/files/system_load_json.py"
+)
+
+# The project, region and user the integration tests' features expect
+DEFAULT_PROJECT_NAME = "INI210003"
+DEFAULT_PROJECT_ID = "44359c085e124766bad6e2c69d867291"
+DEFAULT_REGION = "IU"
+DEFAULT_DOMAIN = "access"
+
+# Seconds between resource usage records, and samples summarised into each, as deployed by the
+# system-load-logging role
+RECORD_INTERVAL = 60
+SAMPLES_PER_RECORD = 12
+
+# A service's path prefix, and the service type it's in the catalog under
+SERVICES = {
+    "v3": "identity",
+    "compute": "compute",
+    "volume": "volumev3",
+    "image": "image",
+    "network": "network",
+    "share": "sharev2",
+}
+CATALOG = [
+    ("identity", "keystone", "/v3"),
+    ("compute", "nova", "/compute/v2.1"),
+    ("volumev3", "cinderv3", "/volume/v3/{project_id}"),
+    ("image", "glance", "/image"),
+    ("network", "neutron", "/network"),
+    ("sharev2", "manilav2", "/share/v2"),
+]
+
+KEYSTONE = r"/v3"
+NOVA = r"/compute/v2\.1"
+CINDER = r"/volume/v3/[^/]+"
+GLANCE = r"/image/v2"
+NEUTRON = r"/network/v2\.0"
+MANILA = r"/share/v2(?:/(?P<project_id>[0-9a-f]{32}))?"
+ID = r"(?P<id>[^/]+)"
+
+# Name, vCPUs, RAM in MiB, root disk in GiB and GPUs, like Jetstream2's flavors
+FLAVORS = [
+    ("m3.tiny", 1, 3072, 20, 0),
+    ("m3.small", 2, 6144, 20, 0),
+    ("m3.quad", 4, 15360, 20, 0),
+    ("m3.medium", 8, 30720, 60, 0),
+    ("m3.large", 16, 61440, 60, 0),
+    ("m3.xl", 32, 128000, 60, 0),
+    ("r3.large", 64, 512000, 60, 0),
+    ("g3.small", 4, 15360, 60, 1),
+    ("g3.medium", 8, 30720, 60, 1),
+    ("g3.large", 16, 61440, 60, 1),
+]
+# Name, os_distro and os_version of the images that cloud_configs.js looks for
+FEATURED_IMAGES = [
+    ("Featured-Ubuntu24", "ubuntu", "24.04"),
+    ("Featured-Ubuntu22", "ubuntu", "22.04"),
+    ("Featured-Ubuntu20", "ubuntu", "20.04"),
+    ("Preview-Ubuntu24", "ubuntu", "24.04"),
+    ("Featured-RockyLinux10", "rocky", "10"),
+    ("Featured-RockyLinux9", "rocky", "9"),
+]
+# The status and power state a server ends up in after each action
+SERVER_ACTIONS = {
+    "os-start": ("ACTIVE", 1),
+    "os-stop": ("SHUTOFF", 4),
+    "reboot": ("ACTIVE", 1),
+    "rebuild": ("ACTIVE", 1),
+    "pause": ("PAUSED", 3),
+    "unpause": ("ACTIVE", 1),
+    "suspend": ("SUSPENDED", 7),
+    "resume": ("ACTIVE", 1),
+    "shelve": ("SHELVED_OFFLOADED", 4),
+    "unshelve": ("ACTIVE", 1),
+    "confirmResize": ("ACTIVE", 1),
+    "revertResize": ("ACTIVE", 1),
+}
+BOOT_MESSAGES = [
+    "Linux version 6.8.0-45-generic (buildd@lcy02-amd64-075) #45-Ubuntu SMP PREEMPT_DYNAMIC",
+    "Command line: BOOT_IMAGE=/vmlinuz-6.8.0-45-generic root=LABEL=cloudimg-rootfs ro console=tty1 console=ttyS0",
+    "BIOS-provided physical RAM map:",
+    "virtio_blk virtio2: [vda] 125829120 512-byte logical blocks (64.4 GB/60.0 GiB)",
+    "EXT4-fs (vda1): mounted filesystem with ordered data mode. Quota mode: none.",
+    "systemd[1]: systemd 255.4-1ubuntu8.4 running in system mode",
+    "cloud-init[702]: Cloud-init v. 24.2 running 'init' at boot",
+    "cloud-init[702]: ci-info: ++++++++++++++++++++++Net device info+++++++++++++++++++++++",
+    "cloud-init[1023]: Cloud-init v. 24.2 running 'modules:config' at boot",
+]
+
+
+def load_system_load_json():
+    spec = importlib.util.spec_from_file_location("system_load_json", SYSTEM_LOAD_JSON)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+system_load_json = load_system_load_json()
+
+
+class CloudConfig(t.NamedTuple):
+    servers: int = 50
+    volumes: int = 20
+    shares: int = 10
+    images: int = 30
+    console_records: int = 1440
+    console_format: str = "full"
+    batch_size: int = 10
+    build_seconds: float = 10
+    setup_seconds: float = 20
+    seed: int = 0
+    project_name: str = DEFAULT_PROJECT_NAME
+    project_id: str = DEFAULT_PROJECT_ID
+    region: str = DEFAULT_REGION
+    username: t.Optional[str] = None
+    password: t.Optional[str] = None
+
+
+class Request(t.NamedTuple):
+    params: t.Dict[str, str]
+    query: t.Dict[str, t.List[str]]
+    body: t.Any
+    base_url: str
+    token: t.Optional[t.Dict[str, t.Any]]
+
+
+class Response(t.NamedTuple):
+    status: int
+    body: t.Any = None
+    headers: t.Optional[t.Dict[str, str]] = None
+
+
+class ApiError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class Route(t.NamedTuple):
+    method: str
+    pattern: t.Pattern[str]
+    handler: t.Callable[..., Response]
+    authenticated: bool
+
+
+ROUTES: t.List[Route] = []
+
+
+def route(method: str, pattern: str, authenticated: bool = True):
+    def register(handler):
+        ROUTES.append(Route(method, re.compile(pattern + "/?"), handler, authenticated))
+        return handler
+
+    return register
+
+
+def new_id(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def iso_time(epoch: float) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(epoch))
+
+
+def public(resource: t.Dict[str, t.Any]) -> t.Dict[str, t.Any]:
+    """Leaves out the fake's own bookkeeping, kept in keys starting with an underscore"""
+
+    return {key: value for key, value in resource.items() if not key.startswith("_")}
+
+
+def kernel_line(uptime: float, message: str) -> str:
+    # Like a line written to /dev/kmsg, prefixed with the seconds since boot
+    return f"[{int(uptime):5d}.{int(uptime % 1 * 1000000):06d}] {message}"
+
+
+def clamp_pct(value: float) -> float:
+    return round(min(100.0, max(0.0, value)), 1)
+
+
+def fingerprint(public_key: str) -> str:
+    digest = hashlib.md5(public_key.encode(), usedforsecurity=False).hexdigest()
+    return ":".join(digest[i : i + 2] for i in range(0, len(digest), 2))
+
+
+def body_of(request: Request, key: str) -> t.Dict[str, t.Any]:
+    if not isinstance(request.body, dict) or not isinstance(
+        request.body.get(key), dict
+    ):
+        raise ApiError(400, f"Expected a JSON object with a {key!r} object")
+    return request.body[key]
+
+
+class Cloud:
+    """An OpenStack project, its resources and their lifecycles, in memory"""
+
+    def __init__(self, config: CloudConfig):
+        self.config = config
+        self.lock = threading.Lock()
+        self.rng = random.Random(config.seed)
+        self.user_id = new_id(self.rng).replace("-", "")
+        self.tokens: t.Dict[str, t.Dict[str, t.Any]] = {}
+        self.app_credentials: t.Dict[str, str] = {}
+        self.servers: t.Dict[str, t.Dict[str, t.Any]] = {}
+        self.ports: t.Dict[str, t.Dict[str, t.Any]] = {}
+        self.floating_ips: t.Dict[str, t.Dict[str, t.Any]] = {}
+        self.volumes: t.Dict[str, t.Dict[str, t.Any]] = {}
+        self.snapshots: t.Dict[str, t.Dict[str, t.Any]] = {}
+        self.images: t.Dict[str, t.Dict[str, t.Any]] = {}
+        self.keypairs: t.Dict[str, t.Dict[str, t.Any]] = {}
+        self.security_groups: t.Dict[str, t.Dict[str, t.Any]] = {}
+        self.shares: t.Dict[str, t.Dict[str, t.Any]] = {}
+        self.access_rules: t.Dict[str, t.Dict[str, t.Any]] = {}
+        # Enough quota for the generated fleet, and as many again
+        self.quota = max(100, 2 * max(config.servers, config.volumes, config.shares))
+        self.generate()
+
+    # Generating the fleet
+
+    def generate(self):
+        now = time.time()
+        rng = self.rng
+        self.flavors = [
+            {
+                "id": str(index),
+                "name": name,
+                "description": None,
+                "vcpus": vcpus,
+                "ram": ram,
+                "disk": disk,
+                "OS-FLV-EXT-DATA:ephemeral": 0,
+                "extra_specs": {"resources:VGPU": str(gpus)} if gpus else {},
+                "_gpus": gpus,
+            }
+            for index, (name, vcpus, ram, disk, gpus) in enumerate(FLAVORS, start=1)
+        ]
+
+        for index in range(max(self.config.images, len(FEATURED_IMAGES))):
+            if index < len(FEATURED_IMAGES):
+                name, distro, version = FEATURED_IMAGES[index]
+                visibility = "public"
+            else:
+                distro, version = rng.choice([(d, v) for _, d, v in FEATURED_IMAGES])
+                name = f"{distro}-{version}-{index:04d}"
+                visibility = rng.choice(["community", "shared", "private", "private"])
+            self.add_image(
+                name, visibility, now - rng.uniform(1, 365) * 86400, distro, version
+            )
+
+        self.networks = [
+            {
+                "id": new_id(rng),
+                "name": "public",
+                "admin_state_up": True,
+                "status": "ACTIVE",
+                "router:external": True,
+            },
+            {
+                "id": new_id(rng),
+                "name": "auto_allocated_network",
+                "admin_state_up": True,
+                "status": "ACTIVE",
+                "router:external": False,
+            },
+        ]
+        self.add_security_group("default", "Default security group", now)
+
+        for index in range(3):
+            self.add_keypair(
+                f"key-{index}",
+                f"ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAI{new_id(rng)} user@host",
+            )
+
+        images = [i for i in self.images.values() if i["visibility"] == "public"]
+        for index in range(self.config.servers):
+            created = now - rng.uniform(1, 90 * 24) * 3600
+            status, power_state = rng.choices(
+                [("ACTIVE", 1), ("SHUTOFF", 4), ("ERROR", 0)], weights=[90, 8, 2]
+            )[0]
+            server = self.add_server(
+                name=f"fleet-{index:04d}",
+                # Mostly general-purpose flavors, and a few with GPUs
+                flavor=rng.choice(self.flavors[:6] * 9 + self.flavors[7:]),
+                image_id=rng.choice(images)["id"],
+                key_name=rng.choice([None, *self.keypairs]),
+                metadata={
+                    "exoServerVersion": "5",
+                    "exoCreatorUsername": self.config.username or "exouser",
+                    "exoSetup": json.dumps(
+                        {
+                            "status": "complete",
+                            "epoch": round((created + 300) * 1000),
+                        },
+                        separators=(",", ":"),
+                    ),
+                },
+                security_groups=["default"],
+                created=created,
+            )
+            server["status"], server["OS-EXT-STS:power_state"] = status, power_state
+            server["locked"] = rng.random() < 0.05
+            if status == "SHUTOFF":
+                server["_stopped"] = rng.uniform(created, now)
+            elif status == "ERROR":
+                server["fault"] = {
+                    "code": 500,
+                    "created": iso_time(created),
+                    "message": "No valid host was found. There are not enough hosts available.",
+                }
+            if status != "ERROR" and rng.random() < 0.8:
+                self.add_floating_ip(self.server_port(server["id"])["id"])
+
+        servers = [s for s in self.servers.values() if s["status"] != "ERROR"]
+        for index in range(self.config.volumes):
+            volume = self.add_volume(
+                f"volume-{index:04d}",
+                rng.choice([10, 20, 50, 100, 500, 1000]),
+                now - rng.uniform(1, 90) * 86400,
+            )
+            if servers and rng.random() < 0.6:
+                server = rng.choice(servers)
+                if len(server["os-extended-volumes:volumes_attached"]) < 3:
+                    self.attach_volume(server, volume)
+            if rng.random() < 0.1:
+                self.add_snapshot(volume, now - rng.uniform(0, 30) * 86400)
+
+        self.share_types = [{"id": new_id(rng), "name": "cephfsnativetype"}]
+        for index in range(self.config.shares):
+            share = self.add_share(
+                f"share-{index:04d}",
+                rng.choice([10, 100, 1000]),
+                now - rng.uniform(1, 90) * 86400,
+            )
+            self.add_access_rule(share, "rw", f"share-{index:04d}-rw")
+
+    def add_image(
+        self,
+        name: str,
+        visibility: str,
+        created: float,
+        distro: t.Optional[str] = None,
+        version: t.Optional[str] = None,
+    ) -> t.Dict[str, t.Any]:
+        image = {
+            "id": new_id(self.rng),
+            "name": name,
+            "status": "active",
+            "size": self.rng.randint(2, 20) * 1024**3,
+            "checksum": new_id(self.rng).replace("-", ""),
+            "disk_format": "raw",
+            "container_format": "bare",
+            "tags": [],
+            "owner": self.config.project_id,
+            "visibility": visibility,
+            "created_at": iso_time(created),
+            "updated_at": iso_time(created),
+            "protected": visibility == "public",
+            "min_disk": 0,
+            "min_ram": 0,
+        }
+        if distro:
+            image["os_distro"], image["os_version"] = distro, version
+        self.images[image["id"]] = image
+        return image
+
+    def add_security_group(
+        self, name: str, description: t.Optional[str], created: float
+    ) -> t.Dict[str, t.Any]:
+        group = {
+            "id": new_id(self.rng),
+            "name": name,
+            "description": description,
+            "security_group_rules": [],
+            "created_at": iso_time(created),
+            "tags": [],
+        }
+        self.security_groups[group["id"]] = group
+        for ethertype in ["IPv4", "IPv6"]:
+            self.add_security_group_rule(
+                {
+                    "security_group_id": group["id"],
+                    "ethertype": ethertype,
+                    "direction": "egress",
+                }
+            )
+        return group
+
+    def add_security_group_rule(self, rule: t.Dict[str, t.Any]) -> t.Dict[str, t.Any]:
+        group = self.security_groups.get(rule.get("security_group_id"))
+        if group is None:
+            raise ApiError(404, "Security group not found")
+        rule = {
+            "id": new_id(self.rng),
+            "security_group_id": group["id"],
+            "ethertype": rule.get("ethertype", "IPv4"),
+            "direction": rule.get("direction", "ingress"),
+            "protocol": rule.get("protocol"),
+            "port_range_min": rule.get("port_range_min"),
+            "port_range_max": rule.get("port_range_max"),
+            "remote_ip_prefix": rule.get("remote_ip_prefix"),
+            "remote_group_id": rule.get("remote_group_id"),
+            "description": rule.get("description", ""),
+        }
+        group["security_group_rules"].append(rule)
+        return rule
+
+    def add_keypair(self, name: str, public_key: str) -> t.Dict[str, t.Any]:
+        keypair = {
+            "name": name,
+            "public_key": public_key,
+            "fingerprint": fingerprint(public_key),
+            "type": "ssh",
+            "user_id": self.user_id,
+        }
+        self.keypairs[name] = keypair
+        return keypair
+
+    def add_server(
+        self,
+        name: str,
+        flavor: t.Dict[str, t.Any],
+        image_id: str,
+        key_name: t.Optional[str],
+        metadata: t.Dict[str, str],
+        security_groups: t.List[str],
+        created: float,
+    ) -> t.Dict[str, t.Any]:
+        server = {
+            "id": new_id(self.rng),
+            "name": name,
+            "status": "ACTIVE",
+            "created": iso_time(created),
+            "updated": iso_time(created),
+            "OS-EXT-STS:power_state": 1,
+            "image": {"id": image_id} if image_id else "",
+            "flavor": {"id": flavor["id"]},
+            "key_name": key_name,
+            "metadata": metadata,
+            "user_id": self.user_id,
+            "tenant_id": self.config.project_id,
+            "os-extended-volumes:volumes_attached": [],
+            "tags": [],
+            "locked": False,
+            "_booted": created,
+            "_ready": created,
+            "_setup_seconds": 300,
+            "_gpus": flavor["_gpus"],
+            "_security_groups": security_groups,
+            "_actions": [self.instance_action("create", created)],
+        }
+        self.servers[server["id"]] = server
+
+        octets = len(self.ports) + 10
+        port = {
+            "id": new_id(self.rng),
+            "device_id": server["id"],
+            "device_owner": "compute:nova",
+            "network_id": self.networks[1]["id"],
+            "admin_state_up": True,
+            "status": "ACTIVE",
+            "fixed_ips": [{"ip_address": f"10.0.{octets // 250}.{octets % 250 + 2}"}],
+        }
+        self.ports[port["id"]] = port
+        return server
+
+    def instance_action(self, action: str, at: float) -> t.Dict[str, t.Any]:
+        return {
+            "action": action,
+            "message": None,
+            "request_id": f"req-{new_id(self.rng)}",
+            "start_time": iso_time(at),
+            "user_id": self.user_id,
+        }
+
+    def server_port(self, server_id: str) -> t.Dict[str, t.Any]:
+        return next(p for p in self.ports.values() if p["device_id"] == server_id)
+
+    def add_floating_ip(self, port_id: t.Optional[str]) -> t.Dict[str, t.Any]:
+        octets = len(self.floating_ips) + 10
+        floating_ip = {
+            "id": new_id(self.rng),
+            "floating_ip_address": f"149.165.{150 + octets // 250}.{octets % 250 + 2}",
+            "floating_network_id": self.networks[0]["id"],
+            "status": "ACTIVE" if port_id else "DOWN",
+            "port_id": port_id,
+            "dns_domain": "",
+            "dns_name": "",
+        }
+        self.floating_ips[floating_ip["id"]] = floating_ip
+        return floating_ip
+
+    def add_volume(self, name: str, size: int, created: float) -> t.Dict[str, t.Any]:
+        volume = {
+            "id": new_id(self.rng),
+            "name": name,
+            "status": "available",
+            "size": size,
+            "description": None,
+            "attachments": [],
+            "created_at": iso_time(created),
+            "user_id": self.user_id,
+            "bootable": "false",
+        }
+        self.volumes[volume["id"]] = volume
+        return volume
+
+    def add_snapshot(
+        self, volume: t.Dict[str, t.Any], created: float
+    ) -> t.Dict[str, t.Any]:
+        snapshot = {
+            "id": new_id(self.rng),
+            "name": f"{volume['name']}-snapshot",
+            "description": None,
+            "volume_id": volume["id"],
+            "size": volume["size"],
+            "created_at": iso_time(created),
+            "status": "available",
+        }
+        self.snapshots[snapshot["id"]] = snapshot
+        return snapshot
+
+    def attach_volume(
+        self, server: t.Dict[str, t.Any], volume: t.Dict[str, t.Any]
+    ) -> t.Dict[str, t.Any]:
+        attached = server["os-extended-volumes:volumes_attached"]
+        attachment = {
+            "id": volume["id"],
+            "volumeId": volume["id"],
+            "serverId": server["id"],
+            "device": f"/dev/sd{'bcdefghijklmnopqrstuvwxyz'[len(attached)]}",
+        }
+        attached.append({"id": volume["id"]})
+        volume["status"] = "in-use"
+        volume["attachments"] = [
+            {
+                "volume_id": volume["id"],
+                "server_id": server["id"],
+                "attachment_id": new_id(self.rng),
+                "device": attachment["device"],
+            }
+        ]
+        return attachment
+
+    def detach_volume(self, volume: t.Dict[str, t.Any]):
+        for attachment in volume["attachments"]:
+            server = self.servers.get(attachment["server_id"])
+            if server:
+                server["os-extended-volumes:volumes_attached"] = [
+                    v
+                    for v in server["os-extended-volumes:volumes_attached"]
+                    if v["id"] != volume["id"]
+                ]
+        volume["status"] = "available"
+        volume["attachments"] = []
+
+    def add_share(self, name: str, size: int, created: float) -> t.Dict[str, t.Any]:
+        share = {
+            "id": new_id(self.rng),
+            "name": name,
+            "status": "available",
+            "size": size,
+            "description": None,
+            "metadata": {},
+            "created_at": iso_time(created),
+            "user_id": self.user_id,
+            "is_public": False,
+            "share_proto": "CEPHFS",
+            "share_type_name": self.share_types[0]["name"],
+            "share_type": self.share_types[0]["id"],
+        }
+        self.shares[share["id"]] = share
+        return share
+
+    def add_access_rule(
+        self, share: t.Dict[str, t.Any], access_level: str, access_to: str
+    ) -> t.Dict[str, t.Any]:
+        rule = {
+            "id": new_id(self.rng),
+            "share_id": share["id"],
+            "access_level": access_level,
+            "access_type": "cephx",
+            "access_to": access_to,
+            "access_key": hashlib.sha256(access_to.encode()).hexdigest()[:40],
+            "state": "active",
+            "created_at": share["created_at"],
+        }
+        self.access_rules[rule["id"]] = rule
+        return rule
+
+    # Lifecycles
+
+    def refresh(self, server: t.Dict[str, t.Any]):
+        if server["status"] == "BUILD" and time.time() >= server["_ready"]:
+            server["status"], server["OS-EXT-STS:power_state"] = "ACTIVE", 1
+            server["updated"] = iso_time(server["_ready"])
+
+    def server(self, server_id: str) -> t.Dict[str, t.Any]:
+        server = self.servers.get(server_id)
+        if server is None:
+            raise ApiError(404, f"Instance {server_id} could not be found.")
+        self.refresh(server)
+        return server
+
+    def find(
+        self, resources: t.Dict[str, t.Dict[str, t.Any]], resource_id: str, kind: str
+    ) -> t.Dict[str, t.Any]:
+        resource = resources.get(resource_id)
+        if resource is None:
+            raise ApiError(404, f"{kind} {resource_id} could not be found.")
+        return resource
+
+    def console_lines(self, server: t.Dict[str, t.Any], now: float) -> t.List[t.Any]:
+        """Lists the lines of a server's console log, with records still to be made"""
+
+        booted = server["_ready"]
+        if server["status"] in ("BUILD", "ERROR") or now < booted:
+            return []
+
+        def kernel(uptime: float, message: str) -> t.Tuple[float, str]:
+            return booted + uptime, kernel_line(uptime, message)
+
+        lines = [kernel(i * 0.4, message) for i, message in enumerate(BOOT_MESSAGES)]
+        setup_seconds = server["_setup_seconds"]
+        for uptime, status in [
+            (min(5, setup_seconds / 4), "starting"),
+            (min(6, setup_seconds / 2), "running"),
+            (setup_seconds, "complete"),
+        ]:
+            # ServerDeploy.elm's script writes these to both the console and the kernel log
+            status_line = f'{{"status":"{status}", "epoch": {int(booted + uptime)}000}}'
+            lines += [(booted + uptime, status_line), kernel(uptime, status_line)]
+        lines = [line for at, line in lines if at <= now]
+
+        # Records every interval since boot, for as long as the server has run
+        until = min(now, server.get("_stopped") or now)
+        made = int((until - booted) // RECORD_INTERVAL)
+        first = max(1, made - self.config.console_records + 1)
+        epochs = [booted + n * RECORD_INTERVAL for n in range(first, made + 1)]
+        if self.config.console_format == "compact":
+            # Only full batches are written, so batches keep their records as the log grows
+            batch = self.config.batch_size
+            first_batch = first + (-(first - 1) % batch)
+            lines += [
+                epochs[start : start + batch]
+                for start in range(first_batch - first, len(epochs) - batch + 1, batch)
+            ]
+        else:
+            lines += [[epoch] for epoch in epochs]
+        return lines
+
+    def load_record(
+        self, server: t.Dict[str, t.Any], epoch: float
+    ) -> t.Dict[str, t.Any]:
+        """Makes the record system_load_json.py would have written at a moment, from samples"""
+
+        rng = random.Random(f"{self.config.seed}:{server['id']}:{int(epoch)}")
+        # Each server has its own level of load, varying over the day, and its root filesystem
+        # fills up by a tenth of a percent a day
+        base = random.Random(server["id"])
+        cpu_level, mem_level = base.uniform(5, 70), base.uniform(20, 80)
+        rootfs = min(98.0, base.uniform(10, 50) + (epoch - server["_booted"]) / 864000)
+        day = (epoch % 86400) / 86400 * 2 * math.pi
+        samples = []
+        for sample in range(SAMPLES_PER_RECORD):
+            record = {
+                "epoch": round(epoch - (SAMPLES_PER_RECORD - 1 - sample) * 5),
+                "cpuPctUsed": clamp_pct(
+                    cpu_level + 20 * math.sin(day + cpu_level) + rng.gauss(0, 10)
+                ),
+                "memPctUsed": clamp_pct(
+                    mem_level + 5 * math.sin(day) + rng.gauss(0, 1)
+                ),
+                "rootfsPctUsed": clamp_pct(rootfs),
+                "gpuPctUsed": None,
+            }
+            if server["_gpus"]:
+                record["gpuPctUsed"] = [
+                    clamp_pct(cpu_level + rng.gauss(0, 15))
+                    for _ in range(server["_gpus"])
+                ]
+                record["gpuMemPctUsed"] = [
+                    clamp_pct(mem_level + rng.gauss(0, 2))
+                    for _ in range(server["_gpus"])
+                ]
+            samples.append(record)
+        return system_load_json.summary_record(samples)
+
+    def render_console_line(self, server: t.Dict[str, t.Any], line: t.Any) -> str:
+        if isinstance(line, str):
+            return line
+        records = [self.load_record(server, epoch) for epoch in line]
+        if self.config.console_format == "compact":
+            text = json.dumps(
+                system_load_json.encode_compact(records), separators=(",", ":")
+            )
+        else:
+            text = json.dumps(records[0])
+        return kernel_line(line[-1] - server["_ready"], text)
+
+    # Keystone
+
+    def catalog(self, base_url: str) -> t.List[t.Dict[str, t.Any]]:
+        return [
+            {
+                "type": service_type,
+                "name": name,
+                "id": hashlib.md5(name.encode(), usedforsecurity=False).hexdigest(),
+                "endpoints": [
+                    {
+                        "id": hashlib.md5(
+                            f"{name}-{interface}".encode(), usedforsecurity=False
+                        ).hexdigest(),
+                        "interface": interface,
+                        "region_id": self.config.region,
+                        "region": self.config.region,
+                        "url": base_url
+                        + path.format(project_id=self.config.project_id),
+                    }
+                    for interface in ["public", "internal"]
+                ],
+            }
+            for service_type, name, path in CATALOG
+        ]
+
+    @route("GET", KEYSTONE, authenticated=False)
+    def keystone_version(self, request: Request) -> Response:
+        return Response(
+            200,
+            {
+                "version": {
+                    "id": "v3.14",
+                    "status": "stable",
+                    "links": [{"rel": "self", "href": f"{request.base_url}/v3/"}],
+                }
+            },
+        )
+
+    @route("POST", KEYSTONE + r"/auth/tokens", authenticated=False)
+    def create_token(self, request: Request) -> Response:
+        auth = body_of(request, "auth")
+        identity = auth.get("identity", {})
+        methods = identity.get("methods", [])
+        scope = (auth.get("scope") or {}).get("project")
+
+        if "password" in methods:
+            user = identity.get("password", {}).get("user", {})
+            if (self.config.username and user.get("name") != self.config.username) or (
+                self.config.password and user.get("password") != self.config.password
+            ):
+                raise ApiError(
+                    401, "The request you have made requires authentication."
+                )
+        elif "token" in methods:
+            if identity.get("token", {}).get("id") not in self.tokens:
+                raise ApiError(
+                    401, "The request you have made requires authentication."
+                )
+        elif "application_credential" in methods:
+            credential = identity.get("application_credential", {})
+            if self.app_credentials.get(credential.get("id")) != credential.get(
+                "secret"
+            ):
+                raise ApiError(
+                    401, "The request you have made requires authentication."
+                )
+            scope = {"id": self.config.project_id}
+        else:
+            raise ApiError(400, f"Unsupported authentication methods {methods}")
+
+        if scope and scope.get("id") not in (self.config.project_id, None):
+            raise ApiError(401, "You are not authorized for the project.")
+        if scope and scope.get("name") not in (self.config.project_name, None):
+            raise ApiError(401, "You are not authorized for the project.")
+
+        now = time.time()
+        domain = {"id": "default", "name": DEFAULT_DOMAIN}
+        token = {
+            "methods": methods,
+            "user": {
+                "id": self.user_id,
+                "name": self.config.username or "exouser",
+                "domain": domain,
+            },
+            "issued_at": time.strftime("%Y-%m-%dT%H:%M:%S.000000Z", time.gmtime(now)),
+            "expires_at": time.strftime(
+                "%Y-%m-%dT%H:%M:%S.000000Z", time.gmtime(now + 86400)
+            ),
+        }
+        if scope:
+            token["project"] = {
+                "id": self.config.project_id,
+                "name": self.config.project_name,
+                "domain": domain,
+            }
+            token["roles"] = [{"id": "member", "name": "member"}]
+            token["catalog"] = self.catalog(request.base_url)
+
+        token_id = f"gAAAAA{new_id(self.rng).replace('-', '')}"
+        self.tokens[token_id] = {"scoped": bool(scope)}
+        return Response(201, {"token": token}, {"X-Subject-Token": token_id})
+
+    @route("GET", KEYSTONE + r"/auth/projects")
+    def list_auth_projects(self, request: Request) -> Response:
+        return Response(
+            200,
+            {
+                "projects": [
+                    {
+                        "id": self.config.project_id,
+                        "name": self.config.project_name,
+                        "description": f"Fake project with {len(self.servers)} instances",
+                        "domain_id": "default",
+                        "enabled": True,
+                    }
+                ]
+            },
+        )
+
+    @route("GET", KEYSTONE + r"/regions")
+    def list_regions(self, request: Request) -> Response:
+        return Response(
+            200, {"regions": [{"id": self.config.region, "description": ""}]}
+        )
+
+    @route("POST", KEYSTONE + r"/users/[^/]+/application_credentials")
+    def create_application_credential(self, request: Request) -> Response:
+        credential = body_of(request, "application_credential")
+        credential_id = new_id(self.rng).replace("-", "")
+        secret = new_id(self.rng)
+        self.app_credentials[credential_id] = secret
+        return Response(
+            201,
+            {
+                "application_credential": {
+                    "id": credential_id,
+                    "name": credential.get("name"),
+                    "secret": secret,
+                    "project_id": self.config.project_id,
+                }
+            },
+        )
+
+    @route("GET", KEYSTONE + r"/registered_limits")
+    def list_registered_limits(self, request: Request) -> Response:
+        return Response(200, {"registered_limits": []})
+
+    @route("GET", KEYSTONE + r"/limits")
+    def list_limits(self, request: Request) -> Response:
+        return Response(200, {"limits": []})
+
+    # Nova
+
+    def server_view(self, server: t.Dict[str, t.Any]) -> t.Dict[str, t.Any]:
+        self.refresh(server)
+        return public(server)
+
+    @route("GET", NOVA + r"/servers/detail")
+    def list_servers(self, request: Request) -> Response:
+        return Response(
+            200, {"servers": [self.server_view(s) for s in self.servers.values()]}
+        )
+
+    @route("GET", NOVA + r"/servers/" + ID)
+    def show_server(self, request: Request) -> Response:
+        return Response(
+            200, {"server": self.server_view(self.server(request.params["id"]))}
+        )
+
+    @route("POST", NOVA + r"/servers")
+    def create_server(self, request: Request) -> Response:
+        spec = body_of(request, "server")
+        flavor = next(
+            (f for f in self.flavors if f["id"] == str(spec.get("flavorRef"))), None
+        )
+        if flavor is None:
+            raise ApiError(400, f"Flavor {spec.get('flavorRef')} could not be found.")
+        image_id = spec.get("imageRef") or next(
+            (
+                device.get("uuid")
+                for device in spec.get("block_device_mapping_v2", [])
+                if device.get("source_type") == "image"
+            ),
+            "",
+        )
+        created = time.time()
+        server = None
+        for _ in range(max(1, int(spec.get("min_count", 1)))):
+            server = self.add_server(
+                name=spec.get("name", ""),
+                flavor=flavor,
+                image_id=image_id,
+                key_name=spec.get("key_name"),
+                metadata=dict(spec.get("metadata", {})),
+                security_groups=[
+                    group["name"] for group in spec.get("security_groups", [])
+                ]
+                or ["default"],
+                created=created,
+            )
+            server["status"], server["OS-EXT-STS:power_state"] = "BUILD", 0
+            server["_ready"] = created + self.config.build_seconds
+            server["_setup_seconds"] = self.config.setup_seconds
+        return Response(
+            202,
+            {
+                "server": {
+                    "id": server["id"],
+                    "adminPass": new_id(self.rng)[:12],
+                    "security_groups": [
+                        {"name": name} for name in server["_security_groups"]
+                    ],
+                }
+            },
+        )
+
+    @route("PUT", NOVA + r"/servers/" + ID)
+    def update_server(self, request: Request) -> Response:
+        server = self.server(request.params["id"])
+        changes = body_of(request, "server")
+        if "name" in changes:
+            server["name"] = changes["name"]
+        view = self.server_view(server)
+        view["OS-EXT-SRV-ATTR:hostname"] = re.sub(
+            r"[^a-z0-9-]+", "-", server["name"].lower()
+        ).strip("-")
+        return Response(200, {"server": view})
+
+    @route("DELETE", NOVA + r"/servers/" + ID)
+    def delete_server(self, request: Request) -> Response:
+        server = self.server(request.params["id"])
+        if server["locked"]:
+            raise ApiError(409, f"Instance {server['id']} is locked")
+        for volume in self.volumes.values():
+            if any(a["server_id"] == server["id"] for a in volume["attachments"]):
+                self.detach_volume(volume)
+        port = self.server_port(server["id"])
+        for floating_ip in self.floating_ips.values():
+            if floating_ip["port_id"] == port["id"]:
+                floating_ip["port_id"], floating_ip["status"] = None, "DOWN"
+        del self.ports[port["id"]]
+        del self.servers[server["id"]]
+        return Response(204)
+
+    @route("POST", NOVA + r"/servers/" + ID + r"/action")
+    def server_action(self, request: Request) -> Response:
+        server = self.server(request.params["id"])
+        if not isinstance(request.body, dict) or len(request.body) != 1:
+            raise ApiError(400, "Expected a JSON object with one action")
+        (action, arguments), now = next(iter(request.body.items())), time.time()
+        arguments = arguments if isinstance(arguments, dict) else {}
+
+        if action == "os-getConsoleOutput":
+            lines = self.console_lines(server, now)
+            length = arguments.get("length")
+            if length is not None and int(length) >= 0:
+                lines = lines[-int(length) :] if int(length) else []
+            output = "".join(
+                self.render_console_line(server, line) + "\n" for line in lines
+            )
+            return Response(200, {"output": output})
+
+        body = None
+        if action in ("lock", "unlock"):
+            server["locked"] = action == "lock"
+        elif action == "createImage":
+            image = self.add_image(arguments.get("name", ""), "private", now)
+            body = {"image_id": image["id"]}
+        elif action == "resize":
+            server["_previous_flavor"] = server["flavor"]
+            server["flavor"] = {"id": str(arguments.get("flavorRef"))}
+            server["status"] = "VERIFY_RESIZE"
+        elif action in ("addSecurityGroup", "removeSecurityGroup"):
+            name = arguments.get("name")
+            groups = [g for g in server["_security_groups"] if g != name]
+            server["_security_groups"] = groups + (
+                [name] if action == "addSecurityGroup" else []
+            )
+        elif action not in SERVER_ACTIONS:
+            raise ApiError(400, f"Unsupported action {action}")
+
+        if action == "revertResize":
+            server["flavor"] = server.pop("_previous_flavor", server["flavor"])
+        if action in SERVER_ACTIONS:
+            server["status"], server["OS-EXT-STS:power_state"] = SERVER_ACTIONS[action]
+            if server["OS-EXT-STS:power_state"] == 1:
+                server.pop("_stopped", None)
+            else:
+                server.setdefault("_stopped", now)
+        server["updated"] = iso_time(now)
+        server["_actions"].append(self.instance_action(action.replace("os-", ""), now))
+        return Response(202, body)
+
+    @route("GET", NOVA + r"/servers/" + ID + r"/os-instance-actions")
+    def list_instance_actions(self, request: Request) -> Response:
+        server = self.server(request.params["id"])
+        return Response(200, {"instanceActions": server["_actions"][::-1]})
+
+    @route("GET", NOVA + r"/servers/" + ID + r"/os-security-groups")
+    def list_server_security_groups(self, request: Request) -> Response:
+        server = self.server(request.params["id"])
+        return Response(
+            200,
+            {
+                "security_groups": [
+                    {"id": group["id"], "name": group["name"]}
+                    for group in self.security_groups.values()
+                    if group["name"] in server["_security_groups"]
+                ]
+            },
+        )
+
+    @route("GET", NOVA + r"/servers/" + ID + r"/os-volume_attachments")
+    def list_volume_attachments(self, request: Request) -> Response:
+        server = self.server(request.params["id"])
+        return Response(
+            200,
+            {
+                "volumeAttachments": [
+                    {
+                        "id": volume["id"],
+                        "volumeId": volume["id"],
+                        "serverId": server["id"],
+                        "device": attachment["device"],
+                    }
+                    for volume in self.volumes.values()
+                    for attachment in volume["attachments"]
+                    if attachment["server_id"] == server["id"]
+                ]
+            },
+        )
+
+    @route("POST", NOVA + r"/servers/" + ID + r"/os-volume_attachments")
+    def attach_server_volume(self, request: Request) -> Response:
+        server = self.server(request.params["id"])
+        volume_id = body_of(request, "volumeAttachment").get("volumeId")
+        volume = self.find(self.volumes, volume_id, "Volume")
+        if volume["attachments"]:
+            raise ApiError(400, f"Volume {volume_id} is already attached")
+        return Response(200, {"volumeAttachment": self.attach_volume(server, volume)})
+
+    @route(
+        "DELETE", NOVA + r"/servers/" + ID + r"/os-volume_attachments/(?P<volume>[^/]+)"
+    )
+    def detach_server_volume(self, request: Request) -> Response:
+        self.server(request.params["id"])
+        self.detach_volume(self.find(self.volumes, request.params["volume"], "Volume"))
+        return Response(202)
+
+    @route("GET", NOVA + r"/servers/" + ID + r"/os-server-password")
+    def show_server_password(self, request: Request) -> Response:
+        self.server(request.params["id"])
+        return Response(200, {"password": ""})
+
+    @route("DELETE", NOVA + r"/servers/" + ID + r"/os-server-password")
+    def clear_server_password(self, request: Request) -> Response:
+        self.server(request.params["id"])
+        return Response(204)
+
+    @route("POST", NOVA + r"/servers/" + ID + r"/metadata")
+    def update_server_metadata(self, request: Request) -> Response:
+        server = self.server(request.params["id"])
+        metadata = body_of(request, "metadata")
+        server["metadata"].update({k: str(v) for k, v in metadata.items()})
+        return Response(200, {"metadata": server["metadata"]})
+
+    @route("DELETE", NOVA + r"/servers/" + ID + r"/metadata/(?P<key>[^/]+)")
+    def delete_server_metadata(self, request: Request) -> Response:
+        server = self.server(request.params["id"])
+        if server["metadata"].pop(request.params["key"], None) is None:
+            raise ApiError(404, "Metadata item was not found")
+        return Response(204)
+
+    @route("PUT", NOVA + r"/servers/" + ID + r"/tags/(?P<tag>[^/]+)")
+    def add_server_tag(self, request: Request) -> Response:
+        server = self.server(request.params["id"])
+        if request.params["tag"] not in server["tags"]:
+            server["tags"].append(request.params["tag"])
+        return Response(201)
+
+    @route("POST", NOVA + r"/servers/" + ID + r"/remote-consoles")
+    def create_remote_console(self, request: Request) -> Response:
+        self.server(request.params["id"])
+        return Response(
+            200,
+            {
+                "remote_console": {
+                    "protocol": "vnc",
+                    "type": "novnc",
+                    "url": f"{request.base_url}/novnc/vnc_lite.html?token={new_id(self.rng)}",
+                }
+            },
+        )
+
+    @route("GET", NOVA + r"/flavors/detail")
+    def list_flavors(self, request: Request) -> Response:
+        return Response(200, {"flavors": [public(f) for f in self.flavors]})
+
+    @route("GET", NOVA + r"/os-keypairs")
+    def list_keypairs(self, request: Request) -> Response:
+        return Response(
+            200, {"keypairs": [{"keypair": k} for k in self.keypairs.values()]}
+        )
+
+    @route("POST", NOVA + r"/os-keypairs")
+    def create_keypair(self, request: Request) -> Response:
+        spec = body_of(request, "keypair")
+        if spec.get("name") in self.keypairs:
+            raise ApiError(409, f"Key pair '{spec.get('name')}' already exists.")
+        return Response(
+            200, {"keypair": self.add_keypair(spec["name"], spec.get("public_key", ""))}
+        )
+
+    @route("DELETE", NOVA + r"/os-keypairs/" + ID)
+    def delete_keypair(self, request: Request) -> Response:
+        self.find(self.keypairs, request.params["id"], "Keypair")
+        del self.keypairs[request.params["id"]]
+        return Response(202)
+
+    @route("GET", NOVA + r"/limits")
+    def compute_limits(self, request: Request) -> Response:
+        flavors = {f["id"]: f for f in self.flavors}
+        used = [flavors.get(s["flavor"]["id"]) for s in self.servers.values()]
+        used = [flavor for flavor in used if flavor]
+        return Response(
+            200,
+            {
+                "limits": {
+                    "absolute": {
+                        "totalCoresUsed": sum(f["vcpus"] for f in used),
+                        "maxTotalCores": self.quota * 32,
+                        "totalInstancesUsed": len(self.servers),
+                        "maxTotalInstances": self.quota,
+                        "totalRAMUsed": sum(f["ram"] for f in used),
+                        "maxTotalRAMSize": self.quota * 128000,
+                        "maxTotalKeypairs": 100,
+                    },
+                    "rate": [],
+                }
+            },
+        )
+
+    # Cinder
+
+    @route("GET", CINDER + r"/volumes/detail")
+    def list_volumes(self, request: Request) -> Response:
+        return Response(200, {"volumes": list(self.volumes.values())})
+
+    @route("POST", CINDER + r"/volumes")
+    def create_volume(self, request: Request) -> Response:
+        spec = body_of(request, "volume")
+        volume = self.add_volume(
+            spec.get("name"), int(spec.get("size", 1)), time.time()
+        )
+        volume["description"] = spec.get("description")
+        image = self.images.get(spec.get("imageRef"))
+        if image:
+            volume["bootable"] = "true"
+            volume["volume_image_metadata"] = {
+                "image_id": image["id"],
+                "image_name": image["name"],
+            }
+        return Response(202, {"volume": volume})
+
+    @route("PUT", CINDER + r"/volumes/" + ID)
+    def update_volume(self, request: Request) -> Response:
+        volume = self.find(self.volumes, request.params["id"], "Volume")
+        changes = body_of(request, "volume")
+        for key in ("name", "description"):
+            if key in changes:
+                volume[key] = changes[key]
+        return Response(200, {"volume": volume})
+
+    @route("DELETE", CINDER + r"/volumes/" + ID)
+    def delete_volume(self, request: Request) -> Response:
+        volume = self.find(self.volumes, request.params["id"], "Volume")
+        if volume["attachments"]:
+            raise ApiError(400, "Volume status must be available or error")
+        del self.volumes[volume["id"]]
+        return Response(202)
+
+    @route("GET", CINDER + r"/snapshots")
+    def list_snapshots(self, request: Request) -> Response:
+        return Response(200, {"snapshots": list(self.snapshots.values())})
+
+    @route("DELETE", CINDER + r"/snapshots/" + ID)
+    def delete_snapshot(self, request: Request) -> Response:
+        self.find(self.snapshots, request.params["id"], "Snapshot")
+        del self.snapshots[request.params["id"]]
+        return Response(202)
+
+    @route("GET", CINDER + r"/limits")
+    def volume_limits(self, request: Request) -> Response:
+        return Response(
+            200,
+            {
+                "limits": {
+                    "absolute": {
+                        "totalVolumesUsed": len(self.volumes),
+                        "maxTotalVolumes": self.quota,
+                        "totalGigabytesUsed": sum(
+                            v["size"] for v in self.volumes.values()
+                        ),
+                        "maxTotalVolumeGigabytes": self.quota * 1000,
+                    },
+                    "rate": [],
+                }
+            },
+        )
+
+    # Glance
+
+    @route("GET", GLANCE + r"/images")
+    def list_images(self, request: Request) -> Response:
+        images = list(self.images.values())
+        for key in ("visibility", "status"):
+            if key in request.query:
+                images = [i for i in images if i[key] == request.query[key][0]]
+        return Response(200, {"images": images})
+
+    @route("GET", GLANCE + r"/images/" + ID)
+    def show_image(self, request: Request) -> Response:
+        return Response(200, self.find(self.images, request.params["id"], "Image"))
+
+    @route("PATCH", GLANCE + r"/images/" + ID)
+    def update_image(self, request: Request) -> Response:
+        image = self.find(self.images, request.params["id"], "Image")
+        for change in request.body if isinstance(request.body, list) else []:
+            key = change.get("path", "").lstrip("/")
+            if change.get("op") in ("add", "replace"):
+                image[key] = change.get("value")
+            elif change.get("op") == "remove":
+                image.pop(key, None)
+        return Response(200, image)
+
+    @route("DELETE", GLANCE + r"/images/" + ID)
+    def delete_image(self, request: Request) -> Response:
+        image = self.find(self.images, request.params["id"], "Image")
+        if image["protected"]:
+            raise ApiError(
+                403, f"Image {image['id']} is protected and cannot be deleted."
+            )
+        del self.images[image["id"]]
+        return Response(204)
+
+    # Neutron
+
+    @route("GET", NEUTRON + r"/networks")
+    def list_networks(self, request: Request) -> Response:
+        return Response(200, {"networks": self.networks})
+
+    @route("GET", NEUTRON + r"/auto-allocated-topology/[^/]+")
+    def auto_allocated_topology(self, request: Request) -> Response:
+        return Response(
+            200,
+            {
+                "auto_allocated_topology": {
+                    "id": self.networks[1]["id"],
+                    "tenant_id": self.config.project_id,
+                }
+            },
+        )
+
+    @route("GET", NEUTRON + r"/ports")
+    def list_ports(self, request: Request) -> Response:
+        ports = list(self.ports.values())
+        if "device_id" in request.query:
+            ports = [
+                p for p in ports if p["device_id"] == request.query["device_id"][0]
+            ]
+        return Response(200, {"ports": ports})
+
+    @route("GET", NEUTRON + r"/floatingips")
+    def list_floating_ips(self, request: Request) -> Response:
+        return Response(200, {"floatingips": list(self.floating_ips.values())})
+
+    @route("POST", NEUTRON + r"/floatingips")
+    def create_floating_ip(self, request: Request) -> Response:
+        port_id = body_of(request, "floatingip").get("port_id")
+        if port_id is not None:
+            self.find(self.ports, port_id, "Port")
+        return Response(201, {"floatingip": self.add_floating_ip(port_id)})
+
+    @route("PUT", NEUTRON + r"/floatingips/" + ID)
+    def update_floating_ip(self, request: Request) -> Response:
+        floating_ip = self.find(self.floating_ips, request.params["id"], "Floating IP")
+        port_id = body_of(request, "floatingip").get("port_id")
+        if port_id is not None:
+            self.find(self.ports, port_id, "Port")
+        floating_ip["port_id"] = port_id
+        floating_ip["status"] = "ACTIVE" if port_id else "DOWN"
+        return Response(200, {"floatingip": floating_ip})
+
+    @route("DELETE", NEUTRON + r"/floatingips/" + ID)
+    def delete_floating_ip(self, request: Request) -> Response:
+        self.find(self.floating_ips, request.params["id"], "Floating IP")
+        del self.floating_ips[request.params["id"]]
+        return Response(204)
+
+    @route("GET", NEUTRON + r"/security-groups")
+    def list_security_groups(self, request: Request) -> Response:
+        return Response(200, {"security_groups": list(self.security_groups.values())})
+
+    @route("POST", NEUTRON + r"/security-groups")
+    def create_security_group(self, request: Request) -> Response:
+        spec = body_of(request, "security_group")
+        group = self.add_security_group(
+            spec.get("name", ""), spec.get("description"), time.time()
+        )
+        return Response(201, {"security_group": group})
+
+    @route("PUT", NEUTRON + r"/security-groups/" + ID)
+    def update_security_group(self, request: Request) -> Response:
+        group = self.find(self.security_groups, request.params["id"], "Security group")
+        changes = body_of(request, "security_group")
+        for key in ("name", "description"):
+            if key in changes:
+                group[key] = changes[key]
+        return Response(200, {"security_group": group})
+
+    @route("DELETE", NEUTRON + r"/security-groups/" + ID)
+    def delete_security_group(self, request: Request) -> Response:
+        group = self.find(self.security_groups, request.params["id"], "Security group")
+        if any(group["name"] in s["_security_groups"] for s in self.servers.values()):
+            raise ApiError(409, f"Security group {group['id']} is in use.")
+        del self.security_groups[group["id"]]
+        return Response(204)
+
+    @route("POST", NEUTRON + r"/security-groups/" + ID + r"/tags")
+    def add_security_group_tags(self, request: Request) -> Response:
+        group = self.find(self.security_groups, request.params["id"], "Security group")
+        tags = request.body.get("tags", []) if isinstance(request.body, dict) else []
+        group["tags"] = sorted(set(group["tags"]) | set(tags))
+        return Response(201, {"tags": group["tags"]})
+
+    @route("DELETE", NEUTRON + r"/security-groups/" + ID + r"/tags/(?P<tag>[^/]+)")
+    def delete_security_group_tag(self, request: Request) -> Response:
+        group = self.find(self.security_groups, request.params["id"], "Security group")
+        group["tags"] = [tag for tag in group["tags"] if tag != request.params["tag"]]
+        return Response(204)
+
+    @route("POST", NEUTRON + r"/security-group-rules")
+    def create_security_group_rule(self, request: Request) -> Response:
+        rule = self.add_security_group_rule(body_of(request, "security_group_rule"))
+        return Response(201, {"security_group_rule": rule})
+
+    @route("DELETE", NEUTRON + r"/security-group-rules/" + ID)
+    def delete_security_group_rule(self, request: Request) -> Response:
+        for group in self.security_groups.values():
+            rules = group["security_group_rules"]
+            if any(rule["id"] == request.params["id"] for rule in rules):
+                group["security_group_rules"] = [
+                    rule for rule in rules if rule["id"] != request.params["id"]
+                ]
+                return Response(204)
+        raise ApiError(
+            404, f"Security group rule {request.params['id']} could not be found."
+        )
+
+    @route("GET", NEUTRON + r"/quotas/[^/]+/details\.json")
+    def network_quota(self, request: Request) -> Response:
+        return Response(
+            200,
+            {
+                "quota": {
+                    "floatingip": {
+                        "used": len(self.floating_ips),
+                        "limit": self.quota,
+                        "reserved": 0,
+                    }
+                }
+            },
+        )
+
+    # Manila
+
+    @route("GET", MANILA + r"/shares/detail")
+    def list_shares(self, request: Request) -> Response:
+        return Response(200, {"shares": list(self.shares.values())})
+
+    @route("POST", MANILA + r"/shares")
+    def create_share(self, request: Request) -> Response:
+        spec = body_of(request, "share")
+        share = self.add_share(spec.get("name"), int(spec.get("size", 1)), time.time())
+        share["description"] = spec.get("description")
+        share["metadata"] = spec.get("metadata") or {}
+        return Response(200, {"share": share})
+
+    @route("DELETE", MANILA + r"/shares/" + ID)
+    def delete_share(self, request: Request) -> Response:
+        self.find(self.shares, request.params["id"], "Share")
+        del self.shares[request.params["id"]]
+        for rule_id in [
+            rule["id"]
+            for rule in self.access_rules.values()
+            if rule["share_id"] == request.params["id"]
+        ]:
+            del self.access_rules[rule_id]
+        return Response(202)
+
+    @route("POST", MANILA + r"/shares/" + ID + r"/action")
+    def share_action(self, request: Request) -> Response:
+        share = self.find(self.shares, request.params["id"], "Share")
+        if isinstance(request.body, dict) and "allow_access" in request.body:
+            spec = body_of(request, "allow_access")
+            rule = self.add_access_rule(
+                share, spec.get("access_level", "rw"), spec.get("access_to", "")
+            )
+            return Response(200, {"access": rule})
+        if isinstance(request.body, dict) and "extend" in request.body:
+            share["size"] = int(
+                body_of(request, "extend").get("new_size", share["size"])
+            )
+            return Response(202)
+        raise ApiError(400, "Unsupported share action")
+
+    @route("GET", MANILA + r"/shares/" + ID + r"/export_locations")
+    def list_export_locations(self, request: Request) -> Response:
+        share = self.find(self.shares, request.params["id"], "Share")
+        path = f"/volumes/_nogroup/{share['id']}/{new_id(random.Random(share['id']))}"
+        return Response(
+            200,
+            {
+                "export_locations": [
+                    {
+                        "id": new_id(random.Random(path)),
+                        "path": f"10.0.80.11:6789,10.0.80.12:6789,10.0.80.13:6789:{path}",
+                        "preferred": True,
+                    }
+                ]
+            },
+        )
+
+    @route("GET", MANILA + r"/share-access-rules")
+    def list_access_rules(self, request: Request) -> Response:
+        share_id = request.query.get("share_id", [None])[0]
+        return Response(
+            200,
+            {
+                "access_list": [
+                    rule
+                    for rule in self.access_rules.values()
+                    if rule["share_id"] == share_id
+                ]
+            },
+        )
+
+    @route("GET", MANILA + r"/types")
+    def list_share_types(self, request: Request) -> Response:
+        return Response(200, {"share_types": self.share_types})
+
+    @route("GET", MANILA + r"/limits")
+    def share_limits(self, request: Request) -> Response:
+        shares = self.shares.values()
+        return Response(
+            200,
+            {
+                "limits": {
+                    "absolute": {
+                        "totalSharesUsed": len(shares),
+                        "maxTotalShares": self.quota,
+                        "totalShareGigabytesUsed": sum(s["size"] for s in shares),
+                        "maxTotalShareGigabytes": self.quota * 1000,
+                        "totalShareSnapshotsUsed": 0,
+                        "maxTotalShareSnapshots": self.quota,
+                        "totalSnapshotGigabytesUsed": 0,
+                        "maxTotalSnapshotGigabytes": self.quota * 1000,
+                    },
+                    "rate": [],
+                }
+            },
+        )
+
+
+class FakeOpenStackServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: t.Tuple[str, int],
+        cloud: Cloud,
+        latency: float = 0,
+        jitter: float = 0,
+        service_latency: t.Optional[t.Dict[str, float]] = None,
+        proxy_path: str = "/proxy",
+        public_url: t.Optional[str] = None,
+        quiet: bool = False,
+    ):
+        super().__init__(address, FakeOpenStackHandler)
+        self.cloud = cloud
+        self.latency = latency
+        self.jitter = jitter
+        self.service_latency = service_latency or {}
+        self.proxy_path = proxy_path.rstrip("/")
+        self.public_url = public_url
+        self.quiet = quiet
+
+    def delay(self, service: t.Optional[str]) -> float:
+        """Seconds to hold a response for a service back"""
+
+        latency = self.service_latency.get(service, self.latency)
+        return (latency + random.uniform(0, self.jitter)) / 1000
+
+
+class FakeOpenStackHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: FakeOpenStackServer
+
+    def log_message(self, format: str, *args: t.Any):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def do_OPTIONS(self):
+        # A CORS preflight, which browsers may cache for a day
+        self.send_json(
+            Response(
+                204,
+                headers={
+                    "Access-Control-Allow-Methods": "GET, POST, PUT, PATCH, DELETE, OPTIONS",
+                    "Access-Control-Allow-Headers": self.headers.get(
+                        "Access-Control-Request-Headers", "*"
+                    ),
+                    "Access-Control-Max-Age": "86400",
+                },
+            ),
+            self.split_path()[0],
+        )
+
+    def do_GET(self):
+        self.handle_api()
+
+    do_POST = do_PUT = do_PATCH = do_DELETE = do_GET
+
+    def split_path(self) -> t.Tuple[str, str]:
+        path, _, query = self.path.partition("?")
+        # A request through the CORS proxy is for the path after the proxy's
+        if "exo-proxy-orig-host" in self.headers and path.startswith(
+            self.server.proxy_path
+        ):
+            path = path[len(self.server.proxy_path) :]
+        return re.sub(r"/{2,}", "/", path) or "/", query
+
+    def base_url(self) -> str:
+        if self.server.public_url:
+            return self.server.public_url.rstrip("/")
+        # Through the proxy, the catalog keeps the cloud's host name, so Exosphere picks its
+        # configuration for that cloud from cloud_configs.js
+        host = self.headers.get("exo-proxy-orig-host")
+        if host:
+            port = self.headers.get("exo-proxy-orig-port", "443")
+            return f"https://{host}" + ("" if port == "443" else f":{port}")
+        return (
+            f"http://{self.headers.get('Host', '%s:%d' % self.server.server_address)}"
+        )
+
+    def handle_api(self):
+        path, query = self.split_path()
+        length = int(self.headers.get("Content-Length") or 0)
+        raw_body = self.rfile.read(length) if length else b""
+        cloud = self.server.cloud
+        try:
+            matches = [
+                (candidate, match)
+                for candidate in ROUTES
+                for match in [candidate.pattern.fullmatch(path)]
+                if match
+            ]
+            if not matches:
+                raise ApiError(404, f"No API at {path}")
+            found = [m for m in matches if m[0].method == self.command]
+            if not found:
+                raise ApiError(405, f"{self.command} isn't allowed on {path}")
+            api, match = found[0]
+            try:
+                body = json.loads(raw_body) if raw_body else None
+            except ValueError:
+                raise ApiError(400, "The request body isn't valid JSON")
+            token = cloud.tokens.get(self.headers.get("X-Auth-Token", ""))
+            if api.authenticated and token is None:
+                raise ApiError(
+                    401, "The request you have made requires authentication."
+                )
+            request = Request(
+                params={k: v for k, v in match.groupdict().items() if v is not None},
+                query=urllib.parse.parse_qs(query),
+                body=body,
+                base_url=self.base_url(),
+                token=token,
+            )
+            with cloud.lock:
+                response = api.handler(cloud, request)
+        except ApiError as error:
+            response = Response(
+                error.status,
+                {
+                    "error": {
+                        "code": error.status,
+                        "message": error.message,
+                        "title": http.HTTPStatus(error.status).phrase,
+                    }
+                },
+            )
+        self.send_json(response, path)
+
+    def send_json(self, response: Response, path: str):
+        time.sleep(self.server.delay(SERVICES.get(path.split("/")[1])))
+        content = b"" if response.body is None else json.dumps(response.body).encode()
+        self.send_response(response.status)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Expose-Headers", "X-Subject-Token")
+        for name, value in (response.headers or {}).items():
+            self.send_header(name, value)
+        if content:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if content and self.command != "HEAD":
+            self.wfile.write(content)
+
+
+def parse_service_latency(value: str) -> t.Tuple[str, float]:
+    service, _, latency = value.partition("=")
+    if service not in SERVICES.values() or not latency:
+        raise argparse.ArgumentTypeError(
+            f"expected SERVICE=MS, with SERVICE one of {', '.join(SERVICES.values())}"
+        )
+    return service, float(latency)
+
+
+def main(argv: t.Optional[t.List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1", help="(default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8775, help="(default: 8775)")
+
+    fleet = parser.add_argument_group("fleet")
+    fleet.add_argument("--servers", type=int, default=50, help="(default: 50)")
+    fleet.add_argument("--volumes", type=int, default=20, help="(default: 20)")
+    fleet.add_argument("--shares", type=int, default=10, help="(default: 10)")
+    fleet.add_argument(
+        "--images",
+        type=int,
+        default=30,
+        help=f"including the {len(FEATURED_IMAGES)} featured images (default: 30)",
+    )
+    fleet.add_argument(
+        "--console-records",
+        type=int,
+        default=1440,
+        help="resource usage records kept in each console log, one a minute (default: 1440)",
+    )
+    fleet.add_argument(
+        "--console-format",
+        choices=["full", "compact"],
+        default="full",
+        help="how system_load_json.py writes the records (default: full)",
+    )
+    fleet.add_argument(
+        "--batch-size",
+        type=int,
+        default=10,
+        help="records in each compact line (default: 10)",
+    )
+    fleet.add_argument(
+        "--build-seconds",
+        type=float,
+        default=10,
+        help="how long a new instance builds for (default: 10)",
+    )
+    fleet.add_argument(
+        "--setup-seconds",
+        type=float,
+        default=20,
+        help="how long a new instance's setup runs for, once built (default: 20)",
+    )
+    fleet.add_argument("--seed", type=int, default=0, help="(default: 0)")
+
+    latency = parser.add_argument_group("latency")
+    latency.add_argument(
+        "--latency", type=float, default=0, help="ms added to every response"
+    )
+    latency.add_argument(
+        "--jitter", type=float, default=0, help="up to this many more ms at random"
+    )
+    latency.add_argument(
+        "--service-latency",
+        type=parse_service_latency,
+        action="append",
+        default=[],
+        metavar="SERVICE=MS",
+        help="ms added to one service's responses instead, e.g. compute=2000",
+    )
+
+    identity = parser.add_argument_group("identity")
+    identity.add_argument(
+        "--project-name",
+        default=DEFAULT_PROJECT_NAME,
+        help=f"(default: {DEFAULT_PROJECT_NAME})",
+    )
+    identity.add_argument(
+        "--project-id",
+        default=DEFAULT_PROJECT_ID,
+        help=f"(default: {DEFAULT_PROJECT_ID})",
+    )
+    identity.add_argument(
+        "--region", default=DEFAULT_REGION, help=f"(default: {DEFAULT_REGION})"
+    )
+    identity.add_argument("--username", help="only accept this user name")
+    identity.add_argument("--password", help="only accept this password")
+
+    parser.add_argument(
+        "--proxy-path",
+        default="/proxy",
+        help="path that Exosphere's cloudCorsProxyUrl points at (default: /proxy)",
+    )
+    parser.add_argument(
+        "--public-url",
+        help="base URL of the endpoints in the catalog (default: where each request was sent)",
+    )
+    parser.add_argument("--quiet", action="store_true", help="don't log requests")
+    args = parser.parse_args(argv)
+
+    if not re.fullmatch(r"[0-9a-f]{32}", args.project_id):
+        parser.error("--project-id must be 32 hexadecimal digits")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+
+    cloud = Cloud(
+        CloudConfig(
+            servers=args.servers,
+            volumes=args.volumes,
+            shares=args.shares,
+            images=args.images,
+            console_records=args.console_records,
+            console_format=args.console_format,
+            batch_size=args.batch_size,
+            build_seconds=args.build_seconds,
+            setup_seconds=args.setup_seconds,
+            seed=args.seed,
+            project_name=args.project_name,
+            project_id=args.project_id,
+            region=args.region,
+            username=args.username,
+            password=args.password,
+        )
+    )
+    server = FakeOpenStackServer(
+        (args.host, args.port),
+        cloud,
+        latency=args.latency,
+        jitter=args.jitter,
+        service_latency=dict(args.service_latency),
+        proxy_path=args.proxy_path,
+        public_url=args.public_url,
+        quiet=args.quiet,
+    )
+    host, port = server.server_address[:2]
+    print(
+        f"Fake OpenStack with {len(cloud.servers)} instances, {len(cloud.volumes)} volumes "
+        f"and {len(cloud.shares)} shares, at http://{host}:{port}/v3/ "
+        f"(or through http://{host}:{port}{server.proxy_path})",
+        flush=True,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
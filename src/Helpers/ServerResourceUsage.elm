@@ -24,8 +24,8 @@ parseConsoleLog consoleLog prevHistory =
         decodedData =
             loglines
                 |> List.map Helpers.stripTimeSinceBootFromLogLine
-                |> List.filterMap
-                    (\l -> Json.Decode.decodeString logLineDecoder l |> Result.toMaybe)
+                |> List.concatMap
+                    (\l -> Json.Decode.decodeString logLineDecoder l |> Result.withDefault [])
 
         newTimeSeries =
             List.foldl
@@ -43,8 +43,16 @@ parseConsoleLog consoleLog prevHistory =
     History newTimeSeries newStrikes
 
 
-logLineDecoder : Json.Decode.Decoder ( Int, DataPoint )
+logLineDecoder : Json.Decode.Decoder (List ( Int, DataPoint ))
 logLineDecoder =
+    Json.Decode.oneOf
+        [ compactLogLineDecoder
+        , Json.Decode.map List.singleton fullLogLineDecoder
+        ]
+
+
+fullLogLineDecoder : Json.Decode.Decoder ( Int, DataPoint )
+fullLogLineDecoder =
     Json.Decode.map2 Tuple.pair
         (Json.Decode.field "epoch" Json.Decode.int
             -- This gets us milliseconds
@@ -64,6 +72,57 @@ logLineDecoder =
         )
 
 
+compactLogLineDecoder : Json.Decode.Decoder (List ( Int, DataPoint ))
+compactLogLineDecoder =
+    -- Version 2 lines batch several data points, e.g. {"v":2,"e":1700000000,"s":[[0,12,40,55],[60,10,41,55,[3]]]}
+    -- "e" is the epoch of the first data point, and each data point starts with seconds since the previous one.
+    -- See ansible/roles/system-load-logging/files/system_load_json.py for the encoder.
+    Json.Decode.field "v" Json.Decode.int
+        |> Json.Decode.andThen
+            (\version ->
+                if version == 2 then
+                    Json.Decode.map2 fromEpochDeltas
+                        (Json.Decode.field "e" Json.Decode.int)
+                        (Json.Decode.field "s" (Json.Decode.list compactDataPointDecoder))
+
+                else
+                    Json.Decode.fail ("Unsupported resource usage record version " ++ String.fromInt version)
+            )
+
+
+compactDataPointDecoder : Json.Decode.Decoder ( Int, DataPoint )
+compactDataPointDecoder =
+    Json.Decode.map2 Tuple.pair
+        (Json.Decode.index 0 Json.Decode.int)
+        (Json.Decode.map4 DataPoint
+            (Json.Decode.index 1 Json.Decode.int)
+            (Json.Decode.index 2 Json.Decode.int)
+            (Json.Decode.index 3 Json.Decode.int)
+            (Json.Decode.oneOf
+                [ Json.Decode.index 4 (Json.Decode.list Json.Decode.int)
+                , Json.Decode.succeed []
+                ]
+            )
+        )
+
+
+fromEpochDeltas : Int -> List ( Int, DataPoint ) -> List ( Int, DataPoint )
+fromEpochDeltas firstEpoch deltas =
+    deltas
+        |> List.foldl
+            (\( delta, dataPoint ) ( prevEpoch, dataPoints ) ->
+                let
+                    epoch =
+                        prevEpoch + delta
+                in
+                -- This gets us milliseconds
+                ( epoch, ( epoch * 1000, dataPoint ) :: dataPoints )
+            )
+            ( firstEpoch, [] )
+        |> Tuple.second
+        |> List.reverse
+
+
 timeSeriesRecentDataPoints : TimeSeries -> Time.Posix -> Int -> Dict.Dict Int DataPoint
 timeSeriesRecentDataPoints timeSeries currentTime timeIntervalDurationMillis =
     let
@@ -0,0 +1,52 @@
+module Tests.Helpers.ServerResourceUsage exposing (parseConsoleLogSuite)
+
+import Dict
+import Expect
+import Helpers.ServerResourceUsage
+import Test exposing (Test, describe, test)
+import Types.ServerResourceUsage exposing (emptyResourceUsageHistory)
+
+
+parseConsoleLogSuite : Test
+parseConsoleLogSuite =
+    describe "parseConsoleLog"
+        [ test "decodes one data point per full JSON line" <|
+            \_ ->
+                """[ 2915.727779] {"epoch": 1700000000, "cpuPctUsed": 12, "memPctUsed": 40, "rootfsPctUsed": 55, "gpuPctUsed": null}
+{"epoch": 1700000060, "cpuPctUsed": 10, "memPctUsed": 41, "rootfsPctUsed": 55, "gpuPctUsed": [3, 4]}"""
+                    |> parse
+                    |> Expect.equal
+                        [ ( 1700000000000, { cpuPctUsed = 12, memPctUsed = 40, rootfsPctUsed = 55, gpuPctUsed = [] } )
+                        , ( 1700000060000, { cpuPctUsed = 10, memPctUsed = 41, rootfsPctUsed = 55, gpuPctUsed = [ 3, 4 ] } )
+                        ]
+        , test "decodes every data point in a compact line" <|
+            \_ ->
+                """[ 2915.727779] {"v":2,"e":1700000000,"s":[[0,12,40,55],[60,10,41,55,[3,4]],[60,11,41,56]]}"""
+                    |> parse
+                    |> Expect.equal
+                        [ ( 1700000000000, { cpuPctUsed = 12, memPctUsed = 40, rootfsPctUsed = 55, gpuPctUsed = [] } )
+                        , ( 1700000060000, { cpuPctUsed = 10, memPctUsed = 41, rootfsPctUsed = 55, gpuPctUsed = [ 3, 4 ] } )
+                        , ( 1700000120000, { cpuPctUsed = 11, memPctUsed = 41, rootfsPctUsed = 56, gpuPctUsed = [] } )
+                        ]
+        , test "decodes full and compact lines in the same log" <|
+            \_ ->
+                """{"epoch": 1700000000, "cpuPctUsed": 12, "memPctUsed": 40, "rootfsPctUsed": 55, "gpuPctUsed": null}
+{"v":2,"e":1700000060,"s":[[0,10,41,55]]}"""
+                    |> parse
+                    |> List.map Tuple.first
+                    |> Expect.equal [ 1700000000000, 1700000060000 ]
+        , test "ignores unsupported versions and other log lines" <|
+            \_ ->
+                """{"v":3,"e":1700000000,"s":[[0,12,40,55]]}
+{"exoSetup":"complete"}
+not json at all"""
+                    |> parse
+                    |> Expect.equal []
+        ]
+
+
+parse : String -> List ( Int, Types.ServerResourceUsage.DataPoint )
+parse consoleLog =
+    Helpers.ServerResourceUsage.parseConsoleLog consoleLog emptyResourceUsageHistory
+        |> .timeSeries
+        |> Dict.toList